@@ -11,20 +11,36 @@ import commands
 # import platform
 import optparse
 import glob
+import json
+import socket
 
 from py_knife import file_system
 from py_knife.ordered_dict import OrderedDict
 from py_knife.database import DatabaseOrderedDict
 from py_knife.logger import Logger
 
-from vmware_backup import DEFAULT_SETTINGS, FOLDER_TS_FORMAT, MUTLIPLE_TAPE_SYSTEM
-from vmware_backup import execute_backup, enable_backup, disable_backup
+from vmware_backup import DEFAULT_SETTINGS, FOLDER_TS_FORMAT, MUTLIPLE_TAPE_SYSTEM, BACKUP_MODES
+from vmware_backup.default_settings import TARGET_TYPES, IO_PRIORITIES, PRUNE_MODES
+from vmware_backup import execute_backup, execute_plan, execute_restore, enable_backup, disable_backup, BackupCatalog
+from vmware_backup import execute_daemon, daemon_command
+from vmware_backup.daemon import COMMANDS
+from vmware_backup.compression import CODEC_NAMES, available_codecs
+from vmware_backup.checksum import CHECKSUM_NAMES, available_checksums
+from vmware_backup.throttle import parse_hours
+from vmware_backup.retry import parse_retry
 
 
 ### CONSTANTS ###
 ## Module Constants ##
 CWD = sys.path[0]
 BACKUP_COMMAND = 'python ' + os.path.join(CWD, 'run_backup.py') + ' -b'
+CATALOG_PATH = os.path.join(CWD, 'backup_catalog.db')
+DAEMON_SOCKET_PATH = os.path.join(CWD, 'backup_daemon.sock')
+LOGS_PATH = os.path.join(CWD, 'logs')
+
+## Switch Options ##
+SWITCH_CHOICES = ('on', 'off')
+SWITCH_VALUES = {'on': True, 'off': False, 'True': True, 'False': False}
 
 
 ### FUNCTIONS ###
@@ -43,16 +59,137 @@ def parse_input_options(allow_time_stamp_mods=True):
     parser.add_option('-p', '--print_settings', dest='print_settings', action='store_true', default=False,
                       help='Print current backup settings')
 
+    parser.add_option('--rebuild_catalog', dest='rebuild_catalog', action='store_true', default=False,
+                      help='Rebuild backup catalog by scanning all of the backup tapes')
+
+    parser.add_option('--plan', dest='plan_backup', action='store_true', default=False,
+                      help='Show what backup would do (dry run). Virtual machines that need backup are sized and '
+                           'assigned tapes, copy time and suspend window are estimated using throughput recorded by '
+                           'earlier runs. Nothing is suspended or copied')
+
+    restore_group = optparse.OptionGroup(parser, 'Restore Options')
+    restore_group.add_option('--restore', dest='restore_vm', type='str', default=None,
+                             help='Restore virtual machine (by its folder name) from the latest backup')
+    restore_group.add_option('--date', dest='restore_date', type='str', default=None,
+                             help='Restore backup made on particular date (part of the backup folder time stamp, '
+                                  'such as 20160131)')
+    restore_group.add_option('--restore_target', dest='restore_target', type='str', default=None,
+                             help='Restore virtual machine to particular folder (virtual machines path by default). '
+                                  'Existing machines are never overwritten')
+    parser.add_option_group(restore_group)
+
+    daemon_group = optparse.OptionGroup(parser, 'Daemon')
+    daemon_group.add_option('--daemon', dest='run_daemon', action='store_true', default=False,
+                            help='Run backup daemon. Daemon stays resident and backs up virtual machines on schedule '
+                                 '(use instead of --enable)')
+    daemon_group.add_option('--control', dest='daemon_command', type='choice', choices=COMMANDS, default=None,
+                            help='Send command to the running backup daemon (' + ', '.join(COMMANDS) + ')')
+    parser.add_option_group(daemon_group)
+
     backup_group = optparse.OptionGroup(parser, 'Backup Settings')
     backup_group.add_option('-s', '--schedule', dest='crone_schedule', type='str', default=None,
                             help='Set backup schedule. Use crontab format. '
                                  'Refer to "man 5 crontab" for more information')
     backup_group.add_option('-r', '--vmrun', dest='vmrun_path', type='str', default=None,
                             help='Change path to vmrun')
+    backup_group.add_option('--vmrun_timeout', dest='vmrun_timeout', type='int', default=None,
+                            help='Change how long a single vmrun call could take before it is killed (in seconds)')
     backup_group.add_option('-v', '--vms', dest='vms_path', type='str', default=None,
                             help='Change path to target virtual machines')
     backup_group.add_option('-t', '--tape', dest='tape_path', type='str', default=None,
                             help='Change path to backup tapes')
+    backup_group.add_option('-w', '--workers', dest='backup_workers', type='int', default=None,
+                            help='Change number of virtual machines backed up at once')
+    backup_group.add_option('--tape_workers', dest='tape_workers', type='int', default=None,
+                            help='Change number of virtual machines backed up at once to the same tape')
+    backup_group.add_option('--file_workers', dest='file_workers', type='int', default=None,
+                            help='Change number of files of the same virtual machine copied at once')
+    backup_group.add_option('--disk_streams', dest='disk_streams', type='int', default=None,
+                            help='Change number of files written at once to the same disk')
+    backup_group.add_option('--tape_streams', dest='tape_streams', type='int', default=None,
+                            help='Change number of files written at once to the same tape')
+    backup_group.add_option('--target', dest='target_type', type='choice', choices=TARGET_TYPES, default=None,
+                            help='Change backup target type (' + ', '.join(TARGET_TYPES) + '). '
+                                 'Auto detects tapes by their file system (LTFS)')
+    backup_group.add_option('--copy_buffer', dest='copy_buffer_mb', type='int', default=None,
+                            help='Change size of the copy buffer (in MB)')
+    backup_group.add_option('--pipeline', dest='pipeline_copy', type='choice', choices=SWITCH_CHOICES,
+                            default=None, help='Turn copy pipeline on or off. Files are read and written by separate '
+                                               'threads, so reading and writing overlap')
+    backup_group.add_option('--copy_memory', dest='copy_memory_mb', type='int', default=None,
+                            help='Change memory taken up by the copy buffers of all of the copies together (in MB)')
+    backup_group.add_option('--two_phase', dest='two_phase_copy', type='choice', choices=SWITCH_CHOICES,
+                            default=None, help='Turn two phase copy on or off. Running virtual machines are copied '
+                                               'first and suspended only to copy changes made since')
+    backup_group.add_option('--sparse', dest='sparse_copy', type='choice', choices=SWITCH_CHOICES,
+                            default=None, help='Turn sparse copy on or off. Holes and blocks of zeros of virtual disk '
+                                               'files are not written to the tapes')
+    backup_group.add_option('--checkpoint', dest='checkpoint_mb', type='int', default=None,
+                            help='Change how often copy progress is recorded in the backup journal (in MB)')
+    backup_group.add_option('--checksum', dest='checksum', type='choice', choices=CHECKSUM_NAMES, default=None,
+                            help='Change checksum computed while copying. Available checksums: ' +
+                                 ', '.join(available_checksums()))
+    backup_group.add_option('--verify', dest='verify_backup', type='choice', choices=SWITCH_CHOICES,
+                            default=None, help='Turn backup verification on or off. Completed backups are read back '
+                                               'from the tapes and compared against their checksums')
+    backup_group.add_option('--write_block', dest='write_block_kb', type='int', default=None,
+                            help='Change size of the blocks written to the tapes (in KB)')
+    backup_group.add_option('--write_alignment', dest='write_alignment', type='int', default=None,
+                            help='Change alignment of the blocks written to the tapes (in bytes)')
+    backup_group.add_option('--direct_io', dest='direct_io', type='choice', choices=SWITCH_CHOICES, default=None,
+                            help='Turn direct I/O on or off. Blocks are written to the tapes bypassing page cache')
+    backup_group.add_option('--fadvise', dest='fadvise', type='choice', choices=SWITCH_CHOICES, default=None,
+                            help='Turn page cache hints on or off. Virtual machine files are read sequentially and '
+                                 'dropped from the page cache once copied')
+    backup_group.add_option('-c', '--compression', dest='compression', type='choice', choices=CODEC_NAMES,
+                            default=None, help='Change compression codec. Available codecs: ' +
+                                               ', '.join(available_codecs()))
+    backup_group.add_option('--level', dest='compression_level', type='int', default=None,
+                            help='Change compression level')
+    backup_group.add_option('--compression_workers', dest='compression_workers', type='int', default=None,
+                            help='Change number of threads compressing each file')
+    backup_group.add_option('-m', '--mode', dest='backup_mode', type='choice', choices=BACKUP_MODES, default=None,
+                            help='Change backup mode. Available modes: ' + ', '.join(BACKUP_MODES))
+    backup_group.add_option('--block_size', dest='incremental_block_mb', type='int', default=None,
+                            help='Change size of the incremental backup block (in MB)')
+    backup_group.add_option('--chunk_size', dest='chunk_size_mb', type='int', default=None,
+                            help='Change size of the chunked backup chunk (in MB)')
+    backup_group.add_option('--read_limit', dest='read_limit_mb', type='int', default=None,
+                            help='Limit rate of reading virtual machine files (in MB/s, 0 for unlimited)')
+    backup_group.add_option('--write_limit', dest='write_limit_mb', type='int', default=None,
+                            help='Limit rate of writing to the tapes (in MB/s, 0 for unlimited)')
+    backup_group.add_option('--limit_hours', dest='limit_hours', type='str', default=None,
+                            help='Apply rate limits during particular hours only, such as "8-18". '
+                                 'Use empty string to apply those at all times')
+    backup_group.add_option('--io_priority', dest='io_priority', type='choice', choices=IO_PRIORITIES,
+                            default=None, help='Change CPU and I/O priority of the backup (' +
+                                               ', '.join(IO_PRIORITIES) + ')')
+    backup_group.add_option('--suspend_retry', dest='suspend_retry', type='str', default=None,
+                            help='Change retry policy of suspending virtual machines. Use "attempts,initial delay,'
+                                 'maximum delay,deadline" format (in seconds, 0 deadline for none), such as '
+                                 '"10,1,30,1800". State is polled with exponentially growing delays (for at most '
+                                 'attempts times maximum delay without deadline)')
+    backup_group.add_option('--resume_retry', dest='resume_retry', type='str', default=None,
+                            help='Change retry policy of resuming virtual machines (same format)')
+    backup_group.add_option('--create_folder_retry', dest='create_folder_retry', type='str', default=None,
+                            help='Change retry policy of creating backup folders (same format)')
+    backup_group.add_option('--backup_retry', dest='backup_retry', type='str', default=None,
+                            help='Change retry policy of copying virtual machines (same format)')
+    backup_group.add_option('--prune', dest='prune_mode', type='choice', choices=PRUNE_MODES, default=None,
+                            help='Change when backups outside of the retention policy are pruned (' +
+                                 ', '.join(PRUNE_MODES) + '). Either all at once before the backup run or only '
+                                 'when virtual machine does not fit on any tape')
+    backup_group.add_option('--keep_last', dest='keep_last', type='int', default=None,
+                            help='Keep last N backups of each virtual machine (0 to disable this rule)')
+    backup_group.add_option('--keep_daily', dest='keep_daily', type='int', default=None,
+                            help='Keep latest backup of each of the last N days (0 to disable this rule)')
+    backup_group.add_option('--keep_weekly', dest='keep_weekly', type='int', default=None,
+                            help='Keep latest backup of each of the last N weeks (0 to disable this rule)')
+    backup_group.add_option('--keep_monthly', dest='keep_monthly', type='int', default=None,
+                            help='Keep latest backup of each of the last N months (0 to disable this rule)')
+    backup_group.add_option('--prometheus', dest='prometheus_file', type='str', default=None,
+                            help='Write metrics of each backup run to particular Prometheus textfile collector file '
+                                 '(*.prom). Use empty string to disable')
 
     if allow_time_stamp_mods:
         backup_group.add_option('-f', '--folder_ts', dest='folder_ts_format', type='str', default=None,
@@ -81,8 +218,46 @@ def validate_settings(current_settings, new_settings=None):
     key_error_pairs = {
         'crone_schedule': ('Schedule string "', '" is in incompatible format!'),
         'vmrun_path': ('Can not reach VMWare vmrun command under "', '" location!'),
+        'vmrun_timeout': ('vmrun timeout "', '" should be a positive integer!'),
         'vms_path': ('No virtual machines under "', '" location!'),
         'tape_path': ('No backup tapes under "', '" location!'),
+        'backup_workers': ('Number of backup workers "', '" should be a positive integer!'),
+        'tape_workers': ('Number of tape workers "', '" should be a positive integer!'),
+        'file_workers': ('Number of file workers "', '" should be a positive integer!'),
+        'disk_streams': ('Number of disk streams "', '" should be a positive integer!'),
+        'tape_streams': ('Number of tape streams "', '" should be a positive integer!'),
+        'target_type': ('Backup target type "', '" is not supported!'),
+        'copy_buffer_mb': ('Copy buffer size "', '" should be a positive integer!'),
+        'pipeline_copy': ('Copy pipeline switch "', '" should be either "on" or "off"!'),
+        'copy_memory_mb': ('Copy memory ceiling "', '" should be a positive integer!'),
+        'checkpoint_mb': ('Checkpoint interval "', '" should be a positive integer!'),
+        'two_phase_copy': ('Two phase copy switch "', '" should be either "on" or "off"!'),
+        'sparse_copy': ('Sparse copy switch "', '" should be either "on" or "off"!'),
+        'checksum': ('Checksum "', '" is not available!'),
+        'verify_backup': ('Backup verification switch "', '" should be either "on" or "off"!'),
+        'write_block_kb': ('Write block size "', '" should be a positive integer!'),
+        'write_alignment': ('Write alignment "', '" should be a power of two!'),
+        'direct_io': ('Direct I/O switch "', '" should be either "on" or "off"!'),
+        'fadvise': ('Page cache hints switch "', '" should be either "on" or "off"!'),
+        'backup_mode': ('Backup mode "', '" is not supported!'),
+        'compression': ('Compression codec "', '" is not available!'),
+        'compression_level': ('Compression level "', '" should be a positive integer!'),
+        'incremental_block_mb': ('Incremental block size "', '" should be a positive integer!'),
+        'chunk_size_mb': ('Chunk size "', '" should be a positive integer!'),
+        'prometheus_file': ('Can not write Prometheus metrics to "', '" location!'),
+        'read_limit_mb': ('Read limit "', '" should be a non negative integer!'),
+        'write_limit_mb': ('Write limit "', '" should be a non negative integer!'),
+        'limit_hours': ('Hours string "', '" is in incompatible format!'),
+        'io_priority': ('I/O priority "', '" is not supported!'),
+        'prune_mode': ('Prune mode "', '" is not supported!'),
+        'keep_last': ('Number of backups to keep "', '" should be a non negative integer!'),
+        'keep_daily': ('Number of daily backups to keep "', '" should be a non negative integer!'),
+        'keep_weekly': ('Number of weekly backups to keep "', '" should be a non negative integer!'),
+        'keep_monthly': ('Number of monthly backups to keep "', '" should be a non negative integer!'),
+        'suspend_retry': ('Suspend retry policy "', '" is in incompatible format!'),
+        'resume_retry': ('Resume retry policy "', '" is in incompatible format!'),
+        'create_folder_retry': ('Create folder retry policy "', '" is in incompatible format!'),
+        'backup_retry': ('Backup retry policy "', '" is in incompatible format!'),
         'folder_ts_format': ('', ''),
         'log_ts_format': ('', '')
     }
@@ -134,6 +309,70 @@ def validate_settings(current_settings, new_settings=None):
                     current_settings[_settings_key] = _settings_value
                     output = True
 
+            elif '_limit_mb' in _settings_key or _settings_key.startswith('keep_'):
+                output = _settings_value.isdigit()
+                if output:
+                    current_settings[_settings_key] = int(_settings_value)
+
+            elif '_workers' in _settings_key or '_streams' in _settings_key or '_mb' in _settings_key or \
+                    _settings_key in ('compression_level', 'vmrun_timeout', 'write_block_kb'):
+                output = bool(_settings_value.isdigit() and int(_settings_value) > 0)
+                if output:
+                    current_settings[_settings_key] = int(_settings_value)
+
+            elif _settings_key == 'write_alignment':
+                output = bool(_settings_value.isdigit() and int(_settings_value) > 0 and
+                              not int(_settings_value) & (int(_settings_value) - 1))
+                if output:
+                    current_settings[_settings_key] = int(_settings_value)
+
+            elif _settings_key in ('backup_mode', 'compression', 'target_type', 'checksum', 'io_priority',
+                                   'prune_mode'):
+                if _settings_key == 'backup_mode':
+                    output = bool(_settings_value in BACKUP_MODES)
+                elif _settings_key == 'target_type':
+                    output = bool(_settings_value in TARGET_TYPES)
+                elif _settings_key == 'checksum':
+                    output = bool(_settings_value in available_checksums())
+                elif _settings_key == 'io_priority':
+                    output = bool(_settings_value in IO_PRIORITIES)
+                elif _settings_key == 'prune_mode':
+                    output = bool(_settings_value in PRUNE_MODES)
+                else:
+                    output = bool(_settings_value in available_codecs())
+
+                if output:
+                    current_settings[_settings_key] = _settings_value
+
+            elif _settings_key in ('two_phase_copy', 'sparse_copy', 'pipeline_copy', 'verify_backup', 'direct_io',
+                                   'fadvise'):
+                output = bool(_settings_value in SWITCH_VALUES)
+                if output:
+                    current_settings[_settings_key] = SWITCH_VALUES[_settings_value]
+
+            elif _settings_key == 'limit_hours':
+                try:
+                    parse_hours(_settings_value)
+                except ValueError:
+                    output = False
+                else:
+                    current_settings[_settings_key] = _settings_value
+                    output = True
+
+            elif _settings_key.endswith('_retry'):
+                try:
+                    parse_retry(_settings_value)
+                except ValueError:
+                    output = False
+                else:
+                    current_settings[_settings_key] = _settings_value
+                    output = True
+
+            elif _settings_key == 'prometheus_file':
+                output = bool(not _settings_value or os.path.isdir(os.path.dirname(os.path.abspath(_settings_value))))
+                if output:
+                    current_settings[_settings_key] = _settings_value
+
             elif _settings_key == 'crone_schedule':
                 crone_limits = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 6)]
                 crone_input_list = _settings_value.split()
@@ -188,7 +427,8 @@ def _hasattr(test_object, attr_name):
     if type(test_object) in (dict, OrderedDict, DatabaseOrderedDict):
         return attr_name in test_object.keys()
     else:
-        return getattr(test_object, attr_name)
+        # Note: Options that have not been provided are None, zeros and empty strings are valid values
+        return getattr(test_object, attr_name, None) is not None
 
 
 def _getattr(test_object, attr_name):
@@ -205,6 +445,7 @@ if __name__ == '__main__':
     # print '*** Loading Backup Settings ***'
     settings_path = os.path.join(CWD, 'backup_settings.db')
     backup_settings = DatabaseOrderedDict(db_file=settings_path, defaults=DEFAULT_SETTINGS)
+    backup_settings['_catalog_path'] = CATALOG_PATH
 
     # Fetch User Options
     allow_ts_mods = bool('folder_ts_format' in backup_settings)
@@ -219,10 +460,10 @@ if __name__ == '__main__':
             backup_settings['_backup_ts'] = file_system.create_time_stamp(FOLDER_TS_FORMAT)
 
         # Create Logs
-        logs_folder_path = os.path.join(CWD, 'logs')
-        file_system.make_dir(logs_folder_path)
-        log_file_path = os.path.join(logs_folder_path, 'backup' + backup_settings['_backup_ts'])
+        file_system.make_dir(LOGS_PATH)
+        log_file_path = os.path.join(LOGS_PATH, 'backup' + backup_settings['_backup_ts'])
         sys.stdout = Logger(log_file_path)
+        backup_settings['_metrics_path'] = os.path.join(LOGS_PATH, 'metrics' + backup_settings['_backup_ts'] + '.json')
 
     # Check operating system
     # TODO: Test on Windows and/or MAC, make sure its working properly!
@@ -241,6 +482,14 @@ if __name__ == '__main__':
             settings_value = backup_settings[settings_key]
             print '{0:<3} {1:<25} {2:<25}'.format('', settings_key, str(settings_value))
 
+    if input_options.daemon_command is not None:
+        print '*** Sending Command to Backup Daemon ***'
+        try:
+            print json.dumps(daemon_command(DAEMON_SOCKET_PATH, input_options.daemon_command), indent=4)
+        except (socket.error, ValueError) as e:
+            print 'Could not reach backup daemon: ' + str(e)
+            sys.exit(1)
+
     if validate_settings(backup_settings):
         if input_options.enable_backup:
             print '*** Enable Backup ***'
@@ -252,6 +501,30 @@ if __name__ == '__main__':
             # Disable crone job
             disable_backup(BACKUP_COMMAND)
 
+        if input_options.rebuild_catalog:
+            print '*** Rebuilding Backup Catalog ***'
+            backup_catalog = BackupCatalog(backup_settings, CATALOG_PATH)
+            print 'Backups found: ' + str(backup_catalog.rebuild())
+            backup_catalog.close()
+
+        if input_options.plan_backup:
+            print '*** Planning Backup (dry run) ***'
+            execute_plan(backup_settings, LOGS_PATH)
+
         if input_options.back_up:
             print '*** Executing Backup ***'
             execute_backup(backup_settings)
+
+        if input_options.restore_vm is not None:
+            print '*** Executing Restore ***'
+            if not execute_restore(backup_settings, input_options.restore_vm, input_options.restore_date,
+                                   input_options.restore_target):
+                sys.exit(1)
+
+        if input_options.run_daemon:
+            print '*** Starting Backup Daemon ***'
+            if os.name != 'posix':
+                print 'Backup daemon is not supported on this operating system!'
+                sys.exit(1)
+
+            execute_daemon(backup_settings, DAEMON_SOCKET_PATH, LOGS_PATH)
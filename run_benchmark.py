@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+"""
+Backup Benchmark Script
+Runs backup end to end against synthetic virtual machines, local folders playing role of tapes and a fake vmrun.
+Reports throughput, wall time, suspend windows and subprocess counts, so performance regressions could be caught
+without VMWare and tape library
+"""
+
+
+### INCLUDES ###
+import os
+import sys
+import copy
+import json
+import time
+import random
+import shutil
+import optparse
+import tempfile
+import collections
+
+from py_knife import file_system
+
+from vmware_backup import DEFAULT_SETTINGS, BACKUP_MODES, execute_backup
+from vmware_backup.compression import available_codecs
+from vmware_backup.checksum import available_checksums
+from vmware_backup.metrics import OPERATIONS
+from vmware_backup.retry import retry_policy, RETRY_SETTINGS_SUFFIX
+
+
+### CONSTANTS ###
+## Module Constants ##
+MEGA_BYTE = 1024 * 1024
+CALLS_LOG_NAME = 'vmrun_calls.log'
+RUNNING_LIST_NAME = 'vmrun_running.txt'
+METRICS_NAME = 'metrics.json'
+RETRY_MAX_DELAY_FACTOR = 16
+
+## Fake vmrun ##
+# Keeps list of running machines in a text file, logs every call. Suspended machine dumps its memory to the disk.
+FAKE_VMRUN_TEMPLATE = '''#!{python}
+import os, sys, time, random
+RUNNING_LIST_PATH = {running_list_path!r}
+CALLS_LOG_PATH = {calls_log_path!r}
+LATENCY = {latency!r}
+FAILURE_RATE = {failure_rate!r}
+MEMORY_SIZE = {memory_size!r}
+
+def running_vms():
+    with open(RUNNING_LIST_PATH) as running_file:
+        return [line.strip() for line in running_file if line.strip()]
+
+def save_running_vms(vm_list):
+    with open(RUNNING_LIST_PATH + '.tmp', 'w') as running_file:
+        running_file.write(''.join([vm_path + '\\n' for vm_path in vm_list]))
+    os.rename(RUNNING_LIST_PATH + '.tmp', RUNNING_LIST_PATH)
+
+command = sys.argv[1] if len(sys.argv) > 1 else ''
+with open(CALLS_LOG_PATH, 'a') as calls_log:
+    calls_log.write(command + '\\n')
+
+if not command:
+    print 'vmrun version 1.0.0 (benchmark)'
+    sys.exit(0)
+
+time.sleep(LATENCY)
+if command != 'list' and random.random() < FAILURE_RATE:
+    print 'Error: The operation was canceled (benchmark)'
+    sys.exit(1)
+
+vm_list = running_vms()
+if command == 'list':
+    print 'Total running VMs: ' + str(len(vm_list))
+    for vm_path in vm_list:
+        print vm_path
+
+elif command == 'suspend':
+    vmx_path = sys.argv[2]
+    if vmx_path in vm_list:
+        with open(os.path.splitext(vmx_path)[0] + '.vmss', 'wb') as memory_file:
+            memory_file.truncate(MEMORY_SIZE)
+        vm_list.remove(vmx_path)
+        save_running_vms(vm_list)
+
+elif command == 'start':
+    vmx_path = sys.argv[2]
+    if vmx_path not in vm_list:
+        memory_path = os.path.splitext(vmx_path)[0] + '.vmss'
+        if os.path.isfile(memory_path):
+            os.remove(memory_path)
+        vm_list.append(vmx_path)
+        save_running_vms(vm_list)
+'''
+
+
+### FUNCTIONS ###
+## OPTION PARSER ##
+def parse_input_options():
+    """ Parse input options """
+    parser = optparse.OptionParser()
+
+    parser.add_option('--work_dir', dest='work_dir', type='str', default=None,
+                      help='Folder to keep synthetic machines and tapes in, each benchmark gets a new sub folder there '
+                           '(temporary folder by default, removed at the end)')
+    parser.add_option('--runs', dest='runs', type='int', default=1,
+                      help='Number of consecutive backup runs. Machines are changed between runs')
+    parser.add_option('-q', '--quiet', dest='quiet', action='store_true', default=False,
+                      help='Do not print backup log')
+
+    vm_group = optparse.OptionGroup(parser, 'Synthetic Virtual Machines')
+    vm_group.add_option('--vms', dest='vms', type='int', default=4,
+                        help='Number of virtual machines')
+    vm_group.add_option('--running', dest='running', type='float', default=0.5,
+                        help='Share of running machines (0.0 - 1.0)')
+    vm_group.add_option('--vmdk_mb', dest='vmdk_mb', type='int', default=64,
+                        help='Size of each virtual disk file (in MB)')
+    vm_group.add_option('--vmdk_files', dest='vmdk_files', type='int', default=1,
+                        help='Number of virtual disk files (split extents) of each machine')
+    vm_group.add_option('--sparse', dest='sparse', type='float', default=0.0,
+                        help='Share of virtual disk never written to (holes, 0.0 - 1.0)')
+    vm_group.add_option('--small_files', dest='small_files', type='int', default=8,
+                        help='Number of small files (logs, nvram and etc.) of each machine')
+    vm_group.add_option('--memory_mb', dest='memory_mb', type='int', default=16,
+                        help='Memory size of each machine, dumped to the disk on suspend (in MB)')
+    vm_group.add_option('--change', dest='change', type='float', default=0.1,
+                        help='Share of virtual disk rewritten between runs (0.0 - 1.0)')
+    parser.add_option_group(vm_group)
+
+    vmrun_group = optparse.OptionGroup(parser, 'Fake vmrun')
+    vmrun_group.add_option('--latency', dest='latency', type='float', default=0.5,
+                           help='Latency of each vmrun call (in seconds)')
+    vmrun_group.add_option('--failure_rate', dest='failure_rate', type='float', default=0.0,
+                           help='Share of failing vmrun suspend and start calls (0.0 - 1.0)')
+    vmrun_group.add_option('--retry_delay', dest='retry_delay', type='float', default=0.1,
+                           help='Initial delay between polls and retried attempts (in seconds)')
+    parser.add_option_group(vmrun_group)
+
+    backup_group = optparse.OptionGroup(parser, 'Backup Settings')
+    backup_group.add_option('--tapes', dest='tapes', type='int', default=2,
+                            help='Number of tapes (local folders)')
+    backup_group.add_option('-w', '--workers', dest='backup_workers', type='int', default=None,
+                            help='Number of virtual machines backed up at once')
+    backup_group.add_option('--tape_workers', dest='tape_workers', type='int', default=None,
+                            help='Number of backups written to the same tape at once')
+    backup_group.add_option('--file_workers', dest='file_workers', type='int', default=None,
+                            help='Number of files of the same virtual machine copied at once')
+    backup_group.add_option('--copy_buffer', dest='copy_buffer_mb', type='int', default=None,
+                            help='Size of the copy buffer (in MB)')
+    backup_group.add_option('--two_phase', dest='two_phase_copy', action='store_true', default=None,
+                            help='Use two phase copy')
+    # Note: Only checksums and codecs supported by this python installation are offered
+    backup_group.add_option('--checksum', dest='checksum', type='choice', choices=available_checksums(),
+                            default=None, help='Checksum computed while copying (' +
+                                               ', '.join(available_checksums()) + ')')
+    backup_group.add_option('--verify', dest='verify_backup', action='store_true', default=None,
+                            help='Verify backups')
+    backup_group.add_option('-c', '--compression', dest='compression', type='choice', choices=available_codecs(),
+                            default=None, help='Compression codec (' + ', '.join(available_codecs()) + ')')
+    backup_group.add_option('-m', '--mode', dest='backup_mode', type='choice', choices=BACKUP_MODES, default=None,
+                            help='Backup mode')
+    parser.add_option_group(backup_group)
+
+    (options, args) = parser.parse_args()
+
+    return options
+
+
+## SYNTHETIC MACHINES ##
+def write_disk_file(file_path, size, sparse, change=1.0):
+    """ Writes (or rewrites part of) synthetic virtual disk file. Never written parts are left as holes """
+    blocks = size // MEGA_BYTE
+    with open(file_path, 'r+b' if os.path.isfile(file_path) else 'wb') as disk_file:
+        disk_file.truncate(size)
+        for block_index in range(blocks):
+            # Note: Holes are always at the same place, so those stay holes between runs
+            if random.Random(file_path + str(block_index)).random() < sparse:
+                continue
+
+            if random.random() < change:
+                disk_file.seek(block_index * MEGA_BYTE)
+                disk_file.write(os.urandom(MEGA_BYTE))
+
+
+def create_machines(options, vms_path, running_list_path):
+    """ Creates synthetic virtual machines, returns list of *.vmx paths of running machines """
+    running_list = []
+    for vm_index in range(options.vms):
+        vm_name = 'bench_vm' + str(vm_index)
+        vm_path = os.path.join(vms_path, vm_name)
+        file_system.make_dir(vm_path)
+
+        vmx_path = os.path.join(vm_path, vm_name + '.vmx')
+        with open(vmx_path, 'w') as vmx_file:
+            vmx_file.write('displayName = "' + vm_name + '"\nmemsize = "' + str(options.memory_mb) + '"\n')
+
+        for disk_index in range(options.vmdk_files):
+            write_disk_file(os.path.join(vm_path, vm_name + '-s' + str(disk_index + 1).zfill(3) + '.vmdk'),
+                            options.vmdk_mb * MEGA_BYTE, options.sparse)
+
+        for file_index in range(options.small_files):
+            with open(os.path.join(vm_path, 'vmware-' + str(file_index) + '.log'), 'wb') as small_file:
+                small_file.write(os.urandom(random.randint(1024, 64 * 1024)))
+
+        if vm_index < int(round(options.vms * options.running)):
+            running_list.append(vmx_path)
+
+    with open(running_list_path, 'w') as running_file:
+        running_file.write(''.join([vmx_path + '\n' for vmx_path in running_list]))
+
+    return running_list
+
+
+def change_machines(options, vms_path):
+    """ Changes synthetic virtual machines between runs, so those are backed up again """
+    for vm_name in sorted(os.listdir(vms_path)):
+        vm_path = os.path.join(vms_path, vm_name)
+        with open(os.path.join(vm_path, vm_name + '.vmx'), 'a') as vmx_file:
+            vmx_file.write('# changed ' + str(time.time()) + '\n')
+
+        for disk_index in range(options.vmdk_files):
+            write_disk_file(os.path.join(vm_path, vm_name + '-s' + str(disk_index + 1).zfill(3) + '.vmdk'),
+                            options.vmdk_mb * MEGA_BYTE, options.sparse, options.change)
+
+
+def create_fake_vmrun(options, work_dir):
+    """ Creates fake vmrun script, returns its path """
+    vmrun_path = os.path.join(work_dir, 'vmrun')
+    with open(vmrun_path, 'w') as vmrun_file:
+        vmrun_file.write(FAKE_VMRUN_TEMPLATE.format(
+            python=sys.executable,
+            running_list_path=os.path.join(work_dir, RUNNING_LIST_NAME),
+            calls_log_path=os.path.join(work_dir, CALLS_LOG_NAME),
+            latency=options.latency,
+            failure_rate=options.failure_rate,
+            memory_size=options.memory_mb * MEGA_BYTE
+        ))
+    os.chmod(vmrun_path, 0755)
+
+    return vmrun_path
+
+
+def count_vmrun_calls(work_dir):
+    """ Returns number of vmrun calls by command, log is cleared """
+    calls_log_path = os.path.join(work_dir, CALLS_LOG_NAME)
+    calls = collections.Counter()
+    if os.path.isfile(calls_log_path):
+        with open(calls_log_path) as calls_log:
+            calls.update([line.strip() for line in calls_log])
+        os.remove(calls_log_path)
+
+    return calls
+
+
+## BENCHMARK ##
+def benchmark_settings(options, work_dir, run_index):
+    """ Creates backup settings of particular benchmark run """
+    settings = copy.deepcopy(DEFAULT_SETTINGS)
+    settings['vmrun_path'] = os.path.join(work_dir, 'vmrun')
+    settings['vms_path'] = os.path.join(work_dir, 'vms')
+    settings['tape_path'] = os.path.join(work_dir, 'tapes')
+    settings['_backup_ts'] = '-bench' + str(run_index + 1).zfill(3)
+    settings['_catalog_path'] = os.path.join(work_dir, 'backup_catalog.db')
+    settings['_metrics_path'] = os.path.join(work_dir, METRICS_NAME)
+
+    # Note: Backup waits between retried attempts, benchmark does not have to wait that long
+    for operation in OPERATIONS:
+        policy = retry_policy(settings, operation)
+        policy.initial_delay = options.retry_delay
+        policy.max_delay = max(policy.initial_delay, options.retry_delay * RETRY_MAX_DELAY_FACTOR)
+        settings[operation + RETRY_SETTINGS_SUFFIX] = str(policy)
+
+    for settings_key in settings.keys():
+        option_value = getattr(options, settings_key, None)
+        if option_value is not None:
+            settings[settings_key] = option_value
+
+    return settings
+
+
+def report(run_index, wall_time, metrics, calls):
+    """ Prints results of particular benchmark run """
+    run = metrics['run']
+    vms = metrics['vms']
+
+    print '*** Benchmark Run #' + str(run_index + 1) + ' ***'
+    print '{0:<25} {1:>12} {2:>12} {3:>10} {4:>10} {5:>12} {6}'.format(
+        'name', 'copied', 'written', 'copy', 'suspended', 'throughput', 'status')
+    for vm_name, vm in vms.items():
+        print '{0:<25} {1:>12} {2:>12} {3:>10} {4:>10} {5:>12} {6}'.format(
+            vm_name, file_system.print_memory_size(vm['bytes_copied']),
+            file_system.print_memory_size(vm['bytes_written']), '%.2fs' % vm['copy_duration'],
+            '%.2fs' % vm['suspend_window'], file_system.print_memory_size(vm['throughput']) + '/s', vm['status'])
+
+    suspend_windows = [vm['suspend_window'] for vm in vms.values() if vm['suspend_window']]
+    print 'Wall time: %.2fs' % wall_time
+    print 'Copied: ' + file_system.print_memory_size(run['bytes_copied']) + ' (' + \
+          file_system.print_memory_size(run['bytes_copied'] / wall_time) + '/s), written: ' + \
+          file_system.print_memory_size(run['bytes_written'])
+    if len(suspend_windows):
+        print 'Suspend window: max %.2fs, mean %.2fs' % (max(suspend_windows),
+                                                         sum(suspend_windows) / len(suspend_windows))
+    print 'vmrun calls: ' + str(sum(calls.values())) + ' (' + \
+          ', '.join([command + ': ' + str(count) for command, count in sorted(calls.items())]) + ')'
+    print 'Retries: ' + str(sum([sum(vm['retries'].values()) for vm in vms.values()]))
+    print 'Directory scans: ' + str(run['directory_scans'])
+
+
+def run_benchmark(options):
+    """ Runs benchmark, returns list of metrics of each run """
+    remove_work_dir = options.work_dir is None
+    if not remove_work_dir:
+        # Note: Fresh sub folder, so nothing the user keeps in the work folder is touched
+        file_system.make_dir(options.work_dir)
+    work_dir = tempfile.mkdtemp(prefix='vmware_backup_benchmark_', dir=options.work_dir)
+
+    metrics_list = []
+    try:
+        print '*** Creating Synthetic Virtual Machines ***'
+        for tape_index in range(options.tapes):
+            file_system.make_dir(os.path.join(work_dir, 'tapes', 'tape' + str(tape_index)))
+        create_fake_vmrun(options, work_dir)
+        create_machines(options, os.path.join(work_dir, 'vms'), os.path.join(work_dir, RUNNING_LIST_NAME))
+        print 'Work folder: ' + work_dir
+
+        for run_index in range(options.runs):
+            if run_index:
+                change_machines(options, os.path.join(work_dir, 'vms'))
+
+            settings = benchmark_settings(options, work_dir, run_index)
+            count_vmrun_calls(work_dir)
+
+            stdout = sys.stdout
+            if options.quiet:
+                sys.stdout = open(os.devnull, 'w')
+
+            start_time = time.time()
+            try:
+                execute_backup(settings)
+            finally:
+                wall_time = time.time() - start_time
+                if options.quiet:
+                    sys.stdout.close()
+                    sys.stdout = stdout
+
+            with open(settings['_metrics_path']) as metrics_file:
+                metrics = json.load(metrics_file, object_pairs_hook=collections.OrderedDict)
+
+            report(run_index, wall_time, metrics, count_vmrun_calls(work_dir))
+            metrics_list.append(metrics)
+
+    finally:
+        if remove_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return metrics_list
+
+
+### MAIN ###
+if __name__ == '__main__':
+    run_benchmark(parse_input_options())
@@ -0,0 +1,4 @@
+"""
+VMWare Backup Tests
+Run with "python -m unittest discover tests" from the repository root
+"""
@@ -0,0 +1,92 @@
+"""
+Backup Journal Tests
+Files changed while those are being copied must not be recorded as completed, final pass of two phase copy has to
+bring those up to date
+"""
+
+
+### INCLUDES ###
+import os
+import sys
+import copy
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vmware_backup import DEFAULT_SETTINGS
+from vmware_backup.copy_engine import CopyEngine, MEGA_BYTE
+from vmware_backup.journal import BackupJournal
+
+
+### CONSTANTS ###
+FILE_NAMES = ('test.nvram', 'test.vmdk')
+FILE_SIZE = 3 * MEGA_BYTE
+
+
+### CLASSES ###
+class ChangingLimiter(object):
+    """ Stands in for bandwidth limiter, changes beginning of the source files every time part of those has been
+    read (machine writes to its files while those are being copied) """
+    def __init__(self, source_path, active=True):
+        self.source_path = source_path
+        self.active = active
+        self.changes = 0
+
+    def read(self, bytes_read):
+        if self.active:
+            self.changes += 1
+            for file_name in FILE_NAMES:
+                with open(os.path.join(self.source_path, file_name), 'r+b') as source_file:
+                    source_file.write(b'change #' + str(self.changes))
+
+    def write(self, bytes_written):
+        pass
+
+
+class TwoPhaseJournalTest(unittest.TestCase):
+    """ Two Phase Journal Test class """
+    def setUp(self):
+        self.temp_path = tempfile.mkdtemp()
+        self.source_path = os.path.join(self.temp_path, 'vm')
+        self.destination_path = os.path.join(self.temp_path, 'backup')
+        os.makedirs(self.source_path)
+        for file_name in FILE_NAMES:
+            with open(os.path.join(self.source_path, file_name), 'wb') as source_file:
+                source_file.write(os.urandom(FILE_SIZE))
+
+        settings = copy.deepcopy(DEFAULT_SETTINGS)
+        settings.update(copy_buffer_mb=1, checkpoint_mb=1, file_workers=1, pipeline_copy=False)
+        self.copy_engine = CopyEngine(settings)
+
+    def tearDown(self):
+        self.copy_engine.close()
+        shutil.rmtree(self.temp_path, ignore_errors=True)
+
+    def _read(self, path, file_name):
+        with open(os.path.join(path, file_name), 'rb') as test_file:
+            return test_file.read()
+
+    def test_file_changed_during_pre_copy(self):
+        """ File changed during the pre-copy is not journaled as completed and final copy matches the source """
+        journal = BackupJournal(self.source_path, self.destination_path)
+        self.copy_engine.journal = journal
+        self.copy_engine.track_blocks = True
+
+        # Pre-copy, files change while those are being copied
+        self.copy_engine.limiter = ChangingLimiter(self.source_path)
+        self.copy_engine.copy_dir(self.source_path, self.destination_path)
+        for file_name in FILE_NAMES:
+            self.assertIsNone(journal.completed(os.path.join(self.source_path, file_name)))
+            self.assertNotEqual(self._read(self.source_path, file_name), self._read(self.destination_path, file_name))
+
+        # Final pass
+        self.copy_engine.limiter = ChangingLimiter(self.source_path, False)
+        self.copy_engine.sync_dir(self.source_path, self.destination_path)
+        for file_name in FILE_NAMES:
+            self.assertEqual(self._read(self.source_path, file_name), self._read(self.destination_path, file_name))
+
+
+if __name__ == '__main__':
+    unittest.main()
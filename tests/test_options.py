@@ -0,0 +1,58 @@
+"""
+Command Line Options Tests
+Options given with zero or empty values have to replace saved settings (those are not the same as missing options)
+"""
+
+
+### INCLUDES ###
+import os
+import sys
+import copy
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import run_backup
+from vmware_backup import DEFAULT_SETTINGS
+
+
+### CLASSES ###
+class OptionPresenceTest(unittest.TestCase):
+    """ Option Presence Test class """
+    def setUp(self):
+        self.settings = copy.deepcopy(DEFAULT_SETTINGS)
+        self.settings.update(read_limit_mb=50, write_limit_mb=50, limit_hours='8-18', keep_last=5,
+                             prometheus_file='/tmp/vmware_backup.prom')
+
+    def _validate(self, arguments):
+        """ Parses command line arguments and applies those to the settings """
+        saved_argv = sys.argv
+        sys.argv = ['run_backup.py'] + arguments
+        try:
+            input_options = run_backup.parse_input_options(False)
+        finally:
+            sys.argv = saved_argv
+
+        return run_backup.validate_settings(self.settings, input_options)
+
+    def test_zero_and_empty_values(self):
+        """ Zero limits, empty limit hours, disabled retention rule and disabled Prometheus file are applied """
+        self.assertTrue(self._validate(['--read_limit', '0', '--write_limit', '0', '--limit_hours', '',
+                                        '--keep_last', '0', '--prometheus', '']))
+        self.assertEqual(self.settings['read_limit_mb'], 0)
+        self.assertEqual(self.settings['write_limit_mb'], 0)
+        self.assertEqual(self.settings['limit_hours'], '')
+        self.assertEqual(self.settings['keep_last'], 0)
+        self.assertEqual(self.settings['prometheus_file'], '')
+
+    def test_missing_options(self):
+        """ Options that have not been given leave saved settings as they are """
+        self.assertFalse(self._validate([]))
+        self.assertEqual(self.settings['read_limit_mb'], 50)
+        self.assertEqual(self.settings['limit_hours'], '8-18')
+        self.assertEqual(self.settings['keep_last'], 5)
+        self.assertEqual(self.settings['prometheus_file'], '/tmp/vmware_backup.prom')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+"""
+Backup Planner Tests
+Virtual machines have to be spread across the tapes that have enough space for them
+"""
+
+
+### INCLUDES ###
+import os
+import sys
+import copy
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vmware_backup import DEFAULT_SETTINGS
+from vmware_backup.default_settings import MUTLIPLE_TAPE_SYSTEM
+from vmware_backup.planner import BackupPlanner
+from vmware_backup.tapes import TapeLedger
+
+
+### CONSTANTS ###
+TAPE_NAMES = ('tape0', 'tape1')
+VM_SIZES = (4000, 3000, 2000, 1000)
+
+
+### CLASSES ###
+class PlannedMachine(object):
+    """ Stands in for virtual machine, planner only needs its name and size """
+    def __init__(self, name, space_estimate):
+        self.name = name
+        self.space_estimate = space_estimate
+        self.planned_tape = None
+
+
+@unittest.skipUnless(MUTLIPLE_TAPE_SYSTEM, 'Multiple tapes are not supported on this system')
+class BackupPlannerTest(unittest.TestCase):
+    """ Tape assignment of the planned virtual machines """
+    def setUp(self):
+        self.tape_path = tempfile.mkdtemp()
+        for tape_name in TAPE_NAMES:
+            os.mkdir(os.path.join(self.tape_path, tape_name))
+
+        settings = copy.deepcopy(DEFAULT_SETTINGS)
+        settings['tape_path'] = self.tape_path
+        self.ledger = TapeLedger(settings)
+        self.planner = BackupPlanner(self.ledger)
+        self.vm_list = [PlannedMachine('vm' + str(index), vm_size) for index, vm_size in enumerate(VM_SIZES)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tape_path, ignore_errors=True)
+
+    def test_spread_across_tapes(self):
+        unplaced_list = self.planner.assign(self.vm_list)
+
+        self.assertEqual(unplaced_list, [])
+        planned_tapes = [virtual_machine.planned_tape for virtual_machine in self.vm_list]
+        self.assertEqual(set(planned_tapes), set(self.ledger.tape_list()))
+        for tape in self.ledger.tape_list():
+            self.assertEqual(self.ledger.space_reserved(tape), sum(VM_SIZES) / len(TAPE_NAMES))
+
+    def test_full_tape_skipped(self):
+        full_tape = self.ledger.tape_list()[0]
+        self.ledger.reserve(full_tape, self.ledger.space_available(full_tape))
+        unplaced_list = self.planner.assign(self.vm_list)
+
+        self.assertEqual(unplaced_list, [])
+        for virtual_machine in self.vm_list:
+            self.assertEqual(virtual_machine.planned_tape, self.ledger.tape_list()[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
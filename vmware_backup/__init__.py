@@ -18,9 +18,12 @@ http://www.jejik.com/articles/2007/02/a_simple_unix_linux_daemon_in_python/
 
 
 ### EXTERNAL INCLUDES ###
-from .default_settings import DEFAULT_SETTINGS, FOLDER_TS_FORMAT, MUTLIPLE_TAPE_SYSTEM
-from .virtual_machine import VirtualMachine, execute_backup
+from .default_settings import DEFAULT_SETTINGS, FOLDER_TS_FORMAT, MUTLIPLE_TAPE_SYSTEM, BACKUP_MODES
+from .virtual_machine import VirtualMachine, execute_backup, execute_plan
 from .cron import enable_backup, disable_backup
+from .catalog import BackupCatalog
+from .restore import execute_restore
+from .daemon import execute_daemon, daemon_command
 
 
 ### CONSTANTS ###
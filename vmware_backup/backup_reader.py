@@ -0,0 +1,170 @@
+"""
+Backup Reader Class
+Reads original content of the backed up files from the tapes, no matter how those have been stored (full copy,
+compressed copy, incremental blocks or chunks)
+"""
+
+
+### INCLUDES ###
+import os
+import io
+import errno
+
+from .copy_engine import FILE_LIST_NAME, FILE_LIST_VERSION, FILE_LIST_CHECKSUM, load_manifest
+from .compression import decompress
+from .incremental import MANIFEST_NAME, tape_absolute_path
+from .chunk_store import RECIPE_NAME
+from .scanner import scan_dir
+from .checksum import new_hasher
+
+
+### FUNCTIONS ###
+def _load_optional(manifest_path):
+    """ Loads manifest if backup folder has one """
+    if os.path.isfile(manifest_path):
+        return load_manifest(manifest_path)
+
+    return None
+
+
+def _load_file_list(backup_path):
+    """ Loads file list of particular backup. Backups made before file lists were introduced are plain copies """
+    file_list_path = os.path.join(backup_path, FILE_LIST_NAME)
+    if os.path.isfile(file_list_path):
+        return load_manifest(file_list_path)
+
+    file_list = {'version': FILE_LIST_VERSION, FILE_LIST_CHECKSUM: None, 'files': {}}
+    for scan_entry in scan_dir(backup_path):
+        relative_path = os.path.relpath(scan_entry.path, backup_path)
+        file_list['files'][relative_path] = {'path': relative_path, 'codec': None, 'size': scan_entry.size}
+
+    return file_list
+
+
+### CLASSES ###
+class BackupReader(object):
+    """ Backup Reader class """
+    def __init__(self, settings, backup_path, chunk_store, buffer_size):
+        self.settings = settings
+        self.backup_path = backup_path
+        self.chunk_store = chunk_store
+        self.buffer_size = buffer_size
+
+        self.file_list = _load_file_list(backup_path)
+        self.manifest = _load_optional(os.path.join(backup_path, MANIFEST_NAME))
+        self.recipe = _load_optional(os.path.join(backup_path, RECIPE_NAME))
+        self.checksum = self.file_list.get(FILE_LIST_CHECKSUM)
+
+    ## Internal Methods ##
+    def _read_file(self, file_path, start=0, length=None):
+        """ Reads particular part of the file from the tape """
+        with io.open(file_path, 'rb', buffering=0) as backup_file:
+            backup_file.seek(start)
+            while length is None or length > 0:
+                read_size = self.buffer_size
+                if length is not None:
+                    read_size = min(read_size, length)
+
+                data = backup_file.read(read_size)
+                if not data:
+                    if length is not None:
+                        raise IOError(errno.EIO, 'Unexpected end of file "' + file_path + '"')
+                    break
+
+                if length is not None:
+                    length -= len(data)
+                yield data
+
+    def _read_blocks(self, entry):
+        """ Reads file stored as incremental blocks """
+        block_size = self.manifest['block_size']
+        sources = self.manifest['sources']
+
+        bytes_left = entry['size']
+        for block_hash, source_index, offset in entry['blocks']:
+            block_length = min(block_size, bytes_left)
+            source_path = tape_absolute_path(self.settings, sources[source_index])
+            for data in self._read_file(source_path, offset, block_length):
+                yield data
+
+            bytes_left -= block_length
+
+    def _read_chunks(self, entry):
+        """ Reads file stored as chunks of the chunk store """
+        for chunk_hash in entry['chunks']:
+            chunk_path = self.chunk_store.locate(chunk_hash)
+            if chunk_path is None:
+                raise IOError(errno.ENOENT, 'Chunk "' + chunk_hash + '" is missing')
+
+            for data in self._read_file(chunk_path):
+                yield data
+
+    def _read_compressed(self, file_path, codec):
+        """ Reads and decompresses compressed file """
+        with io.open(file_path, 'rb') as backup_file:
+            for data in decompress(backup_file, codec, self.buffer_size):
+                yield data
+
+    ## External Methods ##
+    def files(self):
+        """ Returns relative paths of all files of this backup """
+        return sorted(self.file_list['files'].keys())
+
+    def size(self, relative_path):
+        """ Returns original size of particular file """
+        return self.file_list['files'][relative_path]['size']
+
+    def backup_file(self, relative_path):
+        """ Returns path of the copy of particular file in the backup folder, None if file is stored as incremental
+        blocks or chunks """
+        for manifest in (self.manifest, self.recipe):
+            if manifest is not None and relative_path in manifest['files']:
+                return None
+
+        return os.path.join(self.backup_path, self.file_list['files'][relative_path]['path'])
+
+    def mtime(self, relative_path):
+        """ Returns original modification time of particular file (None if it has not been recorded) """
+        for manifest in (self.manifest, self.recipe):
+            if manifest is not None and relative_path in manifest['files']:
+                return manifest['files'][relative_path].get('mtime')
+
+        # Note: Copy got modification time of the original file
+        return os.path.getmtime(self.backup_file(relative_path))
+
+    def read(self, relative_path):
+        """ Reads original content of particular file, yields data """
+        if self.manifest is not None and relative_path in self.manifest['files']:
+            return self._read_blocks(self.manifest['files'][relative_path])
+
+        if self.recipe is not None and relative_path in self.recipe['files']:
+            return self._read_chunks(self.recipe['files'][relative_path])
+
+        entry = self.file_list['files'][relative_path]
+        backup_file_path = os.path.join(self.backup_path, entry['path'])
+        if entry['codec'] is not None:
+            return self._read_compressed(backup_file_path, entry['codec'])
+
+        return self._read_file(backup_file_path)
+
+    def verify(self, relative_path, data_func=None):
+        """ Reads particular file and compares it against its checksum and size.
+        Returns error message, None if file is intact """
+        entry = self.file_list['files'][relative_path]
+        hasher = new_hasher(self.checksum)
+
+        size = 0
+        for data in self.read(relative_path):
+            size += len(data)
+            if hasher is not None:
+                hasher.update(data)
+            if data_func is not None:
+                data_func(data)
+
+        if size != entry['size']:
+            return 'size mismatch ({0} instead of {1} bytes)'.format(size, entry['size'])
+
+        if hasher is not None and entry.get('checksum') is not None and hasher.hexdigest() != entry['checksum']:
+            return 'checksum mismatch'
+
+        return None
@@ -0,0 +1,168 @@
+"""
+Backup Catalog Class
+Keeps persistent index of backups, so finding out if virtual machine is backed up already does not require scanning
+the tapes. Catalog is updated as each backup completes and could be rebuilt from the tapes at any time.
+"""
+
+
+### INCLUDES ###
+import os
+import glob
+import time
+import sqlite3
+import hashlib
+import threading
+
+from .tapes import fetch_tape_list, fetch_tape
+from .journal import incomplete_backup
+
+
+### CONSTANTS ###
+## Catalog Schema ##
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS backups (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    vm_name TEXT NOT NULL,
+    backup_path TEXT NOT NULL UNIQUE,
+    tape TEXT NOT NULL,
+    backup_ts TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS vmx_files (
+    backup_id INTEGER NOT NULL REFERENCES backups(id) ON DELETE CASCADE,
+    file_name TEXT NOT NULL,
+    fingerprint TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS backups_vm_name ON backups (vm_name);
+CREATE INDEX IF NOT EXISTS vmx_files_fingerprint ON vmx_files (fingerprint);
+CREATE INDEX IF NOT EXISTS vmx_files_backup_id ON vmx_files (backup_id);
+"""
+
+
+### FUNCTIONS ###
+def vmx_fingerprint(vmx_path):
+    """ Returns fingerprint of the *.vmx file (hash of its content) """
+    with open(vmx_path, 'rb') as vmx_file:
+        return hashlib.sha256(vmx_file.read()).hexdigest()
+
+
+def vmx_fingerprints(vm_path, vmx_paths=None):
+    """ Returns fingerprints of all *.vmx files under particular folder (or particular *.vmx files) """
+    if vmx_paths is None:
+        vmx_paths = glob.glob(os.path.join(vm_path, '*.vmx'))
+
+    fingerprints = {}
+    for vmx_path in vmx_paths:
+        fingerprints[os.path.basename(vmx_path)] = vmx_fingerprint(vmx_path)
+
+    return fingerprints
+
+
+### CLASSES ###
+class BackupCatalog(object):
+    """ Backup Catalog class. Single instance is shared by all of the virtual machines of the backup run """
+    def __init__(self, settings, catalog_path):
+        self.settings = settings
+        self.catalog_path = catalog_path
+        self.lock = threading.Lock()
+
+        self._connection = sqlite3.connect(catalog_path, check_same_thread=False)
+        self._connection.execute('PRAGMA foreign_keys = ON')
+        self._connection.executescript(CATALOG_SCHEMA)
+
+    ## Internal Methods ##
+    def _record(self, vm_name, backup_path, backup_ts, created, fingerprints):
+        """ Records single backup (without committing) """
+        tape = fetch_tape(self.settings, backup_path)
+        self._connection.execute('DELETE FROM backups WHERE backup_path = ?', (backup_path,))
+        cursor = self._connection.execute(
+            'INSERT INTO backups (vm_name, backup_path, tape, backup_ts, created) VALUES (?, ?, ?, ?, ?)',
+            (vm_name, backup_path, tape, backup_ts, created))
+
+        backup_id = cursor.lastrowid
+        self._connection.executemany(
+            'INSERT INTO vmx_files (backup_id, file_name, fingerprint) VALUES (?, ?, ?)',
+            [(backup_id, file_name, fingerprint) for file_name, fingerprint in fingerprints.items()])
+
+    ## External Methods ##
+    def empty(self):
+        """ Tells if catalog does not have any backups """
+        with self.lock:
+            return self._connection.execute('SELECT COUNT(*) FROM backups').fetchone()[0] == 0
+
+    def record(self, vm_name, backup_path):
+        """ Records completed backup """
+        fingerprints = vmx_fingerprints(backup_path)
+        with self.lock:
+            with self._connection:
+                self._record(vm_name, backup_path, self.settings['_backup_ts'], time.time(), fingerprints)
+
+    def forget(self, backup_path):
+        """ Removes backup from the catalog """
+        with self.lock:
+            with self._connection:
+                self._connection.execute('DELETE FROM backups WHERE backup_path = ?', (backup_path,))
+
+    def find(self, vm_name, fingerprints):
+        """ Returns path of the latest backup that has one of the *.vmx files, None if there is no such backup """
+        if not len(fingerprints):
+            return None
+
+        query = ('SELECT DISTINCT backups.backup_path FROM backups '
+                 'JOIN vmx_files ON vmx_files.backup_id = backups.id '
+                 'WHERE backups.vm_name = ? AND vmx_files.fingerprint IN (' +
+                 ', '.join(['?'] * len(fingerprints)) + ') ORDER BY backups.created DESC')
+
+        with self.lock:
+            backup_paths = [row[0] for row in self._connection.execute(query, [vm_name] + list(fingerprints))]
+
+        for backup_path in backup_paths:
+            if os.path.isdir(backup_path):
+                return backup_path
+
+            # Tapes have been reformatted or backup has been removed by hand
+            self.forget(backup_path)
+
+        return None
+
+    def backups(self, vm_name=None):
+        """ Returns list of backups (as dictionaries), latest backups first """
+        query = 'SELECT vm_name, backup_path, tape, backup_ts, created FROM backups'
+        parameters = ()
+        if vm_name is not None:
+            query += ' WHERE vm_name = ?'
+            parameters = (vm_name,)
+        query += ' ORDER BY created DESC'
+
+        keys = ('vm_name', 'backup_path', 'tape', 'backup_ts', 'created')
+        with self.lock:
+            return [dict(zip(keys, row)) for row in self._connection.execute(query, parameters)]
+
+    def rebuild(self, print_func=None):
+        """ Rebuilds catalog by scanning all of the tapes, returns number of backups found """
+        vm_base_name = os.path.basename(self.settings['vms_path'])
+
+        backup_list = []
+        for tape in fetch_tape_list(self.settings):
+            for base_backup_path in glob.glob(os.path.join(tape, vm_base_name + '*')):
+                backup_ts = os.path.basename(base_backup_path)[len(vm_base_name):]
+                for backup_path in glob.glob(os.path.join(base_backup_path, '*')):
+                    if os.path.isdir(backup_path) and not incomplete_backup(backup_path):
+                        backup_list.append((os.path.basename(backup_path), backup_path, backup_ts,
+                                            os.path.getmtime(backup_path), vmx_fingerprints(backup_path)))
+
+        with self.lock:
+            with self._connection:
+                self._connection.execute('DELETE FROM backups')
+                for backup in backup_list:
+                    self._record(*backup)
+
+        if print_func is not None:
+            print_func('Backup catalog is rebuilt! Backups found: ' + str(len(backup_list)))
+
+        return len(backup_list)
+
+    def close(self):
+        """ Closes catalog database """
+        with self.lock:
+            self._connection.close()
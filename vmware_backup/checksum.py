@@ -0,0 +1,45 @@
+"""
+Checksum Functions
+Strong hashes of the backed up files, computed in the same pass that copies the data
+"""
+
+
+### INCLUDES ###
+import hashlib
+
+try:
+    BLAKE2B = hashlib.blake2b
+except AttributeError:
+    try:
+        # Python 2 needs pyblake2 package
+        from pyblake2 import blake2b as BLAKE2B
+    except ImportError:
+        BLAKE2B = None
+
+
+### CONSTANTS ###
+## Checksum Names ##
+CHECKSUM_NONE = 'none'
+CHECKSUM_SHA256 = 'sha256'
+CHECKSUM_BLAKE2B = 'blake2b'
+CHECKSUM_NAMES = (CHECKSUM_NONE, CHECKSUM_SHA256, CHECKSUM_BLAKE2B)
+
+
+### FUNCTIONS ###
+def available_checksums():
+    """ Returns names of the checksums that could be used on this system """
+    checksums = [CHECKSUM_NONE, CHECKSUM_SHA256]
+    if BLAKE2B is not None:
+        checksums.append(CHECKSUM_BLAKE2B)
+
+    return checksums
+
+
+def new_hasher(checksum):
+    """ Returns new hash object for particular checksum, None if checksums are disabled """
+    if checksum == CHECKSUM_SHA256:
+        return hashlib.sha256()
+    elif checksum == CHECKSUM_BLAKE2B:
+        return BLAKE2B()
+
+    return None
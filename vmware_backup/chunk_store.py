@@ -0,0 +1,253 @@
+"""
+Chunk Store Class
+Content addressed storage that keeps each unique chunk of virtual disk data once across all tapes
+
+Virtual disk files are split into fixed size chunks. Each chunk is stored under its hash in the chunk folder of a
+tape. Backup folder gets a recipe that lists chunks of each virtual disk file in order. Machines cloned from the same
+template and consecutive backups of the same machine share most of their chunks. Chunks are collected once none of
+the recipes refers to them anymore.
+"""
+
+
+### INCLUDES ###
+import os
+import io
+import time
+import hashlib
+import threading
+
+from py_knife import file_system
+
+from .copy_engine import CopyStats, MEGA_BYTE, write_all, disk_file, load_manifest, save_manifest
+from .tapes import fetch_tape_list, fetch_tape
+from .scanner import scan_dir, destination_list
+
+
+### CONSTANTS ###
+## Chunk Store Constants ##
+CHUNK_DIR_NAME = 'chunks'
+CHUNK_TEMP_EXTENSION = '.tmp'
+RECIPE_NAME = 'backup_recipe.json'
+RECIPE_VERSION = 1
+
+## Copy Methods ##
+METHOD_CHUNKED = 'chunked'
+
+
+### FUNCTIONS ###
+def chunk_path(tape, chunk_hash):
+    """ Returns path of particular chunk on particular tape """
+    return os.path.join(tape, CHUNK_DIR_NAME, chunk_hash[:2], chunk_hash)
+
+
+def recipe_chunks(backup_path):
+    """ Returns hashes of the chunks particular (chunked) backup refers to """
+    recipe_path = os.path.join(backup_path, RECIPE_NAME)
+    if not os.path.isfile(recipe_path):
+        return set()
+
+    try:
+        recipe = load_manifest(recipe_path)
+    except (IOError, OSError, ValueError):
+        return set()
+
+    return set([chunk_hash for entry in recipe.get('files', {}).values() for chunk_hash in entry.get('chunks', [])])
+
+
+### CLASSES ###
+class ChunkStore(object):
+    """ Chunk Store class. Single instance is shared by all of the virtual machines of the backup run """
+    def __init__(self, settings):
+        self.settings = settings
+        self.chunk_size = max(1, int(settings['chunk_size_mb'])) * MEGA_BYTE
+        self.lock = threading.Lock()
+
+        self._index = None
+        self._pending = set()
+        # Chunks referred to by the backups of the current run (their recipes might not be saved yet)
+        self._used = set()
+
+    ## Index Methods ##
+    def _load_index(self):
+        """ Reads chunk folders of all tapes, maps chunk hash to the tape that has it """
+        index = {}
+        for tape in fetch_tape_list(self.settings):
+            chunk_root = os.path.join(tape, CHUNK_DIR_NAME)
+            if not os.path.isdir(chunk_root):
+                continue
+
+            for prefix in os.listdir(chunk_root):
+                prefix_path = os.path.join(chunk_root, prefix)
+                if not os.path.isdir(prefix_path):
+                    continue
+
+                for chunk_hash in os.listdir(prefix_path):
+                    if not chunk_hash.endswith(CHUNK_TEMP_EXTENSION):
+                        index.setdefault(chunk_hash, tape)
+
+        return index
+
+    def _fetch_index(self):
+        """ Returns chunk index, loads it on first use """
+        with self.lock:
+            if self._index is None:
+                self._index = self._load_index()
+
+            return self._index
+
+    def reset(self):
+        """ Forgets chunk index of the previous backup run, chunk folders are read again on next use """
+        with self.lock:
+            self.chunk_size = max(1, int(self.settings['chunk_size_mb'])) * MEGA_BYTE
+            self._index = None
+            self._used.clear()
+
+    def locate(self, chunk_hash):
+        """ Returns path of particular chunk or None if there is no such chunk """
+        tape = self._fetch_index().get(chunk_hash)
+        if tape is not None:
+            return chunk_path(tape, chunk_hash)
+
+        return None
+
+    def _claim(self, chunk_hash):
+        """ Tells if caller should write particular chunk (not stored yet and nobody else is writing it) """
+        index = self._fetch_index()
+        with self.lock:
+            self._used.add(chunk_hash)
+            if chunk_hash in index or chunk_hash in self._pending:
+                return False
+
+            self._pending.add(chunk_hash)
+            return True
+
+    def _put(self, tape, chunk_hash, chunk_view):
+        """ Writes chunk to particular tape, returns number of bytes written """
+        if not self._claim(chunk_hash):
+            return 0
+
+        try:
+            destination_path = chunk_path(tape, chunk_hash)
+            file_system.make_dir(os.path.dirname(destination_path))
+
+            # Note: Chunk shows up under its hash only once it is completely written
+            temp_path = destination_path + CHUNK_TEMP_EXTENSION
+            with io.open(temp_path, 'wb', buffering=0) as chunk_file:
+                write_all(chunk_file, chunk_view)
+            os.rename(temp_path, destination_path)
+
+            with self.lock:
+                self._index[chunk_hash] = tape
+
+        finally:
+            with self.lock:
+                self._pending.discard(chunk_hash)
+
+        return len(chunk_view)
+
+    def used(self, chunk_hash):
+        """ Tells if particular chunk is referred to by any of the backups of the current run """
+        with self.lock:
+            return chunk_hash in self._used or chunk_hash in self._pending
+
+    def collect(self, chunk_hashes):
+        """ Removes chunks (that are not used by the current run) from all tapes, returns bytes freed per tape """
+        bytes_freed = {}
+        tape_list = fetch_tape_list(self.settings)
+        # Note: Chunk could not be claimed (and written again) while it is being removed
+        with self.lock:
+            for chunk_hash in chunk_hashes:
+                if chunk_hash in self._used or chunk_hash in self._pending:
+                    continue
+
+                for tape in tape_list:
+                    destination_path = chunk_path(tape, chunk_hash)
+                    try:
+                        chunk_size = os.path.getsize(destination_path)
+                        os.remove(destination_path)
+                    except OSError:
+                        continue
+
+                    bytes_freed[tape] = bytes_freed.get(tape, 0) + chunk_size
+
+                if self._index is not None:
+                    self._index.pop(chunk_hash, None)
+
+        return bytes_freed
+
+    ## Backup Methods ##
+    def _backup_file(self, tape, source_path, destination_path, print_func, hasher=None, limiter=None):
+        """ Splits file into chunks, stores chunks that are not in the store yet """
+        stats = CopyStats(source_path, destination_path)
+        stats.method = METHOD_CHUNKED
+        start_time = time.time()
+
+        chunk_buffer = bytearray(self.chunk_size)
+        chunk_buffer_view = memoryview(chunk_buffer)
+
+        chunks = []
+        chunks_written = 0
+        with io.open(source_path, 'rb', buffering=0) as source_file:
+            while True:
+                bytes_read = source_file.readinto(chunk_buffer)
+                if not bytes_read:
+                    break
+
+                chunk_view = chunk_buffer_view[:bytes_read]
+                chunk_hash = hashlib.sha256(chunk_view).hexdigest()
+                chunks.append(chunk_hash)
+                if hasher is not None:
+                    hasher.update(chunk_view)
+                stats.bytes_copied += bytes_read
+                if limiter is not None:
+                    limiter.read(bytes_read)
+
+                bytes_written = self._put(tape, chunk_hash, chunk_view)
+                if bytes_written:
+                    if limiter is not None:
+                        limiter.write(bytes_written)
+                    stats.bytes_written += bytes_written
+                    chunks_written += 1
+
+        stats.duration = time.time() - start_time
+        if hasher is not None:
+            stats.checksum = hasher.hexdigest()
+
+        source_stat = os.stat(source_path)
+        entry = {'size': source_stat.st_size, 'mtime': source_stat.st_mtime, 'chunks': chunks}
+
+        if print_func is not None:
+            print_func(str(stats) + ', ' + str(chunks_written) + ' of ' + str(len(chunks)) + ' chunks written')
+
+        return entry, stats
+
+    def backup_dir(self, source_path, destination_path, copy_engine, print_func=None, scan_entries=None):
+        """ Backs up directory content to the chunk store, returns list of copy statistics """
+        tape = fetch_tape(self.settings, destination_path)
+        recipe = {
+            'version': RECIPE_VERSION,
+            'chunk_size': self.chunk_size,
+            'files': {}
+        }
+
+        def backup_file(source_file, destination_file):
+            if not disk_file(source_file):
+                return copy_engine.copy_file(source_file, destination_file)
+
+            entry, stats = self._backup_file(tape, source_file, destination_file, print_func,
+                                             copy_engine.new_hasher(), copy_engine.limiter)
+            recipe['files'][os.path.relpath(source_file, source_path)] = entry
+            return stats
+
+        if scan_entries is None:
+            scan_entries = list(scan_dir(source_path))
+
+        file_list = destination_list(source_path, destination_path, scan_entries)
+        file_system.make_dir(destination_path)
+
+        # Note: Several files might be split into chunks at once
+        stats_list = copy_engine.map_files(backup_file, file_list, [scan_entry.size for scan_entry in scan_entries])
+
+        save_manifest(os.path.join(destination_path, RECIPE_NAME), recipe)
+
+        return stats_list
@@ -0,0 +1,210 @@
+"""
+Compression Functions and Classes
+Compresses virtual machine files in parallel, one independent block at a time
+
+Each block is compressed into a separate stream (gzip member, bz2 stream, xz stream or zstd frame) and streams are
+written out in order. Concatenation of such streams is still a valid compressed file, so regular command line tools
+(gunzip, bunzip2, unxz, unzstd) are able to decompress backups as well.
+"""
+
+
+### INCLUDES ###
+import bz2
+import zlib
+import time
+import threading
+import collections
+
+from multiprocessing.pool import ThreadPool
+
+try:
+    import lzma
+except ImportError:
+    try:
+        # Python 2 needs backports.lzma package
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+### CONSTANTS ###
+## Codec Names ##
+CODEC_NONE = 'none'
+CODEC_GZIP = 'gzip'
+CODEC_BZ2 = 'bz2'
+CODEC_LZMA = 'lzma'
+CODEC_ZSTD = 'zstd'
+CODEC_NAMES = (CODEC_NONE, CODEC_GZIP, CODEC_BZ2, CODEC_LZMA, CODEC_ZSTD)
+
+## Compressed File Extensions ##
+CODEC_EXTENSIONS = {
+    CODEC_GZIP: '.gz',
+    CODEC_BZ2: '.bz2',
+    CODEC_LZMA: '.xz',
+    CODEC_ZSTD: '.zst'
+}
+
+# Those files are compared during backup detection, so they have to stay as is
+UNCOMPRESSED_EXTENSIONS = ('.vmx',)
+
+# Gzip header and trailer for zlib
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+### FUNCTIONS ###
+## Block Compressors ##
+def _compress_gzip(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _compress_bz2(data, level):
+    return bz2.compress(data, level)
+
+
+def _compress_lzma(data, level):
+    return lzma.compress(data, format=lzma.FORMAT_XZ, preset=level)
+
+
+def _compress_zstd(data, level):
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def available_codecs():
+    """ Returns names of the codecs that could be used on this system """
+    codecs = [CODEC_NONE, CODEC_GZIP, CODEC_BZ2]
+    if lzma is not None:
+        codecs.append(CODEC_LZMA)
+    if zstandard is not None:
+        codecs.append(CODEC_ZSTD)
+
+    return codecs
+
+
+def compressed_file(file_path, codec):
+    """ Tells if particular file should be compressed """
+    if codec == CODEC_NONE:
+        return False
+
+    return not file_path.lower().endswith(UNCOMPRESSED_EXTENSIONS)
+
+
+def block_compressor(codec):
+    """ Returns function that compresses single block using particular codec """
+    block_compressors = {
+        CODEC_GZIP: _compress_gzip,
+        CODEC_BZ2: _compress_bz2,
+        CODEC_LZMA: _compress_lzma,
+        CODEC_ZSTD: _compress_zstd
+    }
+
+    return block_compressors[codec]
+
+
+## Decompression ##
+def _decompressor(codec):
+    """ Returns decompressor object of particular codec """
+    if codec == CODEC_GZIP:
+        return zlib.decompressobj(GZIP_WBITS)
+    elif codec == CODEC_BZ2:
+        return bz2.BZ2Decompressor()
+    elif codec == CODEC_LZMA:
+        return lzma.LZMADecompressor()
+    elif codec == CODEC_ZSTD:
+        return zstandard.ZstdDecompressor().decompressobj()
+
+    raise ValueError('Codec "' + str(codec) + '" is not supported!')
+
+
+def decompress(source_file, codec, read_size):
+    """ Decompresses file written by the compressor (sequence of streams), yields decompressed data """
+    decompressor = _decompressor(codec)
+    while True:
+        data = source_file.read(read_size)
+        if not data:
+            break
+
+        while data:
+            if getattr(decompressor, 'eof', False):
+                # Previous stream is over, next one begins
+                decompressor = _decompressor(codec)
+
+            try:
+                decompressed_data = decompressor.decompress(data)
+            except EOFError:
+                decompressor = _decompressor(codec)
+                continue
+
+            if decompressed_data:
+                yield decompressed_data
+
+            # Data past the end of the stream belongs to the next stream
+            data = getattr(decompressor, 'unused_data', b'')
+            if data:
+                decompressor = _decompressor(codec)
+
+
+### CLASSES ###
+class Compressor(object):
+    """ Compressor class. Compresses blocks of a file using pool of worker threads """
+    def __init__(self, settings):
+        self.codec = settings['compression']
+        self.level = int(settings['compression_level'])
+        self.workers = max(1, int(settings['compression_workers']))
+        self.block_size = max(1, int(settings['compression_block_mb'])) * 1024 * 1024
+
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def _compress_block(self, data):
+        """ Compresses single block, returns compressed data along with time spent compressing """
+        start_time = time.time()
+        compressed_data = block_compressor(self.codec)(data, self.level)
+
+        return compressed_data, time.time() - start_time
+
+    def extension(self):
+        """ Returns extension of compressed files """
+        return CODEC_EXTENSIONS[self.codec]
+
+    def compress(self, source_file, stats, hasher=None):
+        """ Compresses source file, yields compressed blocks in order and updates copy statistics """
+        # Note: zlib, bz2 and lzma release GIL while compressing, so threads do run in parallel
+        # Note: Several files might be compressed at once, those share the same pool
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+            pool = self._pool
+
+        # Limit number of blocks in flight, so memory usage stays bounded
+        max_pending = self.workers * 2
+        pending = collections.deque()
+
+        while True:
+            data = source_file.read(self.block_size)
+            if data:
+                if hasher is not None:
+                    hasher.update(data)
+                pending.append(pool.apply_async(self._compress_block, (data,)))
+                stats.bytes_copied += len(data)
+
+            while len(pending) and (len(pending) >= max_pending or not data):
+                compressed_data, compress_time = pending.popleft().get()
+                stats.bytes_written += len(compressed_data)
+                stats.cpu_time += compress_time
+                yield compressed_data
+
+            if not data:
+                break
+
+    def close(self):
+        """ Stops worker threads """
+        with self._lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool = None
@@ -0,0 +1,839 @@
+"""
+Copy Engine Class
+Copies virtual machine files using large buffers and kernel copy offload (where available). Virtual disk files are
+copied sparse, holes and blocks of zeros are not written
+"""
+
+
+### INCLUDES ###
+import os
+import io
+import sys
+import json
+import time
+import errno
+import shutil
+import hashlib
+import itertools
+import threading
+
+from multiprocessing.pool import ThreadPool
+
+from py_knife import file_system
+
+from .compression import Compressor, compressed_file
+from .scanner import scan_dir, destination_list
+from .checksum import new_hasher
+from .throttle import BandwidthLimiter
+from .pipeline import BufferPool, CopyPipeline
+from .tape_writer import TapeWriter, advise, POSIX_FADV_SEQUENTIAL, POSIX_FADV_DONTNEED
+
+
+### CONSTANTS ###
+## Kernel Copy Offload ##
+COPY_FILE_RANGE = getattr(os, 'copy_file_range', None)
+SENDFILE = getattr(os, 'sendfile', None)
+if SENDFILE is None:
+    try:
+        # Python 2 does not have os.sendfile, pysendfile package provides the same call
+        from sendfile import sendfile as SENDFILE
+    except ImportError:
+        SENDFILE = None
+
+# Errors meaning that kernel offload is not supported for this pair of files
+OFFLOAD_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EBADF,
+                  getattr(errno, 'ENOTSUP', errno.EINVAL), getattr(errno, 'EOPNOTSUPP', errno.EINVAL))
+
+## Sparse Files ##
+# Python 2 does not have os.SEEK_DATA and os.SEEK_HOLE, values below are the ones used by Linux
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3 if sys.platform.startswith('linux') else None)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4 if sys.platform.startswith('linux') else None)
+
+# Errors meaning that file system can not tell where holes are
+SEEK_ERRORS = (errno.EINVAL, getattr(errno, 'ENOTSUP', errno.EINVAL), getattr(errno, 'EOPNOTSUPP', errno.EINVAL))
+
+# Blocks of zeros (this size and aligned) are not written, those end up as holes of the copy
+SPARSE_BLOCK_SIZE = 64 * 1024
+
+## Copy Methods ##
+METHOD_COPY_FILE_RANGE = 'copy_file_range'
+METHOD_SENDFILE = 'sendfile'
+METHOD_BUFFERED = 'buffered'
+METHOD_SPARSE = 'sparse'
+METHOD_DELTA = 'delta'
+METHOD_UNCHANGED = 'unchanged'
+
+MEGA_BYTE = 1024 * 1024
+
+## Two Phase Copy ##
+# Modification times are not precise, files modified this close to the copy start are copied again
+MTIME_RESOLUTION = 2.0
+# Pre-copy records hash of each block of virtual disk files, final pass rewrites blocks whose hashes differ
+DELTA_BLOCK_SIZE = MEGA_BYTE
+
+## Backup Files ##
+# Lists every file of the backup folder along with the way it has been stored
+FILE_LIST_NAME = 'backup_files.json'
+FILE_LIST_VERSION = 1
+FILE_LIST_CHECKSUM = 'checksum'
+
+## Virtual Disk Files ##
+# Incremental and chunked backups split those into blocks, everything else is copied as is
+DISK_EXTENSIONS = ('.vmdk',)
+
+
+### FUNCTIONS ###
+## Manifest Functions ##
+def load_manifest(manifest_path):
+    """ Loads backup manifest (or any other json file stored in the backup folder) """
+    with open(manifest_path, 'r') as manifest_file:
+        return json.load(manifest_file)
+
+
+def save_manifest(manifest_path, manifest):
+    """ Saves backup manifest. Manifest shows up only once it is completely written """
+    temp_path = manifest_path + '.tmp'
+    with open(temp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, separators=(',', ':'))
+
+    if os.path.isfile(manifest_path):
+        os.remove(manifest_path)
+    os.rename(temp_path, manifest_path)
+
+
+def save_file_list(source_path, destination_path, stats_list, checksum=None):
+    """ Saves list of files of particular backup along with the way those have been stored (and checksums) """
+    file_list = {'version': FILE_LIST_VERSION, FILE_LIST_CHECKSUM: checksum, 'files': {}}
+    for stats in stats_list:
+        relative_path = os.path.relpath(stats.source_path, source_path)
+        file_list['files'][relative_path] = {
+            'path': os.path.relpath(stats.destination_path, destination_path),
+            'codec': stats.codec,
+            'size': stats.bytes_copied,
+            'checksum': stats.checksum
+        }
+
+    save_manifest(os.path.join(destination_path, FILE_LIST_NAME), file_list)
+
+
+## File Functions ##
+def disk_file(file_path):
+    """ Tells if file is a virtual disk file """
+    return os.path.splitext(file_path)[1].lower() in DISK_EXTENSIONS
+
+
+def data_extents(file_descriptor, size):
+    """ Returns list of (start, end) offsets of the data in the sparse file, None if holes can not be detected """
+    if SEEK_DATA is None or SEEK_HOLE is None:
+        return None
+
+    extents = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                data_start = os.lseek(file_descriptor, offset, SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # Nothing but a hole till the end of the file
+                    break
+                raise
+
+            if data_start >= size:
+                break
+
+            data_end = min(size, os.lseek(file_descriptor, data_start, SEEK_HOLE))
+            extents.append((data_start, data_end))
+            offset = data_end
+
+    except OSError as e:
+        if e.errno not in SEEK_ERRORS:
+            raise
+        return None
+
+    finally:
+        os.lseek(file_descriptor, 0, os.SEEK_SET)
+
+    return extents
+
+
+def write_all(destination_file, buffer_view):
+    """ Writes whole buffer to the unbuffered file (those might perform partial writes) """
+    bytes_written = 0
+    while bytes_written < len(buffer_view):
+        bytes_written += destination_file.write(buffer_view[bytes_written:])
+
+
+### CLASSES ###
+class CopyStats(object):
+    """ Statistics of a single file copy """
+    def __init__(self, source_path, destination_path):
+        self.source_path = source_path
+        self.destination_path = destination_path
+        self.bytes_copied = 0
+        self.bytes_written = 0
+        self.duration = 0.0
+        self.cpu_time = 0.0
+        self.method = None
+        self.codec = None
+        self.checksum = None
+
+        # Times reader waited for free buffer and writer waited for filled buffer (copy pipeline)
+        self.reader_stalls = 0
+        self.reader_wait = 0.0
+        self.writer_stalls = 0
+        self.writer_wait = 0.0
+
+    @property
+    def throughput(self):
+        """ Copy throughput in bytes per second """
+        if self.duration > 0:
+            return self.bytes_copied / self.duration
+        return 0.0
+
+    @property
+    def compression_ratio(self):
+        """ Ratio of original size to compressed size """
+        if self.bytes_written > 0:
+            return float(self.bytes_copied) / self.bytes_written
+        return 1.0
+
+    def __str__(self):
+        output = "Copied '{0}': {1} in {2:.1f}s ({3}/s, {4})".format(
+            os.path.basename(self.source_path), file_system.print_memory_size(self.bytes_copied),
+            self.duration, file_system.print_memory_size(self.throughput), self.method)
+
+        if self.method == METHOD_SPARSE:
+            output += ', {0} written'.format(file_system.print_memory_size(self.bytes_written))
+
+        if self.reader_stalls or self.writer_stalls:
+            output += ', stalls: reader {0} ({1:.1f}s), writer {2} ({3:.1f}s)'.format(
+                self.reader_stalls, self.reader_wait, self.writer_stalls, self.writer_wait)
+
+        if self.codec is not None:
+            output += ', ratio {0:.2f}:1, cpu {1:.1f}s'.format(self.compression_ratio, self.cpu_time)
+
+        return output
+
+
+class BlockHashes(object):
+    """ Hashes of the fixed size blocks of a file. Fed the same way as a checksum hasher (and feeds the checksum
+    hasher, if any, on the way) """
+    def __init__(self, hasher=None):
+        self.hasher = hasher
+        self.blocks = []
+
+        self._block_hasher = hashlib.sha1()
+        self._block_used = 0
+
+    ## Internal Methods ##
+    def _finish_block(self):
+        """ Records hash of the current block, starts the next one """
+        self.blocks.append(self._block_hasher.digest())
+        self._block_hasher = hashlib.sha1()
+        self._block_used = 0
+
+    ## External Methods ##
+    def update(self, data):
+        """ Hashes next piece of the file """
+        if self.hasher is not None:
+            self.hasher.update(data)
+
+        data_view = memoryview(data)
+        data_offset = 0
+        while data_offset < len(data_view):
+            count = min(DELTA_BLOCK_SIZE - self._block_used, len(data_view) - data_offset)
+            self._block_hasher.update(data_view[data_offset:data_offset + count])
+            self._block_used += count
+            data_offset += count
+            if self._block_used == DELTA_BLOCK_SIZE:
+                self._finish_block()
+
+    def digests(self):
+        """ Returns hashes of all of the blocks (partial block at the end of the file included) """
+        if self._block_used:
+            self._finish_block()
+
+        return self.blocks
+
+
+class CopyEngine(object):
+    """ Copy Engine class """
+    def __init__(self, settings, print_func=None):
+        self.settings = settings
+        self.buffer_size = max(1, int(settings['copy_buffer_mb'])) * MEGA_BYTE
+        self.file_workers = max(1, int(settings['file_workers']))
+        self.checkpoint_size = max(1, int(settings['checkpoint_mb'])) * MEGA_BYTE
+        self.checksum = settings['checksum']
+        self.sparse = bool(settings['sparse_copy'])
+        self.pipeline = bool(settings['pipeline_copy'])
+        self.fadvise = bool(settings['fadvise'])
+        self.print_func = print_func
+        self.compressor = Compressor(settings)
+        self.limiter = BandwidthLimiter(settings)
+        self.buffer_pool = BufferPool(settings)
+        self.journal = None
+        self.stream = None
+        self.tape_target = False
+        self.track_blocks = False
+
+        # Note: Several files might be copied at once, each thread gets its own buffers
+        self._local = threading.local()
+        self._zeros = None
+        self._direct_reported = False
+        self._copy_times = {}
+        self._checksums = {}
+        self._block_hashes = {}
+
+    ## Internal Methods ##
+    def _print(self, message):
+        if self.print_func is not None:
+            self.print_func(message)
+
+    def _fetch_buffer(self, buffer_name):
+        """ Returns reusable buffer of the current thread """
+        copy_buffer = getattr(self._local, buffer_name, None)
+        if copy_buffer is None or len(copy_buffer) != self.buffer_size:
+            copy_buffer = bytearray(self.buffer_size)
+            setattr(self._local, buffer_name, copy_buffer)
+
+        return copy_buffer
+
+    def _checkpoint(self, destination_file, stats):
+        """ Records copy progress in the journal (if any) every once in a while """
+        if self.journal is not None and stats.bytes_copied - self._local.checkpoint_offset >= self.checkpoint_size:
+            # Data collected by the tape writer has to be written out first
+            destination_file.flush()
+
+            # Note: Holes skipped at the end of the copied data do not extend the copy on their own
+            if os.fstat(destination_file.fileno()).st_size < stats.bytes_copied:
+                destination_file.truncate(stats.bytes_copied)
+
+            # Note: Offset is recorded only once data is on the tape
+            os.fsync(destination_file.fileno())
+            self.journal.checkpoint(stats.source_path, stats.bytes_copied, self._local.source_stat)
+            self._local.checkpoint_offset = stats.bytes_copied
+
+    def _offload_copy(self, source_file, destination_file, stats):
+        """ Copies file content within the kernel, returns False if offload is not supported """
+        source_fd = source_file.fileno()
+        destination_fd = destination_file.fileno()
+        size = os.fstat(source_fd).st_size
+
+        if COPY_FILE_RANGE is not None:
+            stats.method = METHOD_COPY_FILE_RANGE
+        elif SENDFILE is not None:
+            stats.method = METHOD_SENDFILE
+        else:
+            return False
+
+        try:
+            while stats.bytes_copied < size:
+                count = min(self.buffer_size, size - stats.bytes_copied)
+                if COPY_FILE_RANGE is not None:
+                    copied = COPY_FILE_RANGE(source_fd, destination_fd, count)
+                else:
+                    copied = SENDFILE(destination_fd, source_fd, stats.bytes_copied, count)
+
+                if copied == 0:
+                    # File shrunk while we were copying it
+                    break
+
+                stats.bytes_copied += copied
+                self.limiter.read(copied)
+                self.limiter.write(copied)
+                self._checkpoint(destination_file, stats)
+
+        except OSError as e:
+            if e.errno not in OFFLOAD_ERRORS:
+                raise
+
+            # Continue with buffered copy where offload stopped
+            source_file.seek(stats.bytes_copied)
+            destination_file.seek(stats.bytes_copied)
+            return False
+
+        return True
+
+    def _hash_prefix(self, source_file, offset, hasher):
+        """ Hashes beginning of the file copied earlier (interrupted copy continues after it) """
+        copy_buffer = self._fetch_buffer('copy_buffer')
+        buffer_view = memoryview(copy_buffer)
+
+        source_file.seek(0)
+        bytes_left = offset
+        while bytes_left > 0:
+            bytes_read = source_file.readinto(buffer_view[:min(bytes_left, len(copy_buffer))])
+            if not bytes_read:
+                break
+
+            hasher.update(buffer_view[:bytes_read])
+            bytes_left -= bytes_read
+            self.limiter.read(bytes_read)
+
+    def _drop_cache(self, source_file, offset, length):
+        """ Drops pages of the source file that have been read already from the page cache (zero length drops
+        everything) """
+        if self.fadvise:
+            advise(source_file.fileno(), offset, length, POSIX_FADV_DONTNEED)
+
+    def _zero_buffer(self):
+        """ Returns buffer of zeros. It is never written to, so it is shared by all of the threads """
+        if self._zeros is None or len(self._zeros) != self.buffer_size:
+            self._zeros = bytearray(self.buffer_size)
+
+        return self._zeros
+
+    def _copy_chunks(self, read_func, write_func, stats):
+        """ Writes out chunks produced by read function. Reader runs in its own thread if copy pipeline is enabled,
+        so reading from the datastore and writing to the tape overlap """
+        if not self.pipeline:
+            copy_buffer = self._fetch_buffer('copy_buffer')
+            for offset, chunk_buffer, chunk_size in read_func(itertools.repeat(copy_buffer)):
+                chunk_view = memoryview(chunk_buffer)[:chunk_size] if chunk_buffer is not None else None
+                write_func(offset, chunk_view, chunk_size)
+            return
+
+        pipeline = CopyPipeline(self.buffer_pool)
+        try:
+            for offset, chunk_view, chunk_size in pipeline.run(read_func):
+                write_func(offset, chunk_view, chunk_size)
+        finally:
+            pipeline.close()
+            stats.reader_stalls += pipeline.reader_stalls
+            stats.reader_wait += pipeline.reader_wait
+            stats.writer_stalls += pipeline.writer_stalls
+            stats.writer_wait += pipeline.writer_wait
+
+    def _read_chunks(self, source_file, copy_buffers, offset, hasher=None):
+        """ Reads file content into copy buffers (and hashes it on the way), yields (offset, buffer, size) chunks """
+        for copy_buffer in copy_buffers:
+            bytes_read = source_file.readinto(copy_buffer)
+            if not bytes_read:
+                break
+
+            self.limiter.read(bytes_read)
+            if hasher is not None:
+                hasher.update(memoryview(copy_buffer)[:bytes_read])
+            self._drop_cache(source_file, offset, bytes_read)
+
+            yield offset, copy_buffer, bytes_read
+            offset += bytes_read
+
+    def _buffered_copy(self, source_file, destination_file, stats, hasher=None):
+        """ Copies file content using large reusable buffers (and hashes it on the way) """
+        def read_func(copy_buffers):
+            return self._read_chunks(source_file, copy_buffers, stats.bytes_copied, hasher)
+
+        def write_func(offset, chunk_view, chunk_size):
+            write_all(destination_file, chunk_view)
+            self.limiter.write(chunk_size)
+            stats.bytes_copied = offset + chunk_size
+            self._checkpoint(destination_file, stats)
+
+        stats.method = METHOD_BUFFERED
+        self._copy_chunks(read_func, write_func, stats)
+
+    def _hash_zeros(self, hasher, count):
+        """ Hashes zeros of the hole (holes read as zeros) """
+        zero_view = memoryview(self._zero_buffer())
+        while count > 0:
+            hasher.update(zero_view[:min(count, len(zero_view))])
+            count -= min(count, len(zero_view))
+
+    def _write_sparse(self, destination_file, buffer_view, offset, compare_view=None):
+        """ Writes buffer at particular offset skipping blocks that match compare buffer (blocks of zeros by default),
+        returns number of bytes written """
+        if compare_view is None:
+            compare_view = memoryview(self._zero_buffer())
+
+        bytes_written = 0
+        data_start = None
+        block_start = 0
+        while block_start < len(buffer_view):
+            block_end = min(block_start + SPARSE_BLOCK_SIZE, len(buffer_view))
+            same_block = buffer_view[block_start:block_end] == compare_view[block_start:block_end]
+            if not same_block and data_start is None:
+                data_start = block_start
+
+            # Write data collected so far once it is followed by skipped block (or buffer ends)
+            if data_start is not None and (same_block or block_end == len(buffer_view)):
+                data_end = block_start if same_block else block_end
+                destination_file.seek(offset + data_start)
+                write_all(destination_file, buffer_view[data_start:data_end])
+                bytes_written += data_end - data_start
+                data_start = None
+
+            block_start = block_end
+
+        return bytes_written
+
+    def _read_sparse_chunks(self, source_file, copy_buffers, offset, hasher=None):
+        """ Reads data of the sparse file into copy buffers, yields (offset, buffer, size) chunks. Holes are yielded
+        as chunks without buffer """
+        size = os.fstat(source_file.fileno()).st_size
+        extents = data_extents(source_file.fileno(), size)
+        if extents is None:
+            # Holes can not be detected, blocks of zeros still are
+            extents = [(0, size)]
+
+        # Note: File might grow while it is being copied (running machine), so data past the end is copied as well
+        extents.append((size, None))
+
+        for data_start, data_end in extents:
+            if data_end is not None and data_end <= offset:
+                # Copied already (interrupted copy continues after it)
+                continue
+
+            hole_size = max(0, data_start - offset)
+            if hole_size:
+                if hasher is not None:
+                    self._hash_zeros(hasher, hole_size)
+                yield offset, None, hole_size
+                offset += hole_size
+
+            source_file.seek(offset)
+            while data_end is None or offset < data_end:
+                copy_buffer = next(copy_buffers)
+                read_size = len(copy_buffer)
+                if data_end is not None:
+                    read_size = min(read_size, data_end - offset)
+
+                bytes_read = source_file.readinto(memoryview(copy_buffer)[:read_size])
+                if not bytes_read:
+                    # End of the file (file might have shrunk while we were copying it)
+                    return
+
+                self.limiter.read(bytes_read)
+                if hasher is not None:
+                    hasher.update(memoryview(copy_buffer)[:bytes_read])
+                self._drop_cache(source_file, offset, bytes_read)
+
+                yield offset, copy_buffer, bytes_read
+                offset += bytes_read
+
+    def _sparse_copy(self, source_file, destination_file, stats, hasher=None):
+        """ Copies data of the sparse file skipping its holes and blocks of zeros, so the copy is sparse as well """
+        def read_func(copy_buffers):
+            return self._read_sparse_chunks(source_file, copy_buffers, stats.bytes_copied, hasher)
+
+        def write_func(offset, chunk_view, chunk_size):
+            if chunk_view is not None:
+                bytes_written = self._write_sparse(destination_file, chunk_view, offset)
+                self.limiter.write(bytes_written)
+                stats.bytes_written += bytes_written
+
+            stats.bytes_copied = offset + chunk_size
+            self._checkpoint(destination_file, stats)
+
+        stats.method = METHOD_SPARSE
+        self._copy_chunks(read_func, write_func, stats)
+
+        # Copy gets the size of the file, holes at the end included
+        destination_file.truncate(stats.bytes_copied)
+
+    def _delta_copy(self, source_file, destination_file, stats, block_digests, hasher=None):
+        """ Compares blocks of the file with block hashes recorded by the earlier copy, rewrites only blocks that
+        differ. Earlier copy is not read back from the tape. Returns block hashes of the file """
+        copy_buffer = self._fetch_buffer('copy_buffer')
+        buffer_view = memoryview(copy_buffer)
+
+        digests = []
+        stats.method = METHOD_DELTA
+        while True:
+            # Note: Buffer is filled completely, so blocks line up with the blocks of the earlier copy
+            bytes_read = 0
+            while bytes_read < len(copy_buffer):
+                count = source_file.readinto(buffer_view[bytes_read:])
+                if not count:
+                    break
+                bytes_read += count
+
+            if not bytes_read:
+                break
+
+            self.limiter.read(bytes_read)
+            if hasher is not None:
+                hasher.update(buffer_view[:bytes_read])
+            self._drop_cache(source_file, stats.bytes_copied, bytes_read)
+
+            for block_start in xrange(0, bytes_read, DELTA_BLOCK_SIZE):
+                block_view = buffer_view[block_start:min(block_start + DELTA_BLOCK_SIZE, bytes_read)]
+                block_index = len(digests)
+                digests.append(hashlib.sha1(block_view).digest())
+                if block_index < len(block_digests) and block_digests[block_index] == digests[-1]:
+                    continue
+
+                offset = stats.bytes_copied + block_start
+                if self.sparse and block_index >= len(block_digests):
+                    # Past the end of the earlier copy, blocks of zeros are left as holes
+                    bytes_written = self._write_sparse(destination_file, block_view, offset)
+                else:
+                    destination_file.seek(offset)
+                    write_all(destination_file, block_view)
+                    bytes_written = len(block_view)
+
+                self.limiter.write(bytes_written)
+                stats.bytes_written += bytes_written
+
+            stats.bytes_copied += bytes_read
+
+        # File might have shrunk (or grown over holes) since the earlier copy
+        destination_file.truncate(stats.bytes_copied)
+
+        return digests
+
+    def _compressed_copy(self, source_file, destination_file, stats, hasher=None):
+        """ Compresses file content on the way to destination """
+        stats.method = stats.codec = self.compressor.codec
+        bytes_read = stats.bytes_copied
+        for compressed_data in self.compressor.compress(source_file, stats, hasher):
+            write_all(destination_file, memoryview(compressed_data))
+            self.limiter.read(stats.bytes_copied - bytes_read)
+            self.limiter.write(len(compressed_data))
+            bytes_read = stats.bytes_copied
+
+    ## External Methods ##
+    def new_hasher(self):
+        """ Returns new hash object for the file checksum, None if checksums are disabled """
+        return new_hasher(self.checksum)
+
+    def tape_writer(self, destination_file):
+        """ Wraps destination file with tape writer if backup is written to the tape (returns file as is otherwise) """
+        if not self.tape_target:
+            return destination_file
+
+        writer = TapeWriter(destination_file, self.settings)
+        if self.settings['direct_io'] and not writer.direct and not self._direct_reported:
+            self._print('Direct I/O is not supported by the tape, writing through page cache')
+            self._direct_reported = True
+
+        return writer
+
+    def copy_file(self, source_path, destination_path, skip_completed=True):
+        """ Copies single file, returns copy statistics. Files journal lists as completely copied are skipped unless
+        requested otherwise """
+        if self.journal is not None and skip_completed:
+            stats = self.journal.completed(source_path)
+            if stats is not None:
+                self._print("Copied '" + os.path.basename(source_path) + "' already (journal), skipping it")
+                return stats
+
+        compress = compressed_file(source_path, self.compressor.codec)
+        if compress:
+            destination_path += self.compressor.extension()
+
+        # Continue copy that has been interrupted (compressed files are always copied from the start)
+        offset = 0
+        if self.journal is not None and not compress:
+            offset = self.journal.offset(source_path, destination_path)
+
+        stats = CopyStats(source_path, destination_path)
+        start_time = time.time()
+        self._copy_times[destination_path] = start_time
+        self._local.checkpoint_offset = offset
+        hasher = self.new_hasher()
+
+        block_hashes = None
+        copy_hasher = hasher
+        if self.track_blocks and not compress and disk_file(source_path):
+            # Final pass of two phase copy compares blocks against these instead of reading the copy back
+            block_hashes = copy_hasher = BlockHashes(hasher)
+
+        with io.open(source_path, 'rb', buffering=0) as source_file:
+            # Note: Journal records state of the file before the copy, so changes made during the copy are detected
+            source_stat = self._local.source_stat = os.fstat(source_file.fileno())
+            if self.fadvise:
+                advise(source_file.fileno(), 0, 0, POSIX_FADV_SEQUENTIAL)
+
+            with io.open(destination_path, 'r+b' if offset else 'wb', buffering=0) as destination_file:
+                if offset:
+                    self._print("Continuing copy of '" + os.path.basename(source_path) + "' from " +
+                                file_system.print_memory_size(offset) + ' (journal)')
+                    if copy_hasher is not None:
+                        self._hash_prefix(source_file, offset, copy_hasher)
+                    source_file.seek(offset)
+                    destination_file.seek(offset)
+                    destination_file.truncate(offset)
+                    stats.bytes_copied = offset
+
+                # Note: Kernel copy offload does not pass the data through, so it can not be used along with checksums
+                # or tape writer
+                writer = self.tape_writer(destination_file)
+                if compress:
+                    self._compressed_copy(source_file, writer, stats, hasher)
+                elif self.sparse and disk_file(source_path):
+                    self._sparse_copy(source_file, writer, stats, copy_hasher)
+                elif copy_hasher is not None or writer is not destination_file or \
+                        not self._offload_copy(source_file, destination_file, stats):
+                    self._buffered_copy(source_file, writer, stats, copy_hasher)
+
+                writer.flush()
+                self._drop_cache(source_file, 0, 0)
+                if self.journal is not None:
+                    os.fsync(destination_file.fileno())
+
+        shutil.copystat(source_path, destination_path)
+        if not compress and stats.method != METHOD_SPARSE:
+            stats.bytes_written = stats.bytes_copied
+
+        if hasher is not None:
+            stats.checksum = self._checksums[destination_path] = hasher.hexdigest()
+        if block_hashes is not None:
+            self._block_hashes[destination_path] = block_hashes.digests()
+
+        stats.duration = time.time() - start_time
+        self._print(str(stats))
+
+        if self.journal is not None:
+            self.journal.complete(stats, source_stat)
+
+        return stats
+
+    def update_file(self, source_path, destination_path, source_entry=None):
+        """ Brings earlier copy of a file up to date, returns copy statistics """
+        compress = compressed_file(source_path, self.compressor.codec)
+        copy_path = destination_path
+        if compress:
+            copy_path += self.compressor.extension()
+
+        if source_entry is not None:
+            source_size, source_mtime = source_entry.size, source_entry.mtime
+        else:
+            source_stat = os.stat(source_path)
+            source_size, source_mtime = source_stat.st_size, source_stat.st_mtime
+
+        if os.path.isfile(copy_path):
+            destination_stat = os.stat(copy_path)
+            # Note: Earlier copy got modification time of the source file (copystat). Files modified during the
+            # earlier copy might keep the same modification time, so those are never considered unchanged
+            copy_time = self._copy_times.get(copy_path)
+            unchanged = bool(copy_time is not None and source_mtime < copy_time - MTIME_RESOLUTION)
+            unchanged &= bool(source_mtime == destination_stat.st_mtime)
+            if not compress:
+                unchanged &= bool(source_size == destination_stat.st_size)
+
+            if unchanged:
+                stats = CopyStats(source_path, copy_path)
+                stats.method = METHOD_UNCHANGED
+                stats.bytes_copied = source_size
+                stats.checksum = self._checksums.get(copy_path)
+                if compress:
+                    stats.codec = self.compressor.codec
+                return stats
+
+            # Note: Files without block hashes (pre-copy continued from the journal and etc.) are copied again
+            block_digests = self._block_hashes.get(copy_path)
+            if not compress and disk_file(source_path) and block_digests is not None:
+                stats = CopyStats(source_path, copy_path)
+                start_time = time.time()
+                hasher = self.new_hasher()
+
+                with io.open(source_path, 'rb', buffering=0) as source_file:
+                    if self.fadvise:
+                        advise(source_file.fileno(), 0, 0, POSIX_FADV_SEQUENTIAL)
+
+                    with io.open(copy_path, 'r+b', buffering=0) as destination_file:
+                        writer = self.tape_writer(destination_file)
+                        self._block_hashes[copy_path] = self._delta_copy(source_file, writer, stats, block_digests,
+                                                                         hasher)
+                        writer.flush()
+                        self._drop_cache(source_file, 0, 0)
+
+                shutil.copystat(source_path, copy_path)
+                if hasher is not None:
+                    stats.checksum = self._checksums[copy_path] = hasher.hexdigest()
+                stats.duration = time.time() - start_time
+                self._print(str(stats) + ', ' + file_system.print_memory_size(stats.bytes_written) + ' changed')
+
+                return stats
+
+        # Note: Journal could not tell if the file has changed right after it has been copied (modification time
+        # resolution), so files that have been copied already are copied again
+        return self.copy_file(source_path, destination_path, skip_completed=False)
+
+    def close(self):
+        """ Releases resources held by the copy engine """
+        self.compressor.close()
+        self._local = threading.local()
+        self._copy_times = {}
+        self._checksums = {}
+        self._block_hashes = {}
+        self.journal = None
+        self.stream = None
+        self.tape_target = False
+        self.track_blocks = False
+
+    def map_files(self, copy_func, file_list, file_sizes=None):
+        """ Applies copy function to each (source, destination) pair using pool of worker threads.
+        Returns list of results in the same order """
+        def copy_task(file_pair):
+            if self.stream is None:
+                return copy_func(*file_pair)
+
+            # Limit number of files written to the same tape at once
+            with self.stream:
+                return copy_func(*file_pair)
+
+        workers = min(self.file_workers, len(file_list))
+        if workers < 2:
+            return [copy_task(file_pair) for file_pair in file_list]
+
+        # Note: Biggest files go first, so those do not end up copied last by a single thread
+        if file_sizes is None:
+            file_sizes = [os.path.getsize(file_pair[0]) for file_pair in file_list]
+        order = sorted(range(len(file_list)), key=lambda index: file_sizes[index], reverse=True)
+
+        pool = ThreadPool(workers)
+        try:
+            results = pool.map(copy_task, [file_list[index] for index in order], chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        ordered_results = [None] * len(file_list)
+        for index, result in zip(order, results):
+            ordered_results[index] = result
+
+        return ordered_results
+
+    def copy_dir(self, source_path, destination_path, scan_entries=None):
+        """ Copies directory content recursively, returns list of copy statistics """
+        if scan_entries is None:
+            scan_entries = list(scan_dir(source_path))
+
+        file_list = destination_list(source_path, destination_path, scan_entries)
+        file_system.make_dir(destination_path)
+
+        return self.map_files(self.copy_file, file_list, [scan_entry.size for scan_entry in scan_entries])
+
+    def sync_dir(self, source_path, destination_path, scan_entries=None):
+        """ Brings earlier copy of a directory up to date, returns list of copy statistics """
+        if scan_entries is None:
+            scan_entries = list(scan_dir(source_path))
+
+        file_list = destination_list(source_path, destination_path, scan_entries)
+        file_system.make_dir(destination_path)
+
+        # Backup folder keeps some files of its own
+        destination_files = set([os.path.join(destination_path, FILE_LIST_NAME)])
+        if self.journal is not None:
+            destination_files.add(self.journal.journal_path)
+
+        for source_file, destination_file in file_list:
+            if compressed_file(source_file, self.compressor.codec):
+                destination_file += self.compressor.extension()
+            destination_files.add(destination_file)
+
+        # Remove files that are gone since the earlier copy (lock files of the running machine and etc.)
+        for dir_path, dir_names, file_names in os.walk(destination_path, topdown=False):
+            for file_name in file_names:
+                destination_file = os.path.join(dir_path, file_name)
+                if destination_file not in destination_files:
+                    os.remove(destination_file)
+
+            if dir_path != destination_path and not len(os.listdir(dir_path)):
+                os.rmdir(dir_path)
+
+        update_list = [file_pair + (scan_entry,) for file_pair, scan_entry in zip(file_list, scan_entries)]
+        return self.map_files(self.update_file, update_list, [scan_entry.size for scan_entry in scan_entries])
@@ -0,0 +1,409 @@
+"""
+Backup Daemon Class
+Stays resident and backs up virtual machines on schedule, alternative to the cron job starting a new process each time
+
+Daemon parses the same crontab format schedule. Backup catalog, tape ledger and vmrun state are kept warm between the
+backup runs. Local control socket (Unix domain socket) allows triggering, querying or cancelling backup run.
+"""
+
+
+### INCLUDES ###
+import os
+import sys
+import json
+import time
+import errno
+import socket
+import threading
+import SocketServer
+
+from py_knife import file_system
+from py_knife.logger import Logger
+
+from .default_settings import FOLDER_TS_FORMAT, LOG_TS_FORMAT, PRINT_LOCK
+from .virtual_machine import fetch_vm_list
+from .scheduler import BackupScheduler, BACKUP_ABORTED
+from .tapes import TapeLedger
+from .chunk_store import ChunkStore
+from .catalog import BackupCatalog
+from .vmrun import VmrunState
+
+
+### CONSTANTS ###
+## Schedule Constants ##
+# Minimum and maximum value of each crontab field (minute, hour, day of month, month, day of week)
+CRON_LIMITS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 6))
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+# Schedule that does not match anything within a year is never going to match
+SCHEDULE_HORIZON = 366 * DAY
+# Longest wait of the main loop, so it responds to KeyboardInterrupt
+WAIT_TIMEOUT = 1.0
+
+## Control Commands ##
+COMMAND_TRIGGER = 'trigger'
+COMMAND_STATUS = 'status'
+COMMAND_CANCEL = 'cancel'
+COMMANDS = (COMMAND_TRIGGER, COMMAND_STATUS, COMMAND_CANCEL)
+CONTROL_TIMEOUT = 10.0
+
+## Daemon States ##
+STATE_IDLE = 'idle'
+STATE_RUNNING = 'running'
+
+
+### FUNCTIONS ###
+def _parse_field(field_string, field_min, field_max):
+    """ Parses single crontab field ('*', '5', '1-5', '*/15', '1,3,5'), returns set of matching values """
+    values = set()
+    for field_part in field_string.split(','):
+        field_range, separator, step = field_part.partition('/')
+        if separator:
+            if not step.isdigit() or int(step) < 1:
+                raise ValueError
+            step = int(step)
+        else:
+            step = 1
+
+        if field_range == '*':
+            start, end = field_min, field_max
+        elif '-' in field_range:
+            start, separator, end = field_range.partition('-')
+            if not start.isdigit() or not end.isdigit():
+                raise ValueError
+            start, end = int(start), int(end)
+        elif field_range.isdigit():
+            start = end = int(field_range)
+            if separator:
+                # '5/10' stands for '5-max/10'
+                end = field_max
+        else:
+            raise ValueError
+
+        if not field_min <= start <= end <= field_max:
+            raise ValueError
+
+        values.update(range(start, end + 1, step))
+
+    return values
+
+
+def execute_daemon(settings, socket_path, logs_path=None):
+    """ Backup Daemon Routine """
+    backup_daemon = BackupDaemon(settings, socket_path, logs_path)
+    backup_daemon.serve()
+
+
+def daemon_command(socket_path, command):
+    """ Sends command to the running daemon, returns its response """
+    control_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    control_socket.settimeout(CONTROL_TIMEOUT)
+    try:
+        control_socket.connect(socket_path)
+        control_socket.sendall(command + '\n')
+        response = ''
+        while not response.endswith('\n'):
+            data = control_socket.recv(4096)
+            if not data:
+                break
+            response += data
+    finally:
+        control_socket.close()
+
+    return json.loads(response)
+
+
+### CLASSES ###
+class CronSchedule(object):
+    """ Crontab format schedule ('0 22 * * 1-5') """
+    def __init__(self, schedule_string):
+        self.schedule_string = schedule_string
+
+        schedule_fields = str(schedule_string).split()
+        if len(schedule_fields) != len(CRON_LIMITS):
+            raise ValueError('Schedule "' + str(schedule_string) + '" is in incompatible format!')
+
+        try:
+            self.fields = [_parse_field(schedule_field, field_min, field_max)
+                           for schedule_field, (field_min, field_max) in zip(schedule_fields, CRON_LIMITS)]
+        except ValueError:
+            raise ValueError('Schedule "' + str(schedule_string) + '" is in incompatible format!')
+
+        # Note: If both day of month and day of week are restricted, either one of those has to match (as in cron)
+        self.any_day = schedule_fields[2] != '*' and schedule_fields[4] != '*'
+
+    def __str__(self):
+        return self.schedule_string
+
+    ## Internal Methods ##
+    def _day_matches(self, local_time):
+        minutes, hours, days, months, week_days = self.fields
+        if local_time.tm_mon not in months:
+            return False
+
+        # Note: Python weeks start on Monday, cron weeks start on Sunday
+        day_match = local_time.tm_mday in days
+        week_day_match = (local_time.tm_wday + 1) % 7 in week_days
+        if self.any_day:
+            return day_match or week_day_match
+
+        return day_match and week_day_match
+
+    ## External Methods ##
+    def next_time(self, after=None):
+        """ Returns time of the next scheduled run (start of the minute after particular time), None if never """
+        if after is None:
+            after = time.time()
+
+        next_time = (int(after) // MINUTE + 1) * MINUTE
+        end_time = next_time + SCHEDULE_HORIZON
+        minutes, hours = self.fields[:2]
+        while next_time < end_time:
+            local_time = time.localtime(next_time)
+            if not self._day_matches(local_time):
+                next_time += DAY - local_time.tm_hour * HOUR - local_time.tm_min * MINUTE
+            elif local_time.tm_hour not in hours:
+                next_time += HOUR - local_time.tm_min * MINUTE
+            elif local_time.tm_min not in minutes:
+                next_time += MINUTE
+            else:
+                return next_time
+
+        return None
+
+
+class ControlHandler(SocketServer.StreamRequestHandler):
+    """ Control socket request handler, single line command and single line JSON response """
+    def handle(self):
+        command = self.rfile.readline(1024).strip()
+        response = self.server.daemon.command(command)
+        self.wfile.write(json.dumps(response) + '\n')
+
+
+class ControlServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """ Control socket server """
+    daemon_threads = True
+
+    def __init__(self, socket_path, daemon):
+        self.daemon = daemon
+        SocketServer.UnixStreamServer.__init__(self, socket_path, ControlHandler)
+
+
+class BackupDaemon(object):
+    """ Backup Daemon class """
+    def __init__(self, settings, socket_path, logs_path=None):
+        self.settings = settings
+        self.socket_path = socket_path
+        self.logs_path = logs_path
+        self.schedule = CronSchedule(settings['crone_schedule'])
+        self.lock = threading.Lock()
+
+        # Warm state shared by all of the backup runs
+        self.ledger = TapeLedger(settings, settings['tape_workers'])
+        self.chunk_store = ChunkStore(settings)
+        self.vmrun_state = VmrunState(settings, self._print)
+        self.catalog = None
+
+        self.scheduler = None
+        self.next_run = None
+        self.last_run = None
+        self.runs = 0
+
+        self._trigger = threading.Event()
+        self._stop = threading.Event()
+        self._server = None
+
+    ## Internal Methods ##
+    def _print(self, message):
+        # Time Stamp Options 1 and 2
+        if 'log_ts_format' in self.settings:
+            time_stamp = file_system.create_time_stamp(self.settings['log_ts_format'])
+        else:
+            time_stamp = file_system.create_time_stamp(LOG_TS_FORMAT)
+
+        with PRINT_LOCK:
+            print time_stamp, str(message)
+
+    def _format_time(self, timestamp):
+        if timestamp is None:
+            return None
+
+        return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+
+    def _open_socket(self):
+        """ Opens control socket, stale socket left behind by a killed daemon is removed """
+        if os.path.exists(self.socket_path):
+            try:
+                daemon_command(self.socket_path, COMMAND_STATUS)
+            except (socket.error, ValueError):
+                os.remove(self.socket_path)
+            else:
+                raise RuntimeError('Backup daemon is running already! (control socket "' + self.socket_path + '")')
+
+        self._server = ControlServer(self.socket_path, self)
+        # Note: Only the user running the daemon is allowed to control it
+        os.chmod(self.socket_path, 0600)
+
+        server_thread = threading.Thread(target=self._server.serve_forever, name='control_server')
+        server_thread.daemon = True
+        server_thread.start()
+
+    def _close_socket(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+        try:
+            os.remove(self.socket_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _open_catalog(self):
+        """ Opens backup catalog (if enabled), catalog is rebuilt from the tapes if it is empty """
+        if self.settings['_catalog_path']:
+            self.catalog = BackupCatalog(self.settings, self.settings['_catalog_path'])
+            if self.catalog.empty():
+                self._print('Backup catalog is empty! Rebuilding it from the tapes...')
+                self.catalog.rebuild(self._print)
+
+    def _run_summary(self, scheduler, reason):
+        """ Returns summary of particular backup run """
+        return {
+            'backup_ts': self.settings['_backup_ts'],
+            'reason': reason,
+            'start_time': self._format_time(scheduler.start_time),
+            'aborted': scheduler.aborted(),
+            'results': dict([(vm_name, result['status']) for vm_name, result in scheduler.results.items()])
+        }
+
+    def _run(self, reason):
+        """ Executes single backup run """
+        # Time stamp of this backup run
+        if 'folder_ts_format' in self.settings:
+            self.settings['_backup_ts'] = file_system.create_time_stamp(self.settings['folder_ts_format'])
+        else:
+            self.settings['_backup_ts'] = file_system.create_time_stamp(FOLDER_TS_FORMAT)
+
+        logger = None
+        if self.logs_path is not None:
+            file_system.make_dir(self.logs_path)
+            self.settings['_metrics_path'] = os.path.join(self.logs_path,
+                                                          'metrics' + self.settings['_backup_ts'] + '.json')
+            logger = sys.stdout = Logger(os.path.join(self.logs_path, 'backup' + self.settings['_backup_ts']))
+
+        try:
+            self._print('*** Executing Backup (' + reason + ') ***')
+
+            # Tapes might have been changed since the last run
+            self.ledger.reset()
+            self.chunk_store.reset()
+            self.vmrun_state.invalidate()
+
+            scheduler = BackupScheduler(self.settings, fetch_vm_list(self.settings))
+            scheduler.ledger = self.ledger
+            scheduler.chunk_store = self.chunk_store
+            scheduler.vmrun_state = self.vmrun_state
+            scheduler.catalog = self.catalog
+
+            with self.lock:
+                self.scheduler = scheduler
+
+            try:
+                scheduler.run()
+            except:
+                self._print('Backup run failed due to an error: ' + str(sys.exc_info()[0]))
+
+            with self.lock:
+                self.scheduler = None
+                self.last_run = self._run_summary(scheduler, reason)
+                self.runs += 1
+
+        finally:
+            if logger is not None:
+                sys.stdout = logger.terminal
+                logger.log.close()
+
+    ## External Methods ##
+    def command(self, command):
+        """ Executes control command, returns response """
+        with self.lock:
+            if command == COMMAND_STATUS:
+                response = {
+                    'state': STATE_RUNNING if self.scheduler is not None else STATE_IDLE,
+                    'schedule': str(self.schedule),
+                    'next_run': self._format_time(self.next_run),
+                    'triggered': self._trigger.is_set(),
+                    'runs': self.runs,
+                    'last_run': self.last_run,
+                    'current_run': None
+                }
+                if self.scheduler is not None:
+                    response['current_run'] = self._run_summary(self.scheduler, None)
+
+            elif command == COMMAND_TRIGGER:
+                if self.scheduler is not None:
+                    response = {'ok': False, 'message': 'Backup run is in progress already!'}
+                else:
+                    self._trigger.set()
+                    response = {'ok': True, 'message': 'Backup run is triggered'}
+
+            elif command == COMMAND_CANCEL:
+                if self.scheduler is not None:
+                    # Note: Machines being backed up are finished (and resumed), the rest of the machines are skipped
+                    self.scheduler.abort()
+                    response = {'ok': True, 'message': 'Backup run is cancelled, machines being backed up are '
+                                                       'finished first'}
+                elif self._trigger.is_set():
+                    self._trigger.clear()
+                    response = {'ok': True, 'message': 'Triggered backup run is cancelled'}
+                else:
+                    response = {'ok': False, 'message': 'Backup run is not in progress!'}
+
+            else:
+                response = {'ok': False, 'message': 'Unknown command "' + command + '"! Available commands: ' +
+                                                    ', '.join(COMMANDS)}
+
+        return response
+
+    def serve(self):
+        """ Backs up virtual machines on schedule (or on request) until stopped """
+        self._open_socket()
+        self._print('Control socket: ' + self.socket_path)
+        try:
+            self._open_catalog()
+            while not self._stop.is_set():
+                self.next_run = self.schedule.next_time()
+                self._print('Schedule: ' + str(self.schedule) + ', next backup run: ' +
+                            str(self._format_time(self.next_run)))
+
+                while not self._stop.is_set() and not self._trigger.is_set():
+                    if self.next_run is not None and time.time() >= self.next_run:
+                        break
+                    self._trigger.wait(WAIT_TIMEOUT)
+
+                if self._stop.is_set():
+                    break
+
+                with self.lock:
+                    reason = 'triggered' if self._trigger.is_set() else 'scheduled'
+                    self._trigger.clear()
+
+                self._run(reason)
+
+        except KeyboardInterrupt:
+            self._print('Backup daemon is interrupted!')
+
+        finally:
+            self._close_socket()
+            if self.catalog is not None:
+                self.catalog.close()
+                self.catalog = None
+
+            self._print('Backup daemon is stopped!')
+
+    def stop(self):
+        """ Stops the daemon once current backup run (if any) is finished """
+        self._stop.set()
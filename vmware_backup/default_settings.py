@@ -6,6 +6,8 @@ Default Backup Settings
 ### INCLUDES ###
 import os
 import string
+import threading
+import multiprocessing
 
 from py_knife.ordered_dict import OrderedDict
 
@@ -16,6 +18,8 @@ from py_knife.ordered_dict import OrderedDict
 DEFAULT_SETTINGS = OrderedDict()
 DEFAULT_SETTINGS['crone_schedule'] = '0 22 * * 1-5'
 DEFAULT_SETTINGS['vmrun_path'] = 'vmrun'
+DEFAULT_SETTINGS['vmrun_cache_ttl'] = 10
+DEFAULT_SETTINGS['vmrun_timeout'] = 600
 DEFAULT_SETTINGS['vms_path'] = os.path.join(os.path.expanduser('~'), 'vmware')
 
 if os.name == 'nt':
@@ -29,6 +33,67 @@ else:
     MUTLIPLE_TAPE_SYSTEM = True
 
 DEFAULT_SETTINGS['_backup_ts'] = ''
+DEFAULT_SETTINGS['_catalog_path'] = ''
+DEFAULT_SETTINGS['_metrics_path'] = ''
+
+# Concurrency Options
+DEFAULT_SETTINGS['backup_workers'] = 1
+DEFAULT_SETTINGS['tape_workers'] = 1
+DEFAULT_SETTINGS['file_workers'] = 1
+DEFAULT_SETTINGS['disk_streams'] = 4
+DEFAULT_SETTINGS['tape_streams'] = 1
+DEFAULT_SETTINGS['target_type'] = 'auto'
+
+# Copy Options
+DEFAULT_SETTINGS['copy_buffer_mb'] = 16
+DEFAULT_SETTINGS['pipeline_copy'] = True
+DEFAULT_SETTINGS['copy_memory_mb'] = 64
+DEFAULT_SETTINGS['two_phase_copy'] = False
+DEFAULT_SETTINGS['sparse_copy'] = True
+DEFAULT_SETTINGS['checkpoint_mb'] = 1024
+DEFAULT_SETTINGS['checksum'] = 'sha256'
+DEFAULT_SETTINGS['verify_backup'] = False
+
+# Tape Write Options
+# Writes to the tapes are collected into blocks of this size (in KB), aligned for direct I/O
+DEFAULT_SETTINGS['write_block_kb'] = 1024
+DEFAULT_SETTINGS['write_alignment'] = 4096
+DEFAULT_SETTINGS['direct_io'] = False
+DEFAULT_SETTINGS['fadvise'] = True
+
+# Compression Options
+DEFAULT_SETTINGS['compression'] = 'none'
+DEFAULT_SETTINGS['compression_level'] = 1
+DEFAULT_SETTINGS['compression_workers'] = multiprocessing.cpu_count()
+DEFAULT_SETTINGS['compression_block_mb'] = 4
+
+# Backup Mode Options
+DEFAULT_SETTINGS['backup_mode'] = 'full'
+DEFAULT_SETTINGS['incremental_block_mb'] = 4
+DEFAULT_SETTINGS['chunk_size_mb'] = 1
+
+# Bandwidth Options
+DEFAULT_SETTINGS['read_limit_mb'] = 0
+DEFAULT_SETTINGS['write_limit_mb'] = 0
+DEFAULT_SETTINGS['limit_hours'] = ''
+DEFAULT_SETTINGS['io_priority'] = 'normal'
+
+# Retry Options
+# Number of attempts, initial and maximum delay between polls and deadline (in seconds, 0 for no deadline)
+DEFAULT_SETTINGS['suspend_retry'] = '10,1,30,1800'
+DEFAULT_SETTINGS['resume_retry'] = '10,1,30,1800'
+DEFAULT_SETTINGS['create_folder_retry'] = '10,1,10,300'
+DEFAULT_SETTINGS['backup_retry'] = '10,10,300,0'
+
+# Retention Options
+DEFAULT_SETTINGS['prune_mode'] = 'off'
+DEFAULT_SETTINGS['keep_last'] = 0
+DEFAULT_SETTINGS['keep_daily'] = 0
+DEFAULT_SETTINGS['keep_weekly'] = 0
+DEFAULT_SETTINGS['keep_monthly'] = 0
+
+# Metrics Options
+DEFAULT_SETTINGS['prometheus_file'] = ''
 
 # Time Stamp Option 1: Allow user to change time stamps (Comment those out for Option 2)
 DEFAULT_SETTINGS['folder_ts_format'] = '-%Y%m%d'
@@ -37,3 +102,33 @@ DEFAULT_SETTINGS['log_ts_format'] = '%Y-%m-%d %H:%M:%S'
 # Time Stamp Option 2: Do not allow user to change time stamps
 FOLDER_TS_FORMAT = '-%Y%m%d'
 LOG_TS_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+## Backup Modes ##
+BACKUP_MODE_FULL = 'full'
+BACKUP_MODE_INCREMENTAL = 'incremental'
+BACKUP_MODE_CHUNKED = 'chunked'
+BACKUP_MODES = (BACKUP_MODE_FULL, BACKUP_MODE_INCREMENTAL, BACKUP_MODE_CHUNKED)
+
+## Backup Target Types ##
+# Tapes (LTFS) do not handle several streams at once as good as disks do
+TARGET_TYPE_AUTO = 'auto'
+TARGET_TYPE_DISK = 'disk'
+TARGET_TYPE_TAPE = 'tape'
+TARGET_TYPES = (TARGET_TYPE_AUTO, TARGET_TYPE_DISK, TARGET_TYPE_TAPE)
+TAPE_FILE_SYSTEMS = ('ltfs',)
+
+## I/O Priorities ##
+IO_PRIORITY_NORMAL = 'normal'
+IO_PRIORITY_IDLE = 'idle'
+IO_PRIORITIES = (IO_PRIORITY_NORMAL, IO_PRIORITY_IDLE)
+
+## Prune Modes ##
+# Prune backups outside of the retention policy never, all at once before the run or only when space is needed
+PRUNE_MODE_OFF = 'off'
+PRUNE_MODE_BEFORE = 'before'
+PRUNE_MODE_NEEDED = 'needed'
+PRUNE_MODES = (PRUNE_MODE_OFF, PRUNE_MODE_BEFORE, PRUNE_MODE_NEEDED)
+
+## Logging ##
+# Keeps log lines of concurrent backups from interleaving
+PRINT_LOCK = threading.Lock()
@@ -0,0 +1,229 @@
+"""
+Incremental Backup Class
+Splits virtual disk files into fixed size blocks and writes only blocks that changed since the previous backup
+
+Each incremental backup folder contains a manifest. Manifest lists every block of every virtual disk file along with
+the location of the block data on tape. Location is either a full copy of the disk file or a delta file that holds
+changed blocks only. Therefore, any disk file could be restored using a single manifest.
+"""
+
+
+### INCLUDES ###
+import os
+import io
+import glob
+import time
+import shutil
+import hashlib
+
+from py_knife import file_system
+
+from .copy_engine import CopyStats, MEGA_BYTE, write_all, disk_file, load_manifest, save_manifest
+from .tapes import fetch_tape_list
+from .scanner import scan_dir, destination_list
+
+
+### CONSTANTS ###
+## Manifest Constants ##
+MANIFEST_NAME = 'backup_manifest.json'
+MANIFEST_VERSION = 1
+DELTA_EXTENSION = '.delta'
+
+## Copy Methods ##
+METHOD_FULL = 'incremental (full)'
+METHOD_DELTA = 'incremental (delta)'
+
+
+### FUNCTIONS ###
+## Manifest Functions ##
+def find_previous_manifest(settings, vm_name, exclude_path=None):
+    """ Finds manifest of the latest backup of particular virtual machine across all tapes """
+    vm_base_name = os.path.basename(settings['vms_path'])
+
+    manifest_list = []
+    for tape in fetch_tape_list(settings):
+        manifest_list.extend(glob.glob(os.path.join(tape, vm_base_name + '*', vm_name, MANIFEST_NAME)))
+
+    if exclude_path is not None:
+        exclude_manifest = os.path.join(exclude_path, MANIFEST_NAME)
+        manifest_list = [manifest_path for manifest_path in manifest_list
+                         if os.path.abspath(manifest_path) != os.path.abspath(exclude_manifest)]
+
+    if len(manifest_list):
+        return max(manifest_list, key=os.path.getmtime)
+
+    return None
+
+
+def tape_relative_path(settings, path):
+    """ Converts absolute path to the path relative to the tape root, so tapes could be remounted elsewhere """
+    return os.path.relpath(path, settings['tape_path'])
+
+
+def tape_absolute_path(settings, path):
+    """ Converts path relative to the tape root back to absolute path """
+    return os.path.join(settings['tape_path'], path)
+
+
+### CLASSES ###
+class IncrementalBackup(object):
+    """ Incremental Backup class """
+    def __init__(self, settings, copy_engine, print_func=None):
+        self.settings = settings
+        self.copy_engine = copy_engine
+        self.block_size = max(1, int(settings['incremental_block_mb'])) * MEGA_BYTE
+        self.print_func = print_func
+
+        self._buffer = None
+        self._sources = []
+        self._source_indexes = {}
+
+    ## Internal Methods ##
+    def _print(self, message):
+        if self.print_func is not None:
+            self.print_func(message)
+
+    def _fetch_previous(self, destination_path):
+        """ Loads previous manifest (if it is compatible with current settings) """
+        vm_name = os.path.basename(destination_path)
+        previous_path = find_previous_manifest(self.settings, vm_name, destination_path)
+
+        if previous_path is not None:
+            try:
+                previous_manifest = load_manifest(previous_path)
+            except (IOError, OSError, ValueError):
+                self._print('Could not read previous manifest "' + previous_path + '"! Performing full backup!')
+            else:
+                if previous_manifest.get('block_size') == self.block_size:
+                    self._print('Previous Backup: ' + os.path.dirname(previous_path))
+                    return previous_manifest
+
+                self._print('Block size has changed since previous backup! Performing full backup!')
+
+        return None
+
+    def _source_index(self, source):
+        """ Returns index of the data file in the list of manifest sources """
+        if source not in self._source_indexes:
+            self._source_indexes[source] = len(self._sources)
+            self._sources.append(source)
+
+        return self._source_indexes[source]
+
+    def _backup_file(self, source_path, destination_path, previous_entry, previous_sources):
+        """ Splits file into blocks, writes new or changed blocks only """
+        stats = CopyStats(source_path, destination_path)
+        start_time = time.time()
+
+        if self._buffer is None or len(self._buffer) != self.block_size:
+            self._buffer = bytearray(self.block_size)
+        buffer_view = memoryview(self._buffer)
+
+        blocks = []
+
+        if previous_entry is None:
+            # Nothing to compare to, store full copy of the file
+            stats.method = METHOD_FULL
+            data_path = destination_path
+            previous_blocks = []
+        else:
+            stats.method = METHOD_DELTA
+            data_path = destination_path + DELTA_EXTENSION
+            previous_blocks = previous_entry['blocks']
+
+        data_index = self._source_index(tape_relative_path(self.settings, data_path))
+        data_offset = 0
+        blocks_changed = 0
+        hasher = self.copy_engine.new_hasher()
+
+        with io.open(source_path, 'rb', buffering=0) as source_file:
+            with io.open(data_path, 'wb', buffering=0) as data_file:
+                data_file = self.copy_engine.tape_writer(data_file)
+                block_index = 0
+                while True:
+                    bytes_read = source_file.readinto(self._buffer)
+                    if not bytes_read:
+                        break
+
+                    block_view = buffer_view[:bytes_read]
+                    stats.bytes_copied += bytes_read
+                    self.copy_engine.limiter.read(bytes_read)
+                    block_hash = hashlib.sha256(block_view).hexdigest()
+                    if hasher is not None:
+                        hasher.update(block_view)
+
+                    previous_block = None
+                    if block_index < len(previous_blocks):
+                        previous_block = previous_blocks[block_index]
+
+                    if previous_block is not None and previous_block[0] == block_hash:
+                        # Unchanged block, point to the location of existing copy
+                        previous_index = self._source_index(previous_sources[previous_block[1]])
+                        blocks.append([block_hash, previous_index, previous_block[2]])
+                    else:
+                        write_all(data_file, block_view)
+                        self.copy_engine.limiter.write(bytes_read)
+                        blocks.append([block_hash, data_index, data_offset])
+                        data_offset += bytes_read
+                        blocks_changed += 1
+
+                    block_index += 1
+
+                data_file.flush()
+
+        if previous_entry is None:
+            shutil.copystat(source_path, data_path)
+
+        stats.bytes_written = data_offset
+        stats.duration = time.time() - start_time
+        if hasher is not None:
+            stats.checksum = hasher.hexdigest()
+
+        source_stat = os.stat(source_path)
+        entry = {'size': source_stat.st_size, 'mtime': source_stat.st_mtime, 'blocks': blocks}
+
+        self._print(str(stats) + ', ' + str(blocks_changed) + ' of ' + str(len(blocks)) + ' blocks written')
+
+        return entry, stats
+
+    ## External Methods ##
+    def backup_dir(self, source_path, destination_path, scan_entries=None):
+        """ Backs up directory content incrementally, returns list of copy statistics """
+        previous_manifest = self._fetch_previous(destination_path)
+        if previous_manifest is not None:
+            previous_files = previous_manifest['files']
+            previous_sources = previous_manifest['sources']
+        else:
+            previous_files = {}
+            previous_sources = []
+
+        self._sources = []
+        self._source_indexes = {}
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'block_size': self.block_size,
+            'sources': self._sources,
+            'files': {}
+        }
+
+        if scan_entries is None:
+            scan_entries = list(scan_dir(source_path))
+
+        file_system.make_dir(destination_path)
+
+        stats_list = []
+        for source_file, destination_file in destination_list(source_path, destination_path, scan_entries):
+            relative_path = os.path.relpath(source_file, source_path)
+
+            if disk_file(source_file):
+                entry, stats = self._backup_file(source_file, destination_file,
+                                                 previous_files.get(relative_path), previous_sources)
+                manifest['files'][relative_path] = entry
+            else:
+                stats = self.copy_engine.copy_file(source_file, destination_file)
+
+            stats_list.append(stats)
+
+        save_manifest(os.path.join(destination_path, MANIFEST_NAME), manifest)
+
+        return stats_list
@@ -0,0 +1,163 @@
+"""
+Backup Journal Class
+Keeps track of the backup progress inside of the backup folder, so failed backup continues where it stopped
+
+Journal lists files that are completely copied along with byte offset of the file that was being copied. Offsets are
+recorded only once data is flushed to the tape. Files that have changed while being copied are not recorded, copied
+data might be torn. Journal is removed once backup is completed, therefore any backup folder that has a journal is
+incomplete.
+"""
+
+
+### INCLUDES ###
+import os
+import glob
+import threading
+
+from .copy_engine import CopyStats, load_manifest, save_manifest
+from .tapes import fetch_tape_list
+
+
+### CONSTANTS ###
+## Journal Constants ##
+JOURNAL_NAME = 'backup_journal.json'
+JOURNAL_VERSION = 1
+
+## Copy Methods ##
+METHOD_JOURNAL = 'journal'
+
+
+### FUNCTIONS ###
+def incomplete_backup(backup_path):
+    """ Tells if particular backup folder holds incomplete backup """
+    return os.path.isfile(os.path.join(backup_path, JOURNAL_NAME))
+
+
+def find_incomplete_backup(settings, vm_name, exclude_path=None):
+    """ Finds latest incomplete backup of particular virtual machine across all tapes """
+    vm_base_name = os.path.basename(settings['vms_path'])
+
+    journal_list = []
+    for tape in fetch_tape_list(settings):
+        journal_list.extend(glob.glob(os.path.join(tape, vm_base_name + '*', vm_name, JOURNAL_NAME)))
+
+    if exclude_path is not None:
+        journal_list = [journal_path for journal_path in journal_list
+                        if os.path.abspath(os.path.dirname(journal_path)) != os.path.abspath(exclude_path)]
+
+    if len(journal_list):
+        return os.path.dirname(max(journal_list, key=os.path.getmtime))
+
+    return None
+
+
+### CLASSES ###
+class BackupJournal(object):
+    """ Backup Journal class """
+    def __init__(self, source_path, destination_path):
+        self.source_path = source_path
+        self.destination_path = destination_path
+        self.journal_path = os.path.join(destination_path, JOURNAL_NAME)
+        self.lock = threading.RLock()
+
+        self._journal = None
+
+    ## Internal Methods ##
+    def _fetch(self):
+        """ Returns journal content, loads it from the backup folder on first use """
+        with self.lock:
+            if self._journal is None:
+                self._journal = {'version': JOURNAL_VERSION, 'files': {}}
+                if os.path.isfile(self.journal_path):
+                    try:
+                        journal = load_manifest(self.journal_path)
+                    except ValueError:
+                        # Journal got corrupted, start over
+                        journal = None
+
+                    if journal is not None and journal.get('version') == JOURNAL_VERSION:
+                        self._journal = journal
+
+            return self._journal
+
+    def _entry(self, source_path):
+        """ Returns journal entry of particular file, None if source file has changed since it has been recorded """
+        entry = self._fetch()['files'].get(os.path.relpath(source_path, self.source_path))
+        if entry is not None:
+            source_stat = os.stat(source_path)
+            if entry['size'] == source_stat.st_size and entry['mtime'] == source_stat.st_mtime:
+                return entry
+
+        return None
+
+    def _record(self, source_path, entry, source_stat):
+        """ Records journal entry of particular file and saves journal. Stat has to be taken before the copy has
+        started, entry is not recorded if file has changed since. Returns True if entry is recorded """
+        current_stat = os.stat(source_path)
+        if current_stat.st_size != source_stat.st_size or current_stat.st_mtime != source_stat.st_mtime:
+            return False
+
+        entry['size'] = source_stat.st_size
+        entry['mtime'] = source_stat.st_mtime
+
+        # Note: Several files might be copied at once
+        with self.lock:
+            self._fetch()['files'][os.path.relpath(source_path, self.source_path)] = entry
+            save_manifest(self.journal_path, self._journal)
+
+    ## External Methods ##
+    def completed(self, source_path):
+        """ Returns copy statistics of the file that is completely copied already, None otherwise """
+        entry = self._entry(source_path)
+        if entry is None or not entry['completed']:
+            return None
+
+        # Note: Sparse copies write less than their size, those are checked against the size copied instead
+        destination_path = os.path.join(self.destination_path, entry['path'])
+        destination_size = entry['bytes_written'] if entry['codec'] is not None else entry['offset']
+        if not os.path.isfile(destination_path) or os.path.getsize(destination_path) != destination_size:
+            return None
+
+        stats = CopyStats(source_path, destination_path)
+        stats.method = METHOD_JOURNAL
+        stats.codec = entry['codec']
+        stats.bytes_copied = entry['size']
+        stats.checksum = entry.get('checksum')
+
+        return stats
+
+    def offset(self, source_path, destination_path):
+        """ Returns offset particular file copy could continue from (0 if copy has to start over) """
+        entry = self._entry(source_path)
+        if entry is None or entry['completed'] or entry['codec'] is not None:
+            return 0
+
+        # Data past the recorded offset might not have made it to the tape
+        if not os.path.isfile(destination_path) or os.path.getsize(destination_path) < entry['offset']:
+            return 0
+
+        return entry['offset']
+
+    def checkpoint(self, source_path, offset, source_stat):
+        """ Records offset of particular file (stat taken before the copy has started). Copied data has to be
+        flushed to the tape before calling this """
+        return self._record(source_path, {'completed': False, 'path': None, 'codec': None, 'offset': offset},
+                            source_stat)
+
+    def complete(self, stats, source_stat):
+        """ Records file that is completely copied (stat taken before the copy has started) """
+        return self._record(stats.source_path, {
+            'completed': True,
+            'path': os.path.relpath(stats.destination_path, self.destination_path),
+            'codec': stats.codec,
+            'offset': stats.bytes_copied,
+            'bytes_written': stats.bytes_written,
+            'checksum': stats.checksum
+        }, source_stat)
+
+    def remove(self):
+        """ Removes journal once backup is completed """
+        with self.lock:
+            if os.path.isfile(self.journal_path):
+                os.remove(self.journal_path)
+            self._journal = None
@@ -0,0 +1,189 @@
+"""
+Backup Metrics
+Structured metrics of each backup run. Metrics are saved as a JSON summary and (optionally) as a Prometheus textfile
+collector file, so throughput could be graphed over time. Throughput recorded by earlier runs is used to estimate
+duration of the next one
+"""
+
+
+### INCLUDES ###
+import os
+import glob
+
+from py_knife.ordered_dict import OrderedDict
+
+from .copy_engine import load_manifest, save_manifest
+
+
+### CONSTANTS ###
+## Metrics Constants ##
+METRICS_VERSION = 1
+PROMETHEUS_PREFIX = 'vmware_backup_'
+PROMETHEUS_TEMP_EXTENSION = '.tmp'
+
+## Metrics History ##
+METRICS_FILE_PATTERN = 'metrics*.json'
+# Estimates are based on this many latest backup runs
+HISTORY_RUNS = 10
+
+## Retried Operations ##
+OPERATION_SUSPEND = 'suspend'
+OPERATION_RESUME = 'resume'
+OPERATION_CREATE_FOLDER = 'create_folder'
+OPERATION_BACKUP = 'backup'
+OPERATIONS = (OPERATION_SUSPEND, OPERATION_RESUME, OPERATION_CREATE_FOLDER, OPERATION_BACKUP)
+
+## Prometheus Metrics ##
+# Metric key, metric type and help text
+VM_METRICS = (
+    ('duration', 'gauge', 'Total duration of the virtual machine backup in seconds'),
+    ('bytes_copied', 'gauge', 'Bytes read from the virtual machine folder'),
+    ('bytes_written', 'gauge', 'Bytes written to the tape'),
+    ('pre_copy_duration', 'gauge', 'Duration of the pre-copy (two phase copy) in seconds'),
+    ('copy_duration', 'gauge', 'Duration of the copy in seconds'),
+    ('throughput', 'gauge', 'Copy throughput in bytes per second'),
+    ('suspend_latency', 'gauge', 'Time spent suspending the virtual machine in seconds'),
+    ('resume_latency', 'gauge', 'Time spent resuming the virtual machine in seconds'),
+    ('suspend_window', 'gauge', 'Time the virtual machine has been suspended for in seconds'),
+    ('vmrun_calls', 'gauge', 'Number of vmrun suspend and start calls'),
+    ('reader_stalls', 'gauge', 'Number of times copy reader waited for free buffer'),
+    ('reader_wait', 'gauge', 'Time copy reader waited for free buffers in seconds'),
+    ('writer_stalls', 'gauge', 'Number of times copy writer waited for filled buffer'),
+    ('writer_wait', 'gauge', 'Time copy writer waited for filled buffers in seconds'),
+    ('space_free_before', 'gauge', 'Free space on the tape before the backup in bytes'),
+    ('space_free_after', 'gauge', 'Free space on the tape after the backup in bytes'),
+)
+RUN_METRICS = (
+    ('start_time', 'gauge', 'Start time of the backup run (unix time)'),
+    ('duration', 'gauge', 'Total duration of the backup run in seconds'),
+    ('bytes_copied', 'gauge', 'Bytes read from all of the virtual machine folders'),
+    ('bytes_written', 'gauge', 'Bytes written to the tapes'),
+    ('vmrun_list_calls', 'gauge', 'Number of vmrun list calls'),
+    ('vmrun_calls', 'gauge', 'Number of all vmrun calls'),
+    ('vmrun_timeouts', 'gauge', 'Number of vmrun calls killed after timeout'),
+    ('backups_pruned', 'gauge', 'Number of backups pruned according to the retention policy'),
+    ('bytes_pruned', 'gauge', 'Bytes freed by pruning backups'),
+    ('buffer_memory', 'gauge', 'Memory taken up by copy buffers in bytes'),
+    ('directory_scans', 'gauge', 'Number of virtual machine folder scans'),
+)
+
+
+### FUNCTIONS ###
+def vm_metrics():
+    """ Returns empty metrics of a single virtual machine backup """
+    metrics = OrderedDict()
+    metrics['tape'] = None
+    for metric_key, metric_type, metric_help in VM_METRICS:
+        metrics[metric_key] = 0
+    metrics['retries'] = OrderedDict([(operation, 0) for operation in OPERATIONS])
+
+    return metrics
+
+
+def save_metrics(metrics_path, metrics):
+    """ Saves metrics as JSON summary """
+    save_manifest(metrics_path, metrics)
+
+
+def _label_value(value):
+    """ Escapes Prometheus label value """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(label_dict):
+    """ Formats Prometheus labels """
+    if not len(label_dict):
+        return ''
+
+    return '{' + ','.join([key + '="' + _label_value(value) + '"' for key, value in label_dict.items()]) + '}'
+
+
+def prometheus_lines(metrics):
+    """ Converts run metrics to Prometheus text exposition format """
+    lines = []
+
+    def add_metric(name, metric_type, metric_help, samples):
+        lines.append('# HELP ' + PROMETHEUS_PREFIX + name + ' ' + metric_help)
+        lines.append('# TYPE ' + PROMETHEUS_PREFIX + name + ' ' + metric_type)
+        for label_dict, value in samples:
+            lines.append(PROMETHEUS_PREFIX + name + _labels(label_dict) + ' ' + repr(float(value or 0)))
+
+    for metric_key, metric_type, metric_help in RUN_METRICS:
+        add_metric('run_' + metric_key, metric_type, metric_help, [({}, metrics['run'][metric_key])])
+
+    vms = metrics['vms']
+    add_metric('vm_status', 'gauge', 'Result of the virtual machine backup (1 for the current status)',
+               [({'vm': vm_name, 'status': vm['status']}, 1) for vm_name, vm in vms.items()])
+
+    for metric_key, metric_type, metric_help in VM_METRICS:
+        add_metric('vm_' + metric_key, metric_type, metric_help,
+                   [({'vm': vm_name, 'tape': vm['tape'] or ''}, vm[metric_key]) for vm_name, vm in vms.items()])
+
+    add_metric('vm_retries', 'gauge', 'Number of retried attempts of the virtual machine backup operations',
+               [({'vm': vm_name, 'operation': operation}, retries)
+                for vm_name, vm in vms.items() for operation, retries in vm['retries'].items()])
+
+    return lines
+
+
+def save_prometheus(prometheus_path, metrics):
+    """ Saves metrics as Prometheus textfile collector file """
+    # Note: Collector might read the file at any time, so file is replaced at once
+    temp_path = prometheus_path + PROMETHEUS_TEMP_EXTENSION
+    with open(temp_path, 'w') as prometheus_file:
+        prometheus_file.write('\n'.join(prometheus_lines(metrics)) + '\n')
+    os.rename(temp_path, prometheus_path)
+
+
+def load_history(metrics_dir, runs=HISTORY_RUNS):
+    """ Loads metrics of the latest backup runs saved under particular folder (oldest first) """
+    metrics_list = []
+    for metrics_path in glob.glob(os.path.join(metrics_dir, METRICS_FILE_PATTERN)):
+        try:
+            metrics = load_manifest(metrics_path)
+        except (IOError, OSError, ValueError):
+            continue
+
+        if isinstance(metrics, dict) and metrics.get('version') == METRICS_VERSION:
+            metrics_list.append(metrics)
+
+    metrics_list.sort(key=lambda _metrics: _metrics['run'].get('start_time') or 0)
+    return metrics_list[-runs:]
+
+
+### CLASSES ###
+class ThroughputHistory(object):
+    """ Throughput History class. Copy throughput and suspend windows of completed backups of earlier runs """
+    def __init__(self, metrics_list):
+        self.runs = len(metrics_list)
+
+        self._samples = {}
+        for metrics in metrics_list:
+            for vm_name, vm in metrics['vms'].items():
+                # Note: Throughput is recorded for completed backups only
+                copy_time = (vm.get('pre_copy_duration') or 0) + (vm.get('copy_duration') or 0)
+                if vm.get('throughput') and vm.get('bytes_copied') and copy_time > 0:
+                    self._samples.setdefault(vm_name, []).append(dict(vm, copy_time=copy_time))
+
+    ## External Methods ##
+    def throughput(self, vm_name=None):
+        """ Returns copy throughput (in bytes per second) of particular machine (or of all of the machines if that
+        machine has not been backed up yet), None if nothing has been recorded """
+        samples = self._samples.get(vm_name)
+        if not samples:
+            samples = [sample for vm_samples in self._samples.values() for sample in vm_samples]
+
+        copy_time = sum([sample['copy_time'] for sample in samples])
+        if copy_time > 0:
+            return sum([sample['bytes_copied'] for sample in samples]) / copy_time
+
+        return None
+
+    def mean(self, vm_name, metric_key):
+        """ Returns average of the metric recorded for particular machine (ignoring runs it has not been recorded
+        in, such as suspend window of the machine that has not been running), None if nothing has been recorded """
+        values = [sample[metric_key] for sample in self._samples.get(vm_name, []) if sample.get(metric_key)]
+        if len(values):
+            return sum(values) / len(values)
+
+        return None
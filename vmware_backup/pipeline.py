@@ -0,0 +1,179 @@
+"""
+Copy Pipeline Classes
+Overlaps reading from the datastore with writing to the tape
+
+Reader thread fills large reusable buffers while the copying thread writes filled buffers out, so neither side sits
+idle while the other one is busy. Buffers come from a pool shared by all of the copies of the backup run, so memory
+taken up by the buffers stays under the ceiling no matter how many files are copied at once. Each side keeps track of
+how often (and for how long) it had to wait for the other one.
+"""
+
+
+### INCLUDES ###
+import sys
+import time
+import Queue
+import threading
+
+
+### CONSTANTS ###
+## Pipeline Constants ##
+MEGA_BYTE = 1024 * 1024
+# Reader and writer need at least one buffer each
+MIN_BUFFERS = 2
+# Closing pipeline checks if reader is still alive this often (in seconds)
+READER_POLL_TIMEOUT = 1.0
+
+
+### CLASSES ###
+class BufferPool(object):
+    """ Buffer Pool class. Buffers are created on demand until memory ceiling is reached and reused after that """
+    def __init__(self, settings):
+        self.buffer_size = max(1, int(settings['copy_buffer_mb'])) * MEGA_BYTE
+        self.memory_limit = max(1, int(settings['copy_memory_mb'])) * MEGA_BYTE
+        self.buffers = max(MIN_BUFFERS, self.memory_limit // self.buffer_size)
+
+        self._free = []
+        self._created = 0
+        self._condition = threading.Condition()
+
+    def __str__(self):
+        return '{0} buffers of {1} MB'.format(self.buffers, self.buffer_size // MEGA_BYTE)
+
+    ## External Methods ##
+    def acquire(self, blocking=True):
+        """ Returns free buffer, waits for one if memory ceiling is reached (returns None if not blocking) """
+        with self._condition:
+            while not len(self._free) and self._created >= self.buffers:
+                if not blocking:
+                    return None
+                self._condition.wait()
+
+            if len(self._free):
+                return self._free.pop()
+
+            self._created += 1
+
+        return bytearray(self.buffer_size)
+
+    def release(self, copy_buffer):
+        """ Returns buffer to the pool """
+        with self._condition:
+            self._free.append(copy_buffer)
+            self._condition.notify()
+
+    def memory(self):
+        """ Returns memory taken up by the buffers created so far """
+        with self._condition:
+            return self._created * self.buffer_size
+
+
+class CopyPipeline(object):
+    """ Copy Pipeline class. Single use, runs read function in the reader thread and yields chunks it reads """
+    def __init__(self, buffer_pool):
+        self.buffer_pool = buffer_pool
+        self.reader_stalls = 0
+        self.reader_wait = 0.0
+        self.writer_stalls = 0
+        self.writer_wait = 0.0
+
+        self._filled = Queue.Queue()
+        self._stopped = threading.Event()
+        self._reader = None
+        self._error = None
+        self._pending = None
+        self._current = None
+
+    ## Internal Methods ##
+    def _buffers(self):
+        """ Yields free buffers to the read function """
+        while not self._stopped.is_set():
+            copy_buffer = self.buffer_pool.acquire(False)
+            if copy_buffer is None:
+                # Writer (or other copies) hold all of the buffers
+                self.reader_stalls += 1
+                start_time = time.time()
+                copy_buffer = self.buffer_pool.acquire()
+                self.reader_wait += time.time() - start_time
+
+            self._pending = copy_buffer
+            yield copy_buffer
+
+    def _read(self, read_func):
+        """ Reader thread, queues chunks produced by read function """
+        try:
+            for offset, chunk_buffer, chunk_size in read_func(self._buffers()):
+                if chunk_buffer is self._pending:
+                    self._pending = None
+
+                self._filled.put((offset, chunk_buffer, chunk_size))
+                if self._stopped.is_set():
+                    break
+        except:
+            self._error = sys.exc_info()
+        finally:
+            # Buffer taken at the end of the file is not filled
+            if self._pending is not None:
+                self.buffer_pool.release(self._pending)
+                self._pending = None
+
+            self._filled.put(None)
+
+    ## External Methods ##
+    def run(self, read_func):
+        """ Starts reader thread, yields (offset, buffer view, size) of each chunk in order. Read function takes
+        iterator of free buffers and yields (offset, buffer, size) of each chunk, chunks without buffer are holes """
+        self._reader = threading.Thread(target=self._read, args=(read_func,), name='copy_reader')
+        self._reader.daemon = True
+        self._reader.start()
+
+        while True:
+            try:
+                chunk = self._filled.get_nowait()
+            except Queue.Empty:
+                # Reader has not filled next buffer yet
+                self.writer_stalls += 1
+                start_time = time.time()
+                chunk = self._filled.get()
+                self.writer_wait += time.time() - start_time
+
+            if chunk is None:
+                # Reader is done
+                self._reader = None
+                break
+
+            offset, chunk_buffer, chunk_size = chunk
+            if chunk_buffer is None:
+                yield offset, None, chunk_size
+                continue
+
+            self._current = chunk_buffer
+            yield offset, memoryview(chunk_buffer)[:chunk_size], chunk_size
+            self._current = None
+            self.buffer_pool.release(chunk_buffer)
+
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+
+    def close(self):
+        """ Stops reader (if writing stopped early) and returns all of the buffers to the pool """
+        self._stopped.set()
+        if self._current is not None:
+            self.buffer_pool.release(self._current)
+            self._current = None
+
+        while self._reader is not None:
+            try:
+                chunk = self._filled.get(timeout=READER_POLL_TIMEOUT)
+            except Queue.Empty:
+                if not self._reader.is_alive():
+                    break
+                continue
+
+            if chunk is None:
+                break
+
+            if chunk[1] is not None:
+                self.buffer_pool.release(chunk[1])
+
+        self._reader = None
@@ -0,0 +1,126 @@
+"""
+Backup Planner Class
+Sizes all of the virtual machines that need backup before any copying starts and assigns tapes to them
+
+Biggest machines are placed first, so those do not end up without a tape that could fit them once smaller machines
+took up the space. Each machine goes to the least loaded tape that fits it, so backups are spread across the tapes and
+written to them in parallel. Copy time and suspend window of each machine could be estimated using throughput
+recorded by earlier runs.
+"""
+
+
+### INCLUDES ###
+import os
+
+from py_knife import file_system
+
+
+### FUNCTIONS ###
+def print_duration(seconds):
+    """ Formats duration as hours, minutes and seconds (h:mm:ss) """
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{0}:{1:02d}:{2:02d}'.format(hours, minutes, seconds)
+
+
+### CLASSES ###
+class BackupPlanner(object):
+    """ Backup Planner class """
+    def __init__(self, ledger, print_func=None, retention=None):
+        self.ledger = ledger
+        self.print_func = print_func
+        self.retention = retention
+
+    ## Internal Methods ##
+    def _print(self, message):
+        if self.print_func is not None:
+            self.print_func(message)
+
+    ## External Methods ##
+    def assign(self, vm_list):
+        """ Assigns tapes to virtual machines (least loaded tape that fits), returns machines that do not fit """
+        unplaced_list = []
+
+        with self.ledger.lock:
+            tape_list = self.ledger.tape_list()
+            for virtual_machine in sorted(vm_list, key=lambda vm: vm.space_estimate, reverse=True):
+                fit_list = [tape for tape in tape_list
+                            if self.ledger.space_available(tape) >= virtual_machine.space_estimate]
+                if len(fit_list):
+                    # Note: Ties go to the first tape in the list
+                    tape = min(fit_list, key=self.ledger.space_reserved)
+                    self.ledger.reserve(tape, virtual_machine.space_estimate)
+                    virtual_machine.planned_tape = tape
+                else:
+                    tape = None
+                    if self.retention is not None:
+                        # Free up space by pruning old backups
+                        tape = self.retention.reclaim(virtual_machine.space_estimate, tape_list)
+
+                    if tape is not None:
+                        self.ledger.reserve(tape, virtual_machine.space_estimate)
+                    else:
+                        unplaced_list.append(virtual_machine)
+                    virtual_machine.planned_tape = tape
+
+        return unplaced_list
+
+    def plan(self, vm_list):
+        """ Plans backup of all of the virtual machines, returns machines that need backup """
+        self._print('*** Planning Backup ***')
+        backup_list = [virtual_machine for virtual_machine in vm_list if virtual_machine.plan()]
+        unplaced_list = self.assign(backup_list)
+
+        self.report(backup_list)
+        if len(unplaced_list):
+            self._print('Tapes are full! Virtual machines that do not fit: ' +
+                        ', '.join([virtual_machine.name for virtual_machine in unplaced_list]))
+
+        return backup_list
+
+    def report(self, backup_list):
+        """ Prints backup plan """
+        self._print('*** Backup Plan ***')
+        for virtual_machine in backup_list:
+            if virtual_machine.planned_tape is not None:
+                tape_name = os.path.basename(virtual_machine.planned_tape)
+            else:
+                tape_name = 'does not fit'
+
+            self._print('{0:<25} {1:>20} {2}'.format(
+                virtual_machine.name, file_system.print_memory_size(virtual_machine.space_estimate), tape_name))
+
+        for tape in self.ledger.tape_list():
+            self._print("Tape '" + os.path.basename(tape) + "' space left after backup: " +
+                        file_system.print_memory_size(self.ledger.space_available(tape)))
+
+    def report_estimates(self, backup_list, history, workers=1):
+        """ Prints copy time and suspend window estimates of the planned machines along with estimated run time """
+        self._print('*** Time Estimates ***')
+        self._print('{0:<25} {1:>20} {2:<15} {3:>10} {4:>10}'.format('name', 'size', 'tape', 'copy', 'suspended'))
+
+        worker_loads = [0.0] * max(1, workers)
+        estimated = True
+        for virtual_machine in sorted(backup_list, key=lambda vm: vm.space_estimate, reverse=True):
+            copy_time, suspend_window = virtual_machine.estimate_times(history)
+            if virtual_machine.planned_tape is not None:
+                tape_name = os.path.basename(virtual_machine.planned_tape)
+                if copy_time is not None:
+                    # Longest copies go first, each one to the least loaded worker
+                    worker_loads[worker_loads.index(min(worker_loads))] += copy_time
+                else:
+                    estimated = False
+            else:
+                tape_name = 'does not fit'
+
+            self._print('{0:<25} {1:>20} {2:<15} {3:>10} {4:>10}'.format(
+                virtual_machine.name, file_system.print_memory_size(virtual_machine.space_estimate), tape_name,
+                print_duration(copy_time) if copy_time is not None else 'unknown',
+                print_duration(suspend_window) if suspend_window is not None else 'unknown'))
+
+        if not history.runs or history.throughput() is None:
+            self._print('No throughput has been recorded by earlier runs yet, time estimates are not available')
+        elif estimated:
+            self._print('Estimated run time: ' + print_duration(max(worker_loads)) + ' (' + str(len(worker_loads)) +
+                        ' backup workers, ' + file_system.print_memory_size(history.throughput()) +
+                        '/s average throughput of the last ' + str(history.runs) + ' runs)')
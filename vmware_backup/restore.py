@@ -0,0 +1,216 @@
+"""
+Backup Restore Class
+Restores virtual machine from its backup. Files are streamed back from the tapes using pool of worker threads and
+verified against checksums recorded during the backup on the way. Blocks of zeros of virtual disk files are not
+written, so restored disks are sparse
+"""
+
+
+### INCLUDES ###
+import os
+import io
+import sys
+import glob
+import time
+import shutil
+
+from py_knife import file_system
+
+from .default_settings import LOG_TS_FORMAT, PRINT_LOCK
+from .copy_engine import CopyEngine, CopyStats, MEGA_BYTE, SPARSE_BLOCK_SIZE, write_all, disk_file
+from .tapes import TapeLedger, fetch_tape_list, fetch_tape
+from .chunk_store import ChunkStore
+from .catalog import BackupCatalog
+from .journal import incomplete_backup
+from .backup_reader import BackupReader
+
+
+### CONSTANTS ###
+## Copy Methods ##
+METHOD_RESTORE = 'restore'
+
+
+### FUNCTIONS ###
+def find_backups(settings, vm_name):
+    """ Finds completed backups of particular virtual machine across all tapes, latest backups first """
+    vm_base_name = os.path.basename(settings['vms_path'])
+
+    backup_list = []
+    for tape in fetch_tape_list(settings):
+        for backup_path in glob.glob(os.path.join(tape, vm_base_name + '*', vm_name)):
+            if os.path.isdir(backup_path) and not incomplete_backup(backup_path):
+                backup_ts = os.path.basename(os.path.dirname(backup_path))[len(vm_base_name):]
+                backup_list.append((os.path.getmtime(backup_path), backup_ts, backup_path))
+
+    return [(backup_ts, backup_path) for created, backup_ts, backup_path in sorted(backup_list, reverse=True)]
+
+
+def execute_restore(settings, vm_name, backup_date=None, target_path=None):
+    """ Restore Virtual Machine Routine """
+    backup_restore = BackupRestore(settings)
+    return backup_restore.restore(vm_name, backup_date, target_path)
+
+
+### CLASSES ###
+class BackupRestore(object):
+    """ Backup Restore class """
+    def __init__(self, settings):
+        self.settings = settings
+        self.buffer_size = max(1, int(settings['copy_buffer_mb'])) * MEGA_BYTE
+        self.copy_engine = CopyEngine(settings, self._print)
+        self.chunk_store = ChunkStore(settings)
+        self.ledger = TapeLedger(settings)
+
+    ## Internal Methods ##
+    def _print(self, message):
+        # Time Stamp Options 1 and 2
+        if 'log_ts_format' in self.settings:
+            time_stamp = file_system.create_time_stamp(self.settings['log_ts_format'])
+        else:
+            time_stamp = file_system.create_time_stamp(LOG_TS_FORMAT)
+
+        with PRINT_LOCK:
+            print time_stamp, str(message)
+
+    def _catalog_backups(self, vm_name):
+        """ Returns list of cataloged backups of particular virtual machine (time stamp and path), latest first """
+        backup_list = []
+        if self.settings['_catalog_path'] and os.path.isfile(self.settings['_catalog_path']):
+            catalog = BackupCatalog(self.settings, self.settings['_catalog_path'])
+            try:
+                backup_list = [(backup['backup_ts'], backup['backup_path']) for backup in catalog.backups(vm_name)
+                               if os.path.isdir(backup['backup_path'])]
+            finally:
+                catalog.close()
+
+        return backup_list
+
+    def _tape_backups(self, vm_name):
+        """ Returns list of backups of particular virtual machine found on the tapes, latest first """
+        return find_backups(self.settings, vm_name)
+
+    def _restore_file(self, reader, relative_path, destination_file_path):
+        """ Restores single file, returns copy statistics and error message (None if file is intact) """
+        stats = CopyStats(os.path.join(reader.backup_path, relative_path), destination_file_path)
+        stats.method = METHOD_RESTORE
+        start_time = time.time()
+
+        sparse = disk_file(relative_path)
+        zero_view = memoryview(bytearray(SPARSE_BLOCK_SIZE))
+
+        with io.open(destination_file_path, 'wb', buffering=0) as destination_file:
+            def write_data(data):
+                data_view = memoryview(data)
+                if not sparse:
+                    write_all(destination_file, data_view)
+                    stats.bytes_written += len(data_view)
+                else:
+                    # Blocks of zeros are skipped, those are left as holes
+                    for block_start in xrange(0, len(data_view), SPARSE_BLOCK_SIZE):
+                        block_view = data_view[block_start:block_start + SPARSE_BLOCK_SIZE]
+                        if block_view != zero_view[:len(block_view)]:
+                            destination_file.seek(stats.bytes_copied + block_start)
+                            write_all(destination_file, block_view)
+                            stats.bytes_written += len(block_view)
+
+                stats.bytes_copied += len(data_view)
+
+            try:
+                error = reader.verify(relative_path, write_data)
+            except:
+                # Missing files, corrupted compressed streams and etc.
+                error = str(sys.exc_info()[1])
+
+            # Restored file gets its size, holes at the end included
+            destination_file.truncate(stats.bytes_copied)
+
+        if error is None:
+            # Restored file gets modification time (and permissions) of the original file
+            backup_file_path = reader.backup_file(relative_path)
+            if backup_file_path is not None:
+                shutil.copystat(backup_file_path, destination_file_path)
+            elif reader.mtime(relative_path) is not None:
+                os.utime(destination_file_path, (time.time(), reader.mtime(relative_path)))
+
+        stats.duration = time.time() - start_time
+
+        if error is None:
+            self._print(str(stats))
+        else:
+            self._print("Restore of '" + relative_path + "' failed: " + error)
+
+        return stats, error
+
+    ## External Methods ##
+    def find(self, vm_name, backup_date=None):
+        """ Returns path of the latest backup of particular virtual machine (made on particular date),
+        None if there is no such backup """
+        # Note: Catalog might be disabled or out of date, scanning the tapes if it does not have a match
+        for backup_list_func in (self._catalog_backups, self._tape_backups):
+            for backup_ts, backup_path in backup_list_func(vm_name):
+                if backup_date is None or backup_date in backup_ts:
+                    return backup_path
+
+        return None
+
+    def restore(self, vm_name, backup_date=None, target_path=None):
+        """ Restores virtual machine, returns True if every file has been restored and verified """
+        backup_path = self.find(vm_name, backup_date)
+        if backup_path is None:
+            self._print("Could not find backup of '" + vm_name + "' virtual machine" +
+                        (" made on '" + backup_date + "'" if backup_date is not None else '') + '!')
+            return False
+
+        if target_path is None:
+            target_path = self.settings['vms_path']
+        vm_restore_path = os.path.join(target_path, vm_name)
+
+        self._print('VM Name: ' + vm_name)
+        self._print('Backup Location: ' + backup_path)
+        self._print('Restore Location: ' + vm_restore_path)
+
+        if os.path.exists(vm_restore_path) and len(os.listdir(vm_restore_path)):
+            # Never overwrite existing machine
+            self._print('Restore location is not empty! Remove it or choose another restore target!')
+            return False
+
+        try:
+            reader = BackupReader(self.settings, backup_path, self.chunk_store, self.buffer_size)
+        except (IOError, OSError, ValueError) as e:
+            self._print('Could not read file list of "' + backup_path + '": ' + str(e))
+            return False
+
+        if reader.checksum is None:
+            self._print('Backup has no checksums, checking sizes only')
+
+        file_list = []
+        for relative_path in reader.files():
+            destination_file_path = os.path.join(vm_restore_path, relative_path)
+            file_system.make_dir(os.path.dirname(destination_file_path))
+            file_list.append((relative_path, destination_file_path))
+
+        def restore_file(relative_path, destination_file_path):
+            return self._restore_file(reader, relative_path, destination_file_path)
+
+        start_time = time.time()
+        try:
+            # Limit number of files read from the same tape at once
+            self.copy_engine.stream = self.ledger.stream(fetch_tape(self.settings, backup_path))
+            results = self.copy_engine.map_files(restore_file, file_list,
+                                                 [reader.size(relative_path) for relative_path in reader.files()])
+        finally:
+            self.copy_engine.close()
+
+        duration = time.time() - start_time
+        bytes_restored = sum([stats.bytes_copied for stats, error in results])
+        errors = len([error for stats, error in results if error is not None])
+
+        self._print('Restored ' + file_system.print_memory_size(bytes_restored) + ' in ' + '%.1fs' % duration +
+                    (' (' + file_system.print_memory_size(bytes_restored / duration) + '/s)' if duration > 0 else ''))
+
+        if errors:
+            self._print(str(errors) + ' of ' + str(len(results)) + ' files failed verification!')
+            return False
+
+        self._print('All files have been restored and verified!')
+        return True
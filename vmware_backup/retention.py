@@ -0,0 +1,339 @@
+"""
+Retention Engine Class
+Prunes backups that fall outside of the retention policy, so full tapes do not abort the backup run
+
+Policy keeps last N backups of each virtual machine and/or grandfather-father-son backups (latest backup of each of the
+last days, weeks and months). Backups are pruned all at once before the run or just in time, only when planned
+virtual machine does not fit on any tape. Latest backup of each machine, backups of the current run, incomplete
+backups and backups referenced by kept incremental backups are never pruned. Chunks of the pruned chunked backups
+are removed from the chunk store once none of the remaining backups refers to them.
+"""
+
+
+### INCLUDES ###
+import os
+import glob
+import time
+import shutil
+import datetime
+import threading
+
+from py_knife import file_system
+
+from .default_settings import PRUNE_MODE_OFF, PRUNE_MODE_BEFORE
+from .copy_engine import load_manifest
+from .tapes import fetch_tape_list, fetch_tape
+from .journal import incomplete_backup
+from .incremental import MANIFEST_NAME, tape_absolute_path
+from .chunk_store import ChunkStore, CHUNK_DIR_NAME, RECIPE_NAME, recipe_chunks, chunk_path
+
+
+### FUNCTIONS ###
+def backup_references(settings, backup_path):
+    """ Returns backup folders particular (incremental) backup reads its data from """
+    manifest_path = os.path.join(backup_path, MANIFEST_NAME)
+    if not os.path.isfile(manifest_path):
+        return set()
+
+    try:
+        manifest = load_manifest(manifest_path)
+    except (IOError, OSError, ValueError):
+        return set()
+
+    return set([os.path.abspath(os.path.dirname(tape_absolute_path(settings, source)))
+                for source in manifest.get('sources', [])])
+
+
+def chunk_references(settings):
+    """ Returns chunks each of the chunked backups across all tapes refers to """
+    references = {}
+    for tape in fetch_tape_list(settings):
+        for recipe_path in glob.glob(os.path.join(tape, '*', '*', RECIPE_NAME)):
+            backup_path = os.path.abspath(os.path.dirname(recipe_path))
+            references[backup_path] = recipe_chunks(backup_path)
+
+    return references
+
+
+def scan_backups(settings):
+    """ Finds completed backups of all virtual machines across all tapes (as dictionaries), latest backups first """
+    vm_base_name = os.path.basename(settings['vms_path'])
+
+    backup_list = []
+    for tape in fetch_tape_list(settings):
+        for base_backup_path in glob.glob(os.path.join(tape, vm_base_name + '*')):
+            if os.path.basename(base_backup_path) == CHUNK_DIR_NAME:
+                continue
+
+            backup_ts = os.path.basename(base_backup_path)[len(vm_base_name):]
+            for backup_path in glob.glob(os.path.join(base_backup_path, '*')):
+                if os.path.isdir(backup_path) and not incomplete_backup(backup_path):
+                    backup_list.append({'vm_name': os.path.basename(backup_path), 'backup_path': backup_path,
+                                        'tape': tape, 'backup_ts': backup_ts,
+                                        'created': os.path.getmtime(backup_path)})
+
+    return sorted(backup_list, key=lambda backup: backup['created'], reverse=True)
+
+
+### CLASSES ###
+class RetentionPolicy(object):
+    """ Retention Policy class. Zero disables particular rule, policy without any rules keeps everything """
+    def __init__(self, keep_last=0, keep_daily=0, keep_weekly=0, keep_monthly=0):
+        self.keep_last = keep_last
+        self.keep_daily = keep_daily
+        self.keep_weekly = keep_weekly
+        self.keep_monthly = keep_monthly
+
+    def __str__(self):
+        rules = []
+        for rule_name in ('last', 'daily', 'weekly', 'monthly'):
+            rule_value = getattr(self, 'keep_' + rule_name)
+            if rule_value:
+                rules.append(rule_name + ' ' + str(rule_value))
+
+        return ', '.join(rules) if len(rules) else 'keep everything'
+
+    ## Internal Methods ##
+    def _keep_periods(self, backup_list, period_func, periods):
+        """ Keeps latest backup of each of the last periods (days, weeks or months) """
+        kept = set()
+        kept_periods = set()
+        for backup in backup_list:
+            period = period_func(datetime.date.fromtimestamp(backup['created']))
+            if period not in kept_periods:
+                if len(kept_periods) >= periods:
+                    break
+                kept_periods.add(period)
+                kept.add(backup['backup_path'])
+
+        return kept
+
+    ## External Methods ##
+    def enabled(self):
+        """ Tells if any of the rules is set """
+        return bool(self.keep_last or self.keep_daily or self.keep_weekly or self.keep_monthly)
+
+    def keep(self, backup_list):
+        """ Returns paths of the backups (of a single machine, latest first) kept by this policy """
+        if not self.enabled():
+            return set([backup['backup_path'] for backup in backup_list])
+
+        # Latest backup is always kept
+        kept = set([backup['backup_path'] for backup in backup_list[:max(1, self.keep_last)]])
+        kept |= self._keep_periods(backup_list, lambda date: date, self.keep_daily)
+        kept |= self._keep_periods(backup_list, lambda date: date.isocalendar()[:2], self.keep_weekly)
+        kept |= self._keep_periods(backup_list, lambda date: (date.year, date.month), self.keep_monthly)
+
+        return kept
+
+
+class RetentionEngine(object):
+    """ Retention Engine class. Single instance is shared by all of the virtual machines of the backup run """
+    def __init__(self, settings, ledger, catalog=None, print_func=None, chunk_store=None):
+        self.settings = settings
+        self.ledger = ledger
+        self.catalog = catalog
+        # Note: Chunk store has to be the one shared by the backups of the current run, so chunks they use are kept
+        self.chunk_store = chunk_store if chunk_store is not None else ChunkStore(settings)
+        self.print_func = print_func
+        self.mode = settings['prune_mode']
+        self.policy = RetentionPolicy(int(settings['keep_last']), int(settings['keep_daily']),
+                                      int(settings['keep_weekly']), int(settings['keep_monthly']))
+        self.lock = threading.RLock()
+        self.backups_pruned = 0
+        self.bytes_pruned = 0
+
+    ## Internal Methods ##
+    def _print(self, message):
+        if self.print_func is not None:
+            self.print_func(message)
+
+    def _backup_list(self):
+        """ Returns list of completed backups, latest first """
+        backup_list = []
+        if self.catalog is not None:
+            backup_list = [backup for backup in self.catalog.backups()
+                           if os.path.isdir(backup['backup_path']) and not incomplete_backup(backup['backup_path'])]
+            for backup in backup_list:
+                # Note: Catalog keeps tape path of the time backup has been made, tapes might be remounted since
+                backup['tape'] = fetch_tape(self.settings, backup['backup_path'])
+
+        # Note: Backups missing from the catalog still have to be accounted for, those might be referenced by others
+        cataloged = set([os.path.abspath(backup['backup_path']) for backup in backup_list])
+        backup_list.extend([backup for backup in scan_backups(self.settings)
+                            if os.path.abspath(backup['backup_path']) not in cataloged])
+
+        return sorted(backup_list, key=lambda backup: backup['created'], reverse=True)
+
+    def _prunable(self):
+        """ Returns list of backups outside of the retention policy (oldest first), backup folders each of the
+        backups reads its data from and chunks each of the chunked backups refers to """
+        backup_list = self._backup_list()
+        current_backup_name = os.path.basename(self.settings['vms_path']) + self.settings['_backup_ts']
+
+        vm_backups = {}
+        for backup in backup_list:
+            vm_backups.setdefault(backup['vm_name'], []).append(backup)
+
+        kept = set()
+        for vm_backup_list in vm_backups.values():
+            kept |= self.policy.keep(vm_backup_list)
+
+        prunable_list = []
+        for backup in reversed(backup_list):
+            backup_path = backup['backup_path']
+            if backup_path in kept:
+                continue
+
+            if os.path.basename(os.path.dirname(backup_path)) == current_backup_name:
+                # Made by the current run
+                continue
+
+            prunable_list.append(backup)
+
+        # Data of the incremental backups might be stored in the older backups
+        references = dict([(backup['backup_path'], backup_references(self.settings, backup['backup_path']))
+                           for backup in backup_list])
+
+        return prunable_list, references, chunk_references(self.settings)
+
+    def _referenced(self, backup, references):
+        """ Tells if any other backup reads its data from particular backup """
+        backup_path = os.path.abspath(backup['backup_path'])
+        for other_backup_path, backup_paths in references.items():
+            if other_backup_path != backup['backup_path'] and backup_path in backup_paths:
+                return True
+
+        return False
+
+    def _orphan_chunks(self, backup_list, chunks):
+        """ Returns chunks that none of the backups (except particular ones) refers to """
+        backup_paths = set([os.path.abspath(backup['backup_path']) for backup in backup_list])
+
+        orphan_chunks = set()
+        for backup_path in backup_paths:
+            orphan_chunks |= chunks.get(backup_path, set())
+
+        for backup_path, chunk_hashes in chunks.items():
+            if backup_path not in backup_paths:
+                orphan_chunks -= chunk_hashes
+
+        return orphan_chunks
+
+    def _freeable_size(self, tape, backup_list, chunks):
+        """ Returns space pruning of particular backups would free on particular tape """
+        freeable_size = sum([file_system.get_size(backup['backup_path']) for backup in backup_list
+                             if backup['tape'] == tape])
+
+        for chunk_hash in self._orphan_chunks(backup_list, chunks):
+            destination_path = chunk_path(tape, chunk_hash)
+            if os.path.isfile(destination_path) and not self.chunk_store.used(chunk_hash):
+                freeable_size += os.path.getsize(destination_path)
+
+        return freeable_size
+
+    def _prune_list(self, prunable_list, references, chunks, done_func=None):
+        """ Prunes backups (oldest first) until done, backups referenced by the remaining backups are skipped """
+        pending_list = list(prunable_list)
+        while len(pending_list):
+            pruned_list = []
+            for backup in pending_list:
+                if done_func is not None and done_func():
+                    return
+
+                if not self._referenced(backup, references):
+                    self._prune(backup, chunks)
+                    references.pop(backup['backup_path'], None)
+                    pruned_list.append(backup)
+
+            if not len(pruned_list):
+                break
+
+            pending_list = [backup for backup in pending_list if backup not in pruned_list]
+
+    def _prune(self, backup, chunks):
+        """ Removes single backup along with chunks nobody else refers to, returns number of bytes freed """
+        backup_path = backup['backup_path']
+        backup_size = file_system.get_size(backup_path)
+
+        try:
+            shutil.rmtree(backup_path)
+        except (IOError, OSError) as e:
+            self._print('Could not prune backup "' + backup_path + '": ' + str(e))
+            return 0
+
+        base_backup_path = os.path.dirname(backup_path)
+        if os.path.isdir(base_backup_path) and not len(os.listdir(base_backup_path)):
+            os.rmdir(base_backup_path)
+
+        if self.catalog is not None:
+            self.catalog.forget(backup_path)
+
+        chunks_freed = {}
+        orphan_chunks = self._orphan_chunks([backup], chunks)
+        chunks.pop(os.path.abspath(backup_path), None)
+        if len(orphan_chunks):
+            # Note: Chunks might be stored on the other tapes
+            chunks_freed = self.chunk_store.collect(orphan_chunks)
+            backup_size += sum(chunks_freed.values())
+
+        for tape in set([backup['tape']] + chunks_freed.keys()):
+            self.ledger.refresh(tape)
+
+        self.backups_pruned += 1
+        self.bytes_pruned += backup_size
+        self._print('Pruned backup "' + backup_path + '" made on ' +
+                    time.strftime('%Y-%m-%d %H:%M', time.localtime(backup['created'])) + ', freed ' +
+                    file_system.print_memory_size(backup_size))
+
+        return backup_size
+
+    ## External Methods ##
+    def enabled(self):
+        """ Tells if backups are pruned at all """
+        return self.mode != PRUNE_MODE_OFF and self.policy.enabled()
+
+    def prune(self):
+        """ Prunes all of the backups outside of the retention policy (if pruning before the run is requested) """
+        if not self.enabled() or self.mode != PRUNE_MODE_BEFORE:
+            return 0
+
+        with self.ledger.lock, self.lock:
+            self._print('Retention policy: ' + str(self.policy))
+            bytes_pruned = self.bytes_pruned
+            prunable_list, references, chunks = self._prunable()
+            self._prune_list(prunable_list, references, chunks)
+            bytes_freed = self.bytes_pruned - bytes_pruned
+            self._print('Backups pruned: ' + file_system.print_memory_size(bytes_freed) + ' freed')
+
+        return bytes_freed
+
+    def reclaim(self, space_needed, tape_list=None):
+        """ Prunes oldest backups outside of the retention policy until space needed is available on one of the
+        tapes, returns that tape (None if it is not possible) """
+        if not self.enabled():
+            return None
+
+        if tape_list is None:
+            tape_list = self.ledger.tape_list()
+
+        # Note: Locking order is the same as the order of the callers picking their tapes
+        with self.ledger.lock, self.lock:
+            prunable_list, references, chunks = self._prunable()
+            for tape in tape_list:
+                # Note: Backups on the other tapes might refer to the chunks stored on this tape
+                tape_prunable = [backup for backup in prunable_list
+                                 if backup['tape'] == tape or os.path.abspath(backup['backup_path']) in chunks]
+                prunable_size = self._freeable_size(tape, tape_prunable, chunks)
+                if self.ledger.space_available(tape) + prunable_size < space_needed:
+                    continue
+
+                self._print("Reclaiming space on tape '" + os.path.basename(tape) + "' (" +
+                            file_system.print_memory_size(space_needed) + ' needed)')
+                self._prune_list(tape_prunable, references, chunks,
+                                 lambda: self.ledger.space_available(tape) >= space_needed)
+
+                if self.ledger.space_available(tape) >= space_needed:
+                    return tape
+
+        return None
@@ -0,0 +1,131 @@
+"""
+Retry Policy Class
+Retries operations (suspend, resume, backup folder creation, backup itself) and waits for them to complete
+
+State of the machine is polled quickly at first and less often later on (exponential backoff), so fast operations are
+not delayed by a fixed wait and slow operations do not burn through attempts. Operation that is still in progress is
+waited for, operation is issued again only if it has failed. Each operation type has its own policy.
+"""
+
+
+### INCLUDES ###
+import time
+
+
+### CONSTANTS ###
+## Operation Outcomes ##
+OUTCOME_DONE = 'done'
+OUTCOME_IN_PROGRESS = 'in_progress'
+OUTCOME_FAILED = 'failed'
+
+## Backoff Settings ##
+BACKOFF_FACTOR = 2.0
+RETRY_SETTINGS_SUFFIX = '_retry'
+# Number of attempts, initial delay, maximum delay and deadline (in seconds, 0 for no deadline). Without deadline,
+# operation still in progress is polled for at most number of attempts times maximum delay
+RETRY_FIELDS = ('attempts', 'initial_delay', 'max_delay', 'deadline')
+
+
+### FUNCTIONS ###
+def _number(value):
+    """ Converts string to non negative number """
+    number = float(value)
+    if number < 0:
+        raise ValueError
+    return number
+
+
+def parse_retry(retry_string):
+    """ Parses retry string ('10,1,30,900'), returns retry policy """
+    retry_values = str(retry_string).split(',')
+    if len(retry_values) != len(RETRY_FIELDS):
+        raise ValueError('Retry string "' + str(retry_string) + '" is in incompatible format!')
+
+    try:
+        retry_values = [_number(retry_value.strip()) for retry_value in retry_values]
+    except ValueError:
+        raise ValueError('Retry string "' + str(retry_string) + '" is in incompatible format!')
+
+    attempts, initial_delay, max_delay, deadline = retry_values
+    if attempts < 1 or attempts != int(attempts) or initial_delay <= 0 or max_delay < initial_delay:
+        raise ValueError('Retry string "' + str(retry_string) + '" is out of range!')
+
+    return RetryPolicy(int(attempts), initial_delay, max_delay, deadline)
+
+
+def retry_policy(settings, operation):
+    """ Returns retry policy of particular operation """
+    return parse_retry(settings[operation + RETRY_SETTINGS_SUFFIX])
+
+
+### CLASSES ###
+class RetryPolicy(object):
+    """ Retry Policy class """
+    def __init__(self, attempts, initial_delay, max_delay, deadline=0):
+        self.attempts = attempts
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def __str__(self):
+        return ','.join(['{0:g}'.format(getattr(self, retry_field)) for retry_field in RETRY_FIELDS])
+
+    ## External Methods ##
+    def delays(self):
+        """ Generates delays between consecutive polls """
+        delay = self.initial_delay
+        while True:
+            yield delay
+            delay = min(self.max_delay, delay * BACKOFF_FACTOR)
+
+    def run(self, action, poll=None):
+        """ Executes action until it is done. Action is called with attempt number, poll without arguments, both
+        return operation outcome. Returns number of attempts made if operation is done, zero otherwise """
+        deadline = None
+        if self.deadline > 0:
+            deadline = time.time() + self.deadline
+
+        # Note: Machine that never reaches the expected state is not polled forever
+        poll_deadline = None
+
+        delays = self.delays()
+        attempts = 0
+        outcome = OUTCOME_FAILED
+        while True:
+            if outcome == OUTCOME_FAILED:
+                if attempts >= self.attempts:
+                    break
+
+                attempts += 1
+                outcome = action(attempts)
+                poll_deadline = None
+            else:
+                outcome = poll()
+
+            if outcome == OUTCOME_DONE:
+                return attempts
+
+            if outcome == OUTCOME_IN_PROGRESS and poll is None:
+                # Nothing to poll, consider it failed
+                outcome = OUTCOME_FAILED
+
+            delay = next(delays)
+            if deadline is None and outcome == OUTCOME_IN_PROGRESS:
+                if poll_deadline is None:
+                    poll_deadline = time.time() + self.attempts * self.max_delay
+
+                delay = min(delay, poll_deadline - time.time())
+                if delay <= 0:
+                    break
+
+            if deadline is not None:
+                delay = min(delay, deadline - time.time())
+                if delay <= 0:
+                    break
+
+            if outcome == OUTCOME_FAILED and attempts >= self.attempts:
+                break
+
+            time.sleep(delay)
+
+        return 0
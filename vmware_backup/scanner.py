@@ -0,0 +1,135 @@
+"""
+Directory Scanner
+Walks virtual machine folder once and keeps compact list of its files, so sizing, change detection and copying do not
+walk the same folder over and over again
+"""
+
+
+### INCLUDES ###
+import os
+import stat
+import collections
+
+from py_knife import file_system
+
+
+### CONSTANTS ###
+## Directory Scanner ##
+# Python 2 does not have os.scandir, scandir package provides the same call
+SCANDIR = getattr(os, 'scandir', None)
+if SCANDIR is None:
+    try:
+        from scandir import scandir as SCANDIR
+    except ImportError:
+        SCANDIR = None
+
+## Scan Entry ##
+# Allocated size is the space file actually takes up (sparse files take up less than their size)
+ScanEntry = collections.namedtuple('ScanEntry', ('path', 'size', 'mtime', 'allocated'))
+
+# Unit of the st_blocks stat field
+STAT_BLOCK_SIZE = 512
+
+
+### FUNCTIONS ###
+def _scan_entry(file_path, file_stat):
+    """ Creates scan entry out of file stat """
+    # Note: Windows does not report allocated blocks, files are considered fully allocated there
+    allocated = file_stat.st_size
+    if getattr(file_stat, 'st_blocks', None) is not None:
+        allocated = min(allocated, file_stat.st_blocks * STAT_BLOCK_SIZE)
+
+    return ScanEntry(file_path, file_stat.st_size, file_stat.st_mtime, allocated)
+
+
+def scan_dir(path):
+    """ Walks directory recursively (in name order), yields scan entry of each file """
+    if SCANDIR is not None:
+        for dir_entry in sorted(SCANDIR(path), key=lambda _dir_entry: _dir_entry.name):
+            try:
+                if dir_entry.is_dir(follow_symlinks=False):
+                    for scan_entry in scan_dir(dir_entry.path):
+                        yield scan_entry
+
+                elif dir_entry.is_file():
+                    yield _scan_entry(dir_entry.path, dir_entry.stat())
+
+            except OSError:
+                # File is gone already (lock files of the running machine and etc.)
+                continue
+
+    else:
+        for item_name in sorted(os.listdir(path)):
+            item_path = os.path.join(path, item_name)
+            try:
+                item_stat = os.lstat(item_path)
+                if stat.S_ISDIR(item_stat.st_mode):
+                    for scan_entry in scan_dir(item_path):
+                        yield scan_entry
+                    continue
+
+                if stat.S_ISLNK(item_stat.st_mode):
+                    item_stat = os.stat(item_path)
+
+                if stat.S_ISREG(item_stat.st_mode):
+                    yield _scan_entry(item_path, item_stat)
+
+            except OSError:
+                continue
+
+
+def scan_size(scan_entries, allocated=False):
+    """ Returns total size (or allocated size) of scanned files """
+    # Note: Hard linked files are counted every time, since each one of them is copied
+    total_size = 0
+    for scan_entry in scan_entries:
+        total_size += scan_entry.allocated if allocated else scan_entry.size
+
+    return total_size
+
+
+def destination_list(source_path, destination_path, scan_entries):
+    """ Pairs scanned files with their destinations, creates destination folders """
+    file_list = []
+    destination_dirs = set()
+    for scan_entry in scan_entries:
+        destination_file = os.path.join(destination_path, os.path.relpath(scan_entry.path, source_path))
+        destination_dir = os.path.dirname(destination_file)
+        if destination_dir not in destination_dirs:
+            file_system.make_dir(destination_dir)
+            destination_dirs.add(destination_dir)
+
+        file_list.append((scan_entry.path, destination_file))
+
+    return file_list
+
+
+### CLASSES ###
+class DirectoryScan(object):
+    """ Directory Scan class. Directory is scanned on first use, scan is kept until it is invalidated """
+    def __init__(self, path):
+        self.path = path
+        self.scans = 0
+
+        self._entries = None
+
+    def entries(self):
+        """ Returns list of scan entries """
+        if self._entries is None:
+            self._entries = list(scan_dir(self.path))
+            self.scans += 1
+
+        return self._entries
+
+    def size(self, allocated=False):
+        """ Returns total size of the directory (or space its files actually take up) """
+        return scan_size(self.entries(), allocated)
+
+    def top_files(self, extension):
+        """ Returns paths of files with particular extension located right in the directory (not in sub folders) """
+        return [scan_entry.path for scan_entry in self.entries()
+                if os.path.dirname(scan_entry.path) == self.path and scan_entry.path.endswith(extension)]
+
+    def invalidate(self):
+        """ Drops scan. Has to be called whenever directory content might have changed (machine is suspended) """
+        self._entries = None
@@ -0,0 +1,310 @@
+"""
+Backup Scheduler Class
+Backs up several virtual machines at once using a pool of worker threads
+"""
+
+
+### INCLUDES ###
+import sys
+import time
+import Queue
+import threading
+
+from py_knife import file_system
+from py_knife.ordered_dict import OrderedDict
+
+from .default_settings import LOG_TS_FORMAT, PRINT_LOCK
+from .tapes import TapeLedger
+from .chunk_store import ChunkStore
+from .catalog import BackupCatalog
+from .vmrun import VmrunState
+from .planner import BackupPlanner
+from .verify import BackupVerifier
+from .metrics import METRICS_VERSION, save_metrics, save_prometheus
+from .throttle import BandwidthLimiter, lower_priority
+from .pipeline import BufferPool
+from .retention import RetentionEngine
+
+
+### CONSTANTS ###
+## Backup Results ##
+BACKUP_COMPLETED = 'completed'
+BACKUP_FAILED = 'failed'
+BACKUP_NOT_NEEDED = 'not needed'
+BACKUP_ABORTED = 'aborted'
+BACKUP_NO_SPACE = 'no space'
+BACKUP_VERIFY_FAILED = 'verify failed'
+
+
+### CLASSES ###
+class BackupScheduler(object):
+    """ Backup Scheduler class """
+    def __init__(self, settings, vm_list):
+        self.settings = settings
+        self.vm_list = vm_list
+        self.workers = max(1, int(settings['backup_workers']))
+        self.ledger = TapeLedger(settings, settings['tape_workers'])
+        self.chunk_store = ChunkStore(settings)
+        self.limiter = BandwidthLimiter(settings)
+        self.buffer_pool = BufferPool(settings)
+        self.catalog = None
+        self.verifier = None
+        self.retention = None
+        self.vmrun_state = VmrunState(settings, self._print)
+        self.results = OrderedDict()
+        self.start_time = None
+
+        self._queue = Queue.Queue()
+        self._abort = threading.Event()
+        self._close_catalog = False
+
+    ## Internal Methods ##
+    def _print(self, message):
+        # Time Stamp Options 1 and 2
+        if 'log_ts_format' in self.settings:
+            time_stamp = file_system.create_time_stamp(self.settings['log_ts_format'])
+        else:
+            time_stamp = file_system.create_time_stamp(LOG_TS_FORMAT)
+
+        with PRINT_LOCK:
+            print time_stamp, str(message)
+
+    def _worker(self):
+        """ Worker thread, backs up virtual machines until the queue is empty """
+        while True:
+            try:
+                virtual_machine = self._queue.get_nowait()
+            except Queue.Empty:
+                break
+
+            result = self.results[virtual_machine.name]
+            if self._abort.is_set():
+                result['status'] = BACKUP_ABORTED
+                continue
+
+            if virtual_machine.planned_tape is None:
+                # Does not fit on any tape, skip it so the rest of the machines are still backed up
+                result['status'] = BACKUP_NO_SPACE
+                continue
+
+            start_time = time.time()
+            try:
+                backup_completed = virtual_machine.backup()
+
+            except SystemExit:
+                # Virtual machine requested to stop the whole run (tapes are full and etc.)
+                result['status'] = BACKUP_FAILED
+                self._abort.set()
+            except:
+                result['status'] = BACKUP_FAILED
+                virtual_machine.resume()
+                self._print("Virtual Machine '" + virtual_machine.name + "' backup failed due to an error: " +
+                            str(sys.exc_info()[0]))
+            else:
+                if backup_completed is None:
+                    result['status'] = BACKUP_NOT_NEEDED
+                elif backup_completed:
+                    result['status'] = BACKUP_COMPLETED
+                    if self.verifier is not None:
+                        self.verifier.submit(virtual_machine.name, virtual_machine.vm_backup_path,
+                                             virtual_machine.log_prefix)
+                else:
+                    result['status'] = BACKUP_FAILED
+
+            result['duration'] = time.time() - start_time
+            result['suspend_window'] = virtual_machine.suspend_window
+            result['location'] = virtual_machine.vm_backup_path
+
+    def _open_catalog(self):
+        """ Opens backup catalog (if enabled), catalog is rebuilt from the tapes if it is empty """
+        # Note: Daemon keeps its catalog open between the backup runs
+        if self.catalog is None and self.settings['_catalog_path']:
+            self.catalog = BackupCatalog(self.settings, self.settings['_catalog_path'])
+            self._close_catalog = True
+            if self.catalog.empty():
+                self._print('Backup catalog is empty! Rebuilding it from the tapes...')
+                self.catalog.rebuild(self._print)
+
+    def _wait_resumes(self):
+        """ Waits for virtual machines resumed in the background """
+        for virtual_machine in self.vm_list:
+            try:
+                virtual_machine.wait_resume()
+            except:
+                self._print("Virtual Machine '" + virtual_machine.name + "' resume failed due to an error: " +
+                            str(sys.exc_info()[0]))
+
+            if virtual_machine.name in self.results:
+                self.results[virtual_machine.name]['suspend_window'] = virtual_machine.suspend_window
+
+        self.vmrun_state.driver.close()
+
+    def _verify_results(self):
+        """ Waits for verification of completed backups, failed backups are removed from the catalog """
+        for vm_name, backup_intact in self.verifier.join().items():
+            result = self.results[vm_name]
+            result['verified'] = backup_intact
+            if not backup_intact:
+                result['status'] = BACKUP_VERIFY_FAILED
+                if self.catalog is not None:
+                    # Machine has to be backed up again next time
+                    self.catalog.forget(result['location'])
+
+    def _save_metrics(self):
+        """ Saves metrics of this backup run (JSON summary and Prometheus textfile) """
+        vms = OrderedDict()
+        for virtual_machine in self.vm_list:
+            result = self.results[virtual_machine.name]
+            vm = vms[virtual_machine.name] = OrderedDict()
+            vm['status'] = result['status']
+            vm['location'] = result['location']
+            vm['verified'] = result['verified']
+            vm.update(virtual_machine.metrics)
+            vm['duration'] = result['duration']
+            vm['suspend_window'] = result['suspend_window']
+
+        run = OrderedDict()
+        run['backup_ts'] = self.settings['_backup_ts']
+        run['start_time'] = self.start_time
+        run['duration'] = time.time() - self.start_time
+        run['bytes_copied'] = sum([vm['bytes_copied'] for vm in vms.values()])
+        run['bytes_written'] = sum([vm['bytes_written'] for vm in vms.values()])
+        run['vmrun_list_calls'] = self.vmrun_state.calls
+        run['vmrun_calls'] = sum(self.vmrun_state.driver.calls.values())
+        run['vmrun_timeouts'] = self.vmrun_state.driver.timeouts
+        run['backups_pruned'] = self.retention.backups_pruned
+        run['bytes_pruned'] = self.retention.bytes_pruned
+        run['buffer_memory'] = self.buffer_pool.memory()
+        run['directory_scans'] = sum([virtual_machine.scan.scans for virtual_machine in self.vm_list])
+        run['backup_workers'] = self.workers
+        run['tape_workers'] = self.ledger.tape_workers
+
+        metrics = OrderedDict([('version', METRICS_VERSION), ('run', run), ('vms', vms)])
+
+        for metrics_path, save_func in ((self.settings['_metrics_path'], save_metrics),
+                                        (self.settings['prometheus_file'], save_prometheus)):
+            if metrics_path:
+                try:
+                    save_func(metrics_path, metrics)
+                except (IOError, OSError) as e:
+                    self._print('Could not save metrics to "' + metrics_path + '": ' + str(e))
+
+        return metrics
+
+    ## External Methods ##
+    def run(self):
+        """ Backs up all of the virtual machines and returns results """
+        self.start_time = time.time()
+        self.vmrun_state.reset_counters()
+        self._open_catalog()
+
+        # Backups outside of the retention policy are pruned before (or during) planning
+        self.retention = RetentionEngine(self.settings, self.ledger, self.catalog, self._print, self.chunk_store)
+        self.retention.prune()
+
+        # Note: Has to be done before any threads are started, those inherit priority
+        lower_priority(self.settings, self._print)
+        if self.limiter.enabled():
+            self._print('Bandwidth limits: ' + str(self.limiter))
+        if self.settings['pipeline_copy']:
+            self._print('Copy pipeline: ' + str(self.buffer_pool) + ' shared by all of the copies')
+
+        if self.settings['verify_backup']:
+            # Backups are verified in the background while other machines are being backed up
+            self.verifier = BackupVerifier(self.settings, self.chunk_store, self._print)
+            self.verifier.start()
+
+        for virtual_machine in self.vm_list:
+            virtual_machine.ledger = self.ledger
+            virtual_machine.chunk_store = self.chunk_store
+            virtual_machine.copy_engine.limiter = self.limiter
+            virtual_machine.copy_engine.buffer_pool = self.buffer_pool
+            virtual_machine.catalog = self.catalog
+            virtual_machine.retention = self.retention
+            virtual_machine.vmrun_state = self.vmrun_state
+            virtual_machine.async_resume = True
+            if self.workers > 1:
+                virtual_machine.log_prefix = '[' + virtual_machine.name + '] '
+
+            self.results[virtual_machine.name] = {'status': BACKUP_ABORTED, 'duration': 0.0, 'suspend_window': 0.0,
+                                                 'location': None, 'verified': None}
+
+        # Size everything and assign tapes before any copying starts
+        backup_list = BackupPlanner(self.ledger, self._print, self.retention).plan(self.vm_list)
+        for virtual_machine in self.vm_list:
+            if virtual_machine in backup_list:
+                self._queue.put(virtual_machine)
+            else:
+                self.results[virtual_machine.name]['status'] = BACKUP_NOT_NEEDED
+
+        self._print('Backup Workers: ' + str(self.workers) + ', Tape Workers: ' + str(self.ledger.tape_workers))
+
+        worker_list = []
+        for worker_index in range(min(self.workers, len(backup_list))):
+            worker = threading.Thread(target=self._worker, name='backup_worker_' + str(worker_index))
+            worker.daemon = True
+            worker.start()
+            worker_list.append(worker)
+
+        # Note: Joining with timeout so main thread still responds to KeyboardInterrupt
+        for worker in worker_list:
+            while worker.is_alive():
+                worker.join(1)
+
+        self._wait_resumes()
+
+        if self.verifier is not None:
+            self._verify_results()
+
+        if self.catalog is not None and self._close_catalog:
+            self.catalog.close()
+
+        self._print('vmrun list calls: ' + str(self.vmrun_state.calls))
+        self._print('vmrun calls: ' + ', '.join([command + ': ' + str(count) for command, count in
+                                                 sorted(self.vmrun_state.driver.calls.items())]) +
+                    ', timeouts: ' + str(self.vmrun_state.driver.timeouts))
+        self._print('Directory scans: ' + str(sum([virtual_machine.scan.scans for virtual_machine in self.vm_list])))
+        self._save_metrics()
+        self.report()
+
+        return self.results
+
+    def dry_run(self, history):
+        """ Plans backup and estimates its duration using throughput history, returns machines that need backup.
+        Machines are neither suspended nor copied """
+        self._open_catalog()
+        self.vmrun_state.reset_counters()
+
+        for virtual_machine in self.vm_list:
+            virtual_machine.ledger = self.ledger
+            virtual_machine.catalog = self.catalog
+            virtual_machine.vmrun_state = self.vmrun_state
+
+        # Note: Backups are not pruned during dry run, machines that do not fit are reported as such
+        planner = BackupPlanner(self.ledger, self._print)
+        backup_list = planner.plan(self.vm_list)
+        planner.report_estimates(backup_list, history, self.workers)
+
+        self.vmrun_state.driver.close()
+        if self.catalog is not None and self._close_catalog:
+            self.catalog.close()
+
+        return backup_list
+
+    def abort(self):
+        """ Aborts backup run, machines being backed up are finished, the rest of the machines are skipped """
+        self._print('Aborting backup run...')
+        self._abort.set()
+
+    def aborted(self):
+        """ Tells if backup run has been aborted """
+        return self._abort.is_set()
+
+    def report(self):
+        """ Prints backup results """
+        self._print('*** Backup Results ***')
+        self._print('{0:<25} {1:<13} {2:>10} {3:>10} {4}'.format('name', 'status', 'duration', 'suspended', 'location'))
+        for vm_name, result in self.results.items():
+            self._print('{0:<25} {1:<13} {2:>10} {3:>10} {4}'.format(
+                vm_name, result['status'], '%.1fs' % result['duration'], '%.1fs' % result['suspend_window'],
+                str(result['location'] or '')))
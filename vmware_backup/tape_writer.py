@@ -0,0 +1,178 @@
+"""
+Tape Writer Class
+Writes backup files to the tapes in large aligned blocks
+
+LTO drives stream data only as long as it keeps coming. Short writes make the drive stop and rewind over and over
+again (shoe-shining), so writes to the tape are collected into large blocks first. Optionally blocks are written with
+O_DIRECT, bypassing page cache altogether. Source files are read with page cache hints (sequential access, pages that
+have been read are dropped), so nightly backup does not push pages of the running machines out of the cache.
+"""
+
+
+### INCLUDES ###
+import os
+import ctypes
+import ctypes.util
+
+try:
+    import fcntl
+except ImportError:
+    # Not a posix system
+    fcntl = None
+
+
+### CONSTANTS ###
+## Direct I/O ##
+O_DIRECT = getattr(os, 'O_DIRECT', None)
+
+## Page Cache Hints ##
+# Python 2 does not have os.posix_fadvise, the same call is made to the C library directly
+POSIX_FADVISE = getattr(os, 'posix_fadvise', None)
+if POSIX_FADVISE is None and os.name == 'posix':
+    try:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _libc_fadvise = getattr(_libc, 'posix_fadvise64', None) or _libc.posix_fadvise
+        _libc_fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+
+        def POSIX_FADVISE(file_descriptor, offset, length, advice):
+            error_code = _libc_fadvise(file_descriptor, offset, length, advice)
+            if error_code:
+                raise OSError(error_code, os.strerror(error_code))
+
+    except (OSError, AttributeError):
+        POSIX_FADVISE = None
+
+# Values below are the ones used by Linux
+POSIX_FADV_SEQUENTIAL = getattr(os, 'POSIX_FADV_SEQUENTIAL', 2)
+POSIX_FADV_DONTNEED = getattr(os, 'POSIX_FADV_DONTNEED', 4)
+
+KILO_BYTE = 1024
+
+
+### FUNCTIONS ###
+def advise(file_descriptor, offset, length, advice):
+    """ Gives page cache hint about particular range of the file (zero length means till the end of the file).
+    Hints are optional, so those are silently skipped if not supported """
+    if POSIX_FADVISE is None:
+        return
+
+    try:
+        POSIX_FADVISE(file_descriptor, offset, length, advice)
+    except OSError:
+        pass
+
+
+def aligned_buffer(size, alignment):
+    """ Returns writable buffer view with aligned address (direct I/O requires those) """
+    raw_buffer = bytearray(size + alignment)
+    address = ctypes.addressof(ctypes.c_char.from_buffer(raw_buffer))
+    start = -address % alignment
+
+    # Note: View keeps raw buffer alive
+    return memoryview(raw_buffer)[start:start + size]
+
+
+### CLASSES ###
+class TapeWriter(object):
+    """ Tape Writer class. Wraps destination file, writes are collected into large aligned blocks """
+    def __init__(self, destination_file, settings):
+        self.destination_file = destination_file
+        self.alignment = max(1, int(settings['write_alignment']))
+        block_size = max(1, int(settings['write_block_kb'])) * KILO_BYTE
+        # Block size is rounded up to the alignment
+        self.block_size = -(-block_size // self.alignment) * self.alignment
+        self.direct = False
+        self.blocks_written = 0
+
+        self._block = aligned_buffer(self.block_size, self.alignment)
+        self._block_used = 0
+        self._position = destination_file.tell()
+        self._direct_enabled = False
+
+        if settings['direct_io']:
+            # Note: Falls back to page cache if file system does not support direct I/O
+            self.direct = self._set_direct(True)
+
+    ## Internal Methods ##
+    def _set_direct(self, enabled):
+        """ Turns direct I/O of the destination file on or off, returns False if it can not be done """
+        if enabled == self._direct_enabled:
+            return True
+
+        if O_DIRECT is None or fcntl is None:
+            return False
+
+        file_descriptor = self.destination_file.fileno()
+        try:
+            flags = fcntl.fcntl(file_descriptor, fcntl.F_GETFL)
+            flags = flags | O_DIRECT if enabled else flags & ~O_DIRECT
+            fcntl.fcntl(file_descriptor, fcntl.F_SETFL, flags)
+        except (IOError, OSError):
+            return False
+
+        self._direct_enabled = enabled
+        return True
+
+    def _write_block(self, block_view):
+        """ Writes block at the current position """
+        if self.direct:
+            # Note: Direct I/O requires aligned position and size, tail of the file is written through page cache
+            self._set_direct(not self._position % self.alignment and not len(block_view) % self.alignment)
+
+        bytes_written = 0
+        while bytes_written < len(block_view):
+            bytes_written += self.destination_file.write(block_view[bytes_written:])
+
+        if not self._direct_enabled:
+            # Start writing block out right away instead of keeping it in the page cache
+            advise(self.destination_file.fileno(), self._position, len(block_view), POSIX_FADV_DONTNEED)
+
+        self._position += len(block_view)
+        self.blocks_written += 1
+
+    ## External Methods ##
+    def write(self, data):
+        """ Collects data into blocks, full blocks are written out. Returns size of the data """
+        data_view = memoryview(data)
+        data_offset = 0
+        while data_offset < len(data_view):
+            if not self._block_used and not self.direct and len(data_view) - data_offset >= self.block_size:
+                # Whole blocks are written as they are (direct I/O still needs those copied to aligned buffer)
+                count = (len(data_view) - data_offset) // self.block_size * self.block_size
+                self._write_block(data_view[data_offset:data_offset + count])
+            else:
+                count = min(self.block_size - self._block_used, len(data_view) - data_offset)
+                self._block[self._block_used:self._block_used + count] = data_view[data_offset:data_offset + count]
+                self._block_used += count
+                if self._block_used == self.block_size:
+                    self.flush()
+
+            data_offset += count
+
+        return len(data_view)
+
+    def flush(self):
+        """ Writes out partially filled block """
+        if self._block_used:
+            block_used = self._block_used
+            self._block_used = 0
+            self._write_block(self._block[:block_used])
+
+    def seek(self, offset):
+        """ Changes position of the next write """
+        self.flush()
+        self._position = self.destination_file.seek(offset)
+        return self._position
+
+    def tell(self):
+        """ Returns position of the next write """
+        return self._position + self._block_used
+
+    def truncate(self, size):
+        """ Changes size of the file """
+        self.flush()
+        return self.destination_file.truncate(size)
+
+    def fileno(self):
+        """ Returns file descriptor of the destination file """
+        return self.destination_file.fileno()
@@ -0,0 +1,166 @@
+"""
+Tape Ledger Class
+Keeps track of the tape space and tape streams shared by all of the virtual machines of the current backup run
+"""
+
+
+### INCLUDES ###
+import os
+import glob
+import threading
+
+from py_knife import file_system
+
+from .default_settings import MUTLIPLE_TAPE_SYSTEM, TARGET_TYPE_AUTO, TARGET_TYPE_DISK, TARGET_TYPE_TAPE
+from .default_settings import TAPE_FILE_SYSTEMS
+
+
+### CONSTANTS ###
+## Mount Table ##
+MOUNTS_PATH = '/proc/mounts'
+
+
+### FUNCTIONS ###
+def fetch_tape_list(settings):
+    """ Fetches list of available tapes (volumes) """
+    if MUTLIPLE_TAPE_SYSTEM:
+        tape_list = glob.glob(os.path.join(settings['tape_path'], '*'))
+    else:
+        tape_list = [settings['tape_path']]
+
+    return tape_list
+
+
+def fetch_tape(settings, path):
+    """ Figures out tape (volume) particular backup path belongs to """
+    if MUTLIPLE_TAPE_SYSTEM:
+        relative_path = os.path.relpath(path, settings['tape_path'])
+        return os.path.join(settings['tape_path'], relative_path.split(os.sep)[0])
+    else:
+        return settings['tape_path']
+
+
+def fetch_target_type(settings, tape):
+    """ Figures out if particular tape is an actual tape (LTFS) or a disk """
+    if settings['target_type'] != TARGET_TYPE_AUTO:
+        return settings['target_type']
+
+    # Find file system of the longest mount point tape path belongs to
+    tape_path = os.path.abspath(tape)
+    mount_point = ''
+    file_system_type = None
+    try:
+        with open(MOUNTS_PATH, 'r') as mounts_file:
+            for mount_line in mounts_file:
+                mount_fields = mount_line.split()
+                if len(mount_fields) < 3:
+                    continue
+
+                _mount_point = mount_fields[1].replace('\\040', ' ')
+                if (tape_path + os.sep).startswith(_mount_point.rstrip(os.sep) + os.sep):
+                    if len(_mount_point) >= len(mount_point):
+                        mount_point = _mount_point
+                        file_system_type = mount_fields[2]
+
+    except IOError:
+        # No mount table (not a Linux system)
+        return TARGET_TYPE_DISK
+
+    if file_system_type is not None:
+        for tape_file_system in TAPE_FILE_SYSTEMS:
+            if tape_file_system in file_system_type:
+                return TARGET_TYPE_TAPE
+
+    return TARGET_TYPE_DISK
+
+
+### CLASSES ###
+class TapeLedger(object):
+    """ Tape Ledger class. Keeps free space of each tape in memory, so tapes are not queried over and over again """
+    def __init__(self, settings, tape_workers=1):
+        self.settings = settings
+        self.tape_workers = max(1, int(tape_workers))
+        self.lock = threading.RLock()
+
+        self._free = {}
+        self._reserved = {}
+        self._slots = {}
+        self._streams = {}
+
+    ## Space Methods ##
+    def tape_list(self):
+        """ Returns list of available tapes """
+        return sorted(fetch_tape_list(self.settings))
+
+    def _space_free(self, tape):
+        """ Returns free space on particular tape, tape is queried on first use only """
+        if tape not in self._free:
+            self._free[tape] = file_system.get_free_space(tape)
+
+        return self._free[tape]
+
+    def space_free(self, tape):
+        """ Returns free space on particular tape (as of the last query) """
+        with self.lock:
+            return self._space_free(tape)
+
+    def space_reserved(self, tape):
+        """ Returns space reserved on particular tape by the planned backups and backups in progress """
+        with self.lock:
+            return self._reserved.get(tape, 0)
+
+    def space_available(self, tape):
+        """ Returns free space on particular tape minus space reserved by the planned and running backups """
+        with self.lock:
+            return self._space_free(tape) - self._reserved.get(tape, 0)
+
+    def reserve(self, tape, space_needed):
+        """ Reserves space on particular tape """
+        with self.lock:
+            self._reserved[tape] = self._reserved.get(tape, 0) + space_needed
+
+    def release(self, tape, space_needed):
+        """ Releases space reserved on particular tape """
+        with self.lock:
+            self._reserved[tape] = max(0, self._reserved.get(tape, 0) - space_needed)
+
+    def settle(self, tape, space_needed):
+        """ Releases space reserved by finished backup, tape free space reflects actual usage now """
+        # Note: Backups still in progress are counted twice (partially written data plus reservation), which is safe
+        with self.lock:
+            self.release(tape, space_needed)
+            self.refresh(tape)
+
+    def refresh(self, tape):
+        """ Queries free space on particular tape again (once backups are removed from it and etc.) """
+        with self.lock:
+            self._free[tape] = file_system.get_free_space(tape)
+
+    def reset(self):
+        """ Forgets free space and reservations of the previous backup run, tapes are queried again on next use """
+        with self.lock:
+            self._free.clear()
+            self._reserved.clear()
+
+    ## Stream Methods ##
+    def slot(self, tape):
+        """ Returns semaphore limiting number of concurrent backups written to particular tape """
+        with self.lock:
+            if tape not in self._slots:
+                self._slots[tape] = threading.BoundedSemaphore(self.tape_workers)
+
+            return self._slots[tape]
+
+    def stream(self, tape):
+        """ Returns semaphore limiting number of files written to particular tape at once (by all backups) """
+        with self.lock:
+            if tape not in self._streams:
+                target_type = fetch_target_type(self.settings, tape)
+                if target_type == TARGET_TYPE_TAPE:
+                    streams = self.settings['tape_streams']
+                else:
+                    streams = self.settings['disk_streams']
+
+                self._streams[tape] = threading.BoundedSemaphore(max(1, int(streams)))
+
+            return self._streams[tape]
@@ -0,0 +1,145 @@
+"""
+Bandwidth Limiter Class
+Keeps backup copies from starving virtual machines that are still running off the same datastore
+
+Read and write rates are limited using token buckets shared by all of the copies of the backup run. Limits could be
+applied during particular hours only (business hours), so backups speed up once those are over. Also, backup process
+could run with idle CPU and I/O priority.
+"""
+
+
+### INCLUDES ###
+import os
+import time
+import commands
+import threading
+
+from .default_settings import IO_PRIORITY_IDLE
+
+
+### CONSTANTS ###
+## Limiter Constants ##
+MEGA_BYTE = 1024 * 1024
+# Longest burst (in seconds of the rate limit) allowed after idle period
+BURST_DURATION = 1.0
+
+## Process Priority ##
+IDLE_NICE_INCREMENT = 19
+IONICE_IDLE_COMMAND = 'ionice -c 3 -p '
+
+
+### FUNCTIONS ###
+def parse_hours(limit_hours):
+    """ Parses hours string ('8-18'), returns (start, end) tuple or None if limits apply at all times """
+    if not limit_hours:
+        return None
+
+    start_hour, separator, end_hour = str(limit_hours).partition('-')
+    if not separator or not start_hour.isdigit() or not end_hour.isdigit():
+        raise ValueError('Hours string "' + str(limit_hours) + '" is in incompatible format!')
+
+    start_hour = int(start_hour)
+    end_hour = int(end_hour)
+    if not (0 <= start_hour <= 23 and 0 <= end_hour <= 24 and start_hour != end_hour):
+        raise ValueError('Hours string "' + str(limit_hours) + '" is out of range!')
+
+    return start_hour, end_hour
+
+
+def within_hours(hours, current_hour=None):
+    """ Tells if current hour is within hours (start hour included, end hour excluded, could wrap past midnight) """
+    if hours is None:
+        return True
+
+    if current_hour is None:
+        current_hour = time.localtime().tm_hour
+
+    start_hour, end_hour = hours
+    if start_hour < end_hour:
+        return start_hour <= current_hour < end_hour
+
+    return current_hour >= start_hour or current_hour < end_hour
+
+
+def lower_priority(settings, print_func=None):
+    """ Lowers CPU and I/O priority of the current thread (and threads it starts afterwards) if requested """
+    if settings['io_priority'] != IO_PRIORITY_IDLE or os.name != 'posix':
+        return
+
+    # Note: Linux keeps priorities per thread, threads inherit those from the thread that starts them
+    os.nice(IDLE_NICE_INCREMENT)
+
+    status, output = commands.getstatusoutput(IONICE_IDLE_COMMAND + str(os.getpid()))
+    if status and print_func is not None:
+        print_func('Could not set idle I/O priority: ' + output)
+
+
+### CLASSES ###
+class TokenBucket(object):
+    """ Token Bucket class. Callers are put to sleep once they consume more than rate allows """
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+
+        self._tokens = rate * BURST_DURATION
+        self._timestamp = time.time()
+
+    def consume(self, amount):
+        """ Consumes tokens, sleeps until consumed amount fits the rate """
+        with self.lock:
+            now = time.time()
+            self._tokens = min(self.rate * BURST_DURATION, self._tokens + (now - self._timestamp) * self.rate)
+            self._timestamp = now
+
+            # Note: Tokens could go negative (large buffers), following callers wait for the debt to be paid off
+            self._tokens -= amount
+            delay = 0.0
+            if self._tokens < 0:
+                delay = -self._tokens / self.rate
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+class BandwidthLimiter(object):
+    """ Bandwidth Limiter class. Single instance is shared by all of the virtual machines of the backup run """
+    def __init__(self, settings):
+        self.settings = settings
+        self.hours = parse_hours(settings['limit_hours'])
+
+        self._buckets = {}
+        for direction in ('read', 'write'):
+            rate = int(settings[direction + '_limit_mb']) * MEGA_BYTE
+            if rate > 0:
+                self._buckets[direction] = TokenBucket(rate)
+
+    ## Internal Methods ##
+    def _consume(self, direction, amount):
+        bucket = self._buckets.get(direction)
+        if bucket is not None and amount > 0 and within_hours(self.hours):
+            bucket.consume(amount)
+
+    def __str__(self):
+        limits = []
+        for direction in ('read', 'write'):
+            limit_mb = int(self.settings[direction + '_limit_mb'])
+            limits.append(direction + ' ' + (str(limit_mb) + ' MB/s' if limit_mb > 0 else 'unlimited'))
+
+        output = ', '.join(limits)
+        if self.hours is not None:
+            output += ' (from {0}:00 to {1}:00)'.format(*self.hours)
+
+        return output
+
+    ## External Methods ##
+    def enabled(self):
+        """ Tells if any of the limits is set """
+        return bool(len(self._buckets))
+
+    def read(self, amount):
+        """ Accounts for data read, sleeps if read rate is over the limit """
+        self._consume('read', amount)
+
+    def write(self, amount):
+        """ Accounts for data written, sleeps if write rate is over the limit """
+        self._consume('write', amount)
@@ -0,0 +1,102 @@
+"""
+Backup Verifier Class
+Reads backups back from the tapes and compares them against checksums recorded while copying
+
+Verification runs in a background thread, so backup of the next virtual machine does not wait for it.
+"""
+
+
+### INCLUDES ###
+import sys
+import time
+import Queue
+import threading
+
+from py_knife import file_system
+
+from .copy_engine import MEGA_BYTE
+from .backup_reader import BackupReader
+
+
+### CLASSES ###
+class BackupVerifier(object):
+    """ Backup Verifier class """
+    def __init__(self, settings, chunk_store, print_func=None):
+        self.settings = settings
+        self.chunk_store = chunk_store
+        self.buffer_size = max(1, int(settings['copy_buffer_mb'])) * MEGA_BYTE
+        self.print_func = print_func
+        self.results = {}
+
+        self._queue = Queue.Queue()
+        self._thread = None
+
+    ## Internal Methods ##
+    def _print(self, message):
+        if self.print_func is not None:
+            self.print_func(message)
+
+    def _verify(self, backup_path, log_prefix=''):
+        """ Verifies every file of particular backup, returns True if backup is intact """
+        try:
+            reader = BackupReader(self.settings, backup_path, self.chunk_store, self.buffer_size)
+        except (IOError, OSError, ValueError) as e:
+            self._print(log_prefix + 'Could not read file list of "' + backup_path + '": ' + str(e))
+            return False
+
+        if reader.checksum is None:
+            self._print(log_prefix + 'Backup "' + backup_path + '" has no checksums, checking sizes only')
+
+        start_time = time.time()
+        bytes_verified = 0
+        backup_intact = True
+        for relative_path in reader.files():
+            try:
+                error = reader.verify(relative_path)
+            except:
+                # Missing files, corrupted compressed streams and etc.
+                error = str(sys.exc_info()[1])
+
+            if error is not None:
+                self._print(log_prefix + 'Verification of "' + relative_path + '" failed: ' + error)
+                backup_intact = False
+            else:
+                bytes_verified += reader.size(relative_path)
+
+        self._print(log_prefix + 'Verified ' + file_system.print_memory_size(bytes_verified) + ' of "' + backup_path +
+                    '" in ' + '%.1fs' % (time.time() - start_time) + ': ' + ('OK' if backup_intact else 'FAILED'))
+
+        return backup_intact
+
+    def _worker(self):
+        """ Verifier thread, verifies submitted backups until it gets None """
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            name, backup_path, log_prefix = item
+            self.results[name] = self._verify(backup_path, log_prefix)
+
+    ## External Methods ##
+    def start(self):
+        """ Starts verifier thread """
+        self._thread = threading.Thread(target=self._worker, name='backup_verifier')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, name, backup_path, log_prefix=''):
+        """ Queues backup for verification """
+        self._queue.put((name, backup_path, log_prefix))
+
+    def join(self):
+        """ Waits for all of the queued backups to be verified, returns verification results """
+        if self._thread is not None:
+            self._queue.put(None)
+
+            # Note: Joining with timeout so main thread still responds to KeyboardInterrupt
+            while self._thread.is_alive():
+                self._thread.join(1)
+            self._thread = None
+
+        return self.results
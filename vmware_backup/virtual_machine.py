@@ -6,26 +6,56 @@ Virtual Machine Class
 ### INCLUDES ###
 import os
 import sys
-import commands
 import glob
+import time
 import filecmp
 
 from py_knife import file_system
-from py_knife.decorators import multiple_attempts
 
-from default_settings import LOG_TS_FORMAT, MUTLIPLE_TAPE_SYSTEM
+from default_settings import LOG_TS_FORMAT, PRINT_LOCK, BACKUP_MODE_FULL, BACKUP_MODE_INCREMENTAL, BACKUP_MODE_CHUNKED
+from default_settings import TARGET_TYPE_TAPE
+from copy_engine import CopyEngine, save_file_list
+from incremental import IncrementalBackup
+from chunk_store import ChunkStore, CHUNK_DIR_NAME
+from catalog import vmx_fingerprints
+from journal import BackupJournal, find_incomplete_backup, incomplete_backup
+from scheduler import BackupScheduler
+from tapes import TapeLedger, fetch_tape, fetch_target_type
+from vmrun import VmrunState
+from scanner import DirectoryScan
+from retry import retry_policy, OUTCOME_DONE, OUTCOME_IN_PROGRESS, OUTCOME_FAILED
+from metrics import load_history, ThroughputHistory
+from metrics import vm_metrics, OPERATION_SUSPEND, OPERATION_RESUME, OPERATION_CREATE_FOLDER, OPERATION_BACKUP
+
+
+### CONSTANTS ###
+## VMX Settings ##
+VMX_EXTENSION = '.vmx'
+VMX_MEMSIZE_KEY = 'memsize'
+MEGA_BYTE = 1024 * 1024
 
 
 ### FUNCTIONS ###
-def execute_backup(settings):
-    """ Backup Machines """
+def fetch_vm_list(settings):
+    """ Creates list of virtual machines found under virtual machines path """
     vm_list = []
     vm_path_list = glob.glob(os.path.join(settings['vms_path'], '*'))
     for vm_path in vm_path_list:
         vm_list.append(VirtualMachine(settings, vm_path))
 
-    for virtual_machine in vm_list:
-        virtual_machine.backup()
+    return vm_list
+
+
+def execute_backup(settings):
+    """ Backup Machines """
+    scheduler = BackupScheduler(settings, fetch_vm_list(settings))
+    return scheduler.run()
+
+
+def execute_plan(settings, metrics_dir):
+    """ Plan Backup (dry run), time estimates are based on metrics saved under particular folder """
+    scheduler = BackupScheduler(settings, fetch_vm_list(settings))
+    return scheduler.dry_run(ThroughputHistory(load_history(metrics_dir)))
 
 
 ### CLASSES ###
@@ -38,71 +68,135 @@ class VirtualMachine(object):
         self.vmware = None
         self.base_backup_path = None
         self.vm_backup_path = None
+        self.backup_required = None
+        self.space_estimate = 0
+        self.planned_tape = None
+        self.space_reserved = 0
+        self.incomplete_path = None
+        self.ledger = TapeLedger(settings)
+        self.log_prefix = ''
+        self.copy_engine = CopyEngine(settings, self._print)
+        self.incremental = IncrementalBackup(settings, self.copy_engine, self._print)
+        self.chunk_store = ChunkStore(settings)
+        self.catalog = None
+        self.retention = None
+        self.vmrun_state = VmrunState(settings, self._print)
+        self.scan = DirectoryScan(vm_path)
+        self.copy_stats = []
+        self.pre_copied = False
+        self.suspend_time = None
+        self.suspend_window = 0.0
+        self.metrics = vm_metrics()
+        self.async_resume = False
+        self.resume_result = None
 
     ## Some generic internal methods ##
     def _print(self, message):
         # Time Stamp Options 1 and 2
         if 'log_ts_format' in self.settings:
-            print file_system.create_time_stamp(self.settings['log_ts_format']), str(message)
+            time_stamp = file_system.create_time_stamp(self.settings['log_ts_format'])
         else:
-            print file_system.create_time_stamp(LOG_TS_FORMAT), str(message)
+            time_stamp = file_system.create_time_stamp(LOG_TS_FORMAT)
+
+        with PRINT_LOCK:
+            print time_stamp, self.log_prefix + str(message)
 
     def _exit(self, message):
         self._print(message)
         self.resume()
         sys.exit()
 
+    def _retry(self, operation, action, poll=None):
+        """ Executes operation according to its retry policy, returns True if operation is done """
+        policy = retry_policy(self.settings, operation)
+
+        def _action(attempt):
+            # Count retried attempts of particular operation
+            if attempt > 1:
+                self.metrics['retries'][operation] += 1
+            return action(attempt)
+
+        operation_done = bool(policy.run(_action, poll))
+        if not operation_done:
+            self._print("Operation '" + operation + "' has failed! Giving up (retry policy: " + str(policy) + ')')
+
+        return operation_done
+
     ## VMWare Communication Methods ##
     # Internal #
     def _fetch_vmware(self):
         """ Fetches vmware path if machine is currently running """
-        vm_list = commands.getoutput(self.settings['vmrun_path'] + ' list').split('\n')
-        if 'Total running VMs:' in vm_list[0]:
-            self._print(vm_list.pop(0))
-        else:
+        vm_dict = self.vmrun_state.running_vms()
+        if vm_dict is None:
             self._exit('VMWare vmrun location is incorrect, please provide it manually via command prompt. '
                        'Use -h option for help!')
 
-        vm_dict = {}
-        for vm_path in vm_list:
-            vm_name = os.path.basename(os.path.dirname(vm_path))
-            vm_dict[vm_name] = vm_path
-
         vmware_path = None
         if self.name in vm_dict.keys():
             vmware_path = vm_dict[self.name]
 
         return vmware_path
 
-    @multiple_attempts
-    def _suspend(self, **kwargs):
-        """ Suspending Virtual Machine (inner function) """
-        kwargs['success'] = bool(self._fetch_vmware() is None)
+    def _suspended(self):
+        """ Polls state of the machine being suspended """
+        self.vmrun_state.invalidate()
+        if self._fetch_vmware() is None:
+            self._print('Suspend of virtual machine is completed!')
+            return OUTCOME_DONE
+
+        return OUTCOME_IN_PROGRESS
+
+    def _suspend(self, attempt):
+        """ Suspending Virtual Machine (single attempt) """
+        if self._fetch_vmware() is None:
+            return OUTCOME_DONE
 
-        if not kwargs['success']:
-            total_attempts = str(kwargs['total_attempts'])
-            self._print('Suspending virtual machine... (attempt #' + total_attempts + ')')
-            os.system(self.settings['vmrun_path'] + ' suspend "' + self.vmware + '" soft')
+        total_attempts = str(attempt)
+        self._print('Suspending virtual machine... (attempt #' + total_attempts + ')')
+        result = self.vmrun_state.driver.run(['suspend', self.vmware, 'soft'])
+        self.metrics['vmrun_calls'] += 1
+        self.vmrun_state.invalidate()
+
+        if self._fetch_vmware() is None:
             self._print('Suspend of virtual machine is completed! (attempt #' + total_attempts + ')')
+            return OUTCOME_DONE
+
+        if result.exit_code != 0:
+            return OUTCOME_FAILED
+
+        # vmrun is done, but machine is still writing its memory to the disk
+        self._print('Waiting for virtual machine to suspend...')
+        return OUTCOME_IN_PROGRESS
+
+    def _resumed(self):
+        """ Polls state of the machine being resumed """
+        self.vmrun_state.invalidate()
+        if self._fetch_vmware() is not None:
+            self._print('Resume of virtual machine is completed!')
+            return OUTCOME_DONE
 
-            kwargs['success'] = bool(self._fetch_vmware() is None)
+        return OUTCOME_IN_PROGRESS
 
-        return kwargs
+    def _resume(self, attempt):
+        """ Resuming Virtual Machine (single attempt) """
+        if self._fetch_vmware() is not None:
+            return OUTCOME_DONE
 
-    @multiple_attempts
-    def _resume(self, **kwargs):
-        """ Resuming Virtual Machine (inner function) """
-        kwargs['success'] = bool(self._fetch_vmware() is not None)
+        total_attempts = str(attempt)
+        self._print('Resuming virtual machine... (attempt #' + total_attempts + ')')
+        result = self.vmrun_state.driver.run(['start', self.vmware, 'nogui'])
+        self.metrics['vmrun_calls'] += 1
+        self.vmrun_state.invalidate()
 
-        if not kwargs['success']:
-            total_attempts = str(kwargs['total_attempts'])
-            self._print('Resuming virtual machine... (attempt #' + total_attempts + ')')
-            os.system(self.settings['vmrun_path'] + ' start "' + self.vmware + '" nogui')
+        if self._fetch_vmware() is not None:
             self._print('Resume of virtual machine is completed! (attempt #' + total_attempts + ')')
+            return OUTCOME_DONE
 
-            kwargs['success'] = bool(self._fetch_vmware() is not None)
+        if result.exit_code != 0:
+            return OUTCOME_FAILED
 
-        return kwargs
+        self._print('Waiting for virtual machine to resume...')
+        return OUTCOME_IN_PROGRESS
 
     # External #
     # Note: User has to fetch state of the machine before using suspend or resume
@@ -115,17 +209,45 @@ class VirtualMachine(object):
     def suspend(self):
         """ Suspending Virtual Machine """
         if self.vmware:
-            self._suspend()
+            if self.suspend_time is None:
+                self.suspend_time = time.time()
+
+            start_time = time.time()
+            self._retry(OPERATION_SUSPEND, self._suspend, self._suspended)
+            self.metrics['suspend_latency'] += time.time() - start_time
+
+            # Suspended machine dumps its memory to the disk
+            self.scan.invalidate()
 
     def resume(self):
         """ Resuming Virtual Machine """
         if self.vmware:
-            self._resume()
+            start_time = time.time()
+            self._retry(OPERATION_RESUME, self._resume, self._resumed)
+            self.metrics['resume_latency'] += time.time() - start_time
+            self.scan.invalidate()
+
+            if self.suspend_time is not None:
+                self.suspend_window = time.time() - self.suspend_time
+                self.suspend_time = None
+                self._print('Suspend window: {0:.1f}s'.format(self.suspend_window))
+
+    def resume_async(self):
+        """ Resuming Virtual Machine in the background, so backup of the next machine does not wait for it """
+        self.resume_result = self.vmrun_state.driver.submit(self.resume)
+
+    def wait_resume(self):
+        """ Waits for the background resume (if any) to finish """
+        if self.resume_result is not None:
+            try:
+                self.resume_result.get()
+            finally:
+                self.resume_result = None
 
     ## Tape Methods ##
     def _space_available(self, tape):
         """ Reads available space on particular tape """
-        space_available = file_system.get_free_space(tape)
+        space_available = self.ledger.space_available(tape)
         tape_name = str(os.path.basename(tape))
         self._print("Space available on tape '" + tape_name + "': " + file_system.print_memory_size(space_available))
 
@@ -134,36 +256,89 @@ class VirtualMachine(object):
     def _fetch_base_path(self, space_needed):
         """ Figuring out what tape to use and generating path for the future backup location """
         tape_to_use = None
-        if MUTLIPLE_TAPE_SYSTEM:
-            tape_list = glob.glob(os.path.join(self.settings['tape_path'], '*'))
-        else:
-            tape_list = [self.settings['tape_path']]
-
-        for tape in tape_list:
-            # Figure out how much space we have on this tape
-            space_available = self._space_available(tape)
-
-            # Is it enough space?
-            if space_available >= space_needed:
-                self._print('Space available: ' + file_system.print_memory_size(space_available))
-                tape_to_use = tape
-                break
-        else:
-            self._exit('Tapes are full or inaccessible! Please unmount tape drive, reload tapes,'
-                       ' format all of them and remount tape drive!')
+        # Note: Other virtual machines might be picking their tapes at the same time
+        with self.ledger.lock:
+            tape_list = self.ledger.tape_list()
+            if self.planned_tape is not None:
+                # Try planned tape first, space estimate has been reserved there during planning
+                self.ledger.release(self.planned_tape, self.space_estimate)
+                tape_list.remove(self.planned_tape)
+                tape_list.insert(0, self.planned_tape)
+                self.planned_tape = None
+
+            incomplete_tape = None
+            incomplete_size = 0
+            if self.incomplete_path is not None:
+                # Try tape of the incomplete backup before anything else, so it could be continued
+                incomplete_tape = fetch_tape(self.settings, self.incomplete_path)
+                incomplete_size = file_system.get_size(self.incomplete_path)
+                if incomplete_tape in tape_list:
+                    tape_list.remove(incomplete_tape)
+                    tape_list.insert(0, incomplete_tape)
+
+            for tape in tape_list:
+                # Figure out how much space we have on this tape
+                space_available = self._space_available(tape)
+
+                # Incomplete backup takes up some of the space needed already
+                space_reserved = space_needed
+                if tape == incomplete_tape:
+                    space_reserved = max(0, space_needed - incomplete_size)
+
+                # Is it enough space?
+                if space_available >= space_reserved:
+                    self._print('Space available: ' + file_system.print_memory_size(space_available))
+                    tape_to_use = tape
+                    self.space_reserved = space_reserved
+                    self.ledger.reserve(tape_to_use, space_reserved)
+                    break
+
+            if tape_to_use is None and self.retention is not None:
+                # Free up space by pruning old backups
+                tape_to_use = self.retention.reclaim(space_needed, tape_list)
+                if tape_to_use is not None:
+                    self.space_reserved = space_needed
+                    self.ledger.reserve(tape_to_use, space_needed)
+
+        if tape_to_use is None:
+            self._print('Tapes are full or inaccessible! Please unmount tape drive, reload tapes,'
+                        ' format all of them and remount tape drive! Alternatively, set retention policy,'
+                        ' so old backups are pruned')
+            return None
 
         vm_base_name = os.path.basename(self.settings['vms_path'])
         vm_backup_name = vm_base_name + self.settings['_backup_ts']
 
         return os.path.join(tape_to_use, vm_backup_name)
 
-    @multiple_attempts
-    def _creating_backup_folder(self, **kwargs):
-        """ Creating backup folder on tape """
-        kwargs['success'] = kwargs['output'] = os.path.isdir(self.vm_backup_path)
+    def _continue_backup(self):
+        """ Moves incomplete backup of this machine (if any) to the current backup folder, so it is continued """
+        if self.incomplete_path is None:
+            return
+
+        if os.path.abspath(self.incomplete_path) == os.path.abspath(self.vm_backup_path):
+            # Same backup folder, journal takes care of the rest
+            return
+
+        if fetch_tape(self.settings, self.incomplete_path) != fetch_tape(self.settings, self.vm_backup_path):
+            self._print('Incomplete backup "' + self.incomplete_path + '" is on another tape, starting over!')
+            return
+
+        if os.path.exists(self.vm_backup_path):
+            return
+
+        self._print('Continuing incomplete backup "' + self.incomplete_path + '"')
+        file_system.make_dir(self.base_backup_path)
+        os.rename(self.incomplete_path, self.vm_backup_path)
+
+        incomplete_base_path = os.path.dirname(self.incomplete_path)
+        if not len(os.listdir(incomplete_base_path)):
+            os.rmdir(incomplete_base_path)
 
-        if not kwargs['success']:
-            total_attempts = str(kwargs['total_attempts'])
+    def _creating_backup_folder(self, attempt):
+        """ Creating backup folder on tape (single attempt) """
+        if not os.path.isdir(self.vm_backup_path):
+            total_attempts = str(attempt)
             try:
                 self._print('Creating backup folder... (attempt #' + total_attempts + ')')
                 file_system.make_dir(self.vm_backup_path)
@@ -180,19 +355,30 @@ class VirtualMachine(object):
             else:
                 self._print('Backup folder is successfully created!')
 
-            kwargs['success'] = kwargs['output'] = os.path.isdir(self.vm_backup_path)
+        if os.path.isdir(self.vm_backup_path):
+            return OUTCOME_DONE
 
-        return kwargs
+        return OUTCOME_FAILED
 
-    @multiple_attempts
-    def _backup(self, **kwargs):
-        """ Backup (internal function)"""
-        kwargs['success'] = False
-        total_attempts = str(kwargs['total_attempts'])
+    def _backup(self, attempt):
+        """ Backup (single attempt) """
+        outcome = OUTCOME_FAILED
+        total_attempts = str(attempt)
 
         try:
             self._print('Starting Backup... (attempt #' + total_attempts + ')')
-            file_system.copy_dir(self.path, self.vm_backup_path)
+            if self.settings['backup_mode'] == BACKUP_MODE_INCREMENTAL:
+                self.copy_stats = self.incremental.backup_dir(self.path, self.vm_backup_path, self.scan.entries())
+            elif self.settings['backup_mode'] == BACKUP_MODE_CHUNKED:
+                self.copy_stats = self.chunk_store.backup_dir(self.path, self.vm_backup_path, self.copy_engine,
+                                                              self._print, self.scan.entries())
+            elif self.pre_copied:
+                # Only changes made since the pre-copy have to be copied
+                self.copy_stats = self.copy_engine.sync_dir(self.path, self.vm_backup_path, self.scan.entries())
+            else:
+                self.copy_stats = self.copy_engine.copy_dir(self.path, self.vm_backup_path, self.scan.entries())
+
+            save_file_list(self.path, self.vm_backup_path, self.copy_stats, self.copy_engine.checksum)
 
         except OSError as e:
             self._print('Could not backup "' + self.name +
@@ -204,45 +390,97 @@ class VirtualMachine(object):
             self._print('Could not backup "' + self.name + '" virtual machine due to an error: ' +
                         str(sys.exc_info()[0]))
         else:
-            self._print('Backup Completed!')
-            kwargs['success'] = True
+            bytes_copied = self.metrics['bytes_copied'] = sum([stats.bytes_copied for stats in self.copy_stats])
+            bytes_written = self.metrics['bytes_written'] = sum([stats.bytes_written for stats in self.copy_stats])
+            copy_duration = sum([stats.duration for stats in self.copy_stats])
+            for stall_key in ('reader_stalls', 'reader_wait', 'writer_stalls', 'writer_wait'):
+                self.metrics[stall_key] = sum([getattr(stats, stall_key) for stats in self.copy_stats])
+            self._print('Backup Completed! Copied ' + file_system.print_memory_size(bytes_copied) +
+                        ' (' + file_system.print_memory_size(bytes_written) + ' written)' +
+                        ' in {0:.1f}s'.format(copy_duration))
+            outcome = OUTCOME_DONE
+
+        return outcome
+
+    def _two_phase(self):
+        """ Tells if this machine is copied in two phases (pre-copy while running, then changes once suspended) """
+        return bool(self.vmware and self.settings['two_phase_copy'] and
+                    self.settings['backup_mode'] == BACKUP_MODE_FULL)
+
+    def _pre_copy(self):
+        """ Copies this machine while it is still running, returns True if pre-copy is completed """
+        self._print('Starting Pre-Copy...')
+        try:
+            # Note: Machine has been running since it was planned, so files might be different by now
+            self.scan.invalidate()
+            stats_list = self.copy_engine.copy_dir(self.path, self.vm_backup_path, self.scan.entries())
+
+        except (OSError, IOError) as e:
+            # Not a big deal, everything is copied once machine is suspended
+            self._print('Pre-copy of "' + self.name + '" virtual machine failed due to an error ({0}): {1}'.format(
+                e.errno, e.strerror))
+            return False
+
+        bytes_copied = sum([stats.bytes_copied for stats in stats_list])
+        copy_duration = sum([stats.duration for stats in stats_list])
+        self._print('Pre-Copy Completed! Copied ' + file_system.print_memory_size(bytes_copied) +
+                    ' in {0:.1f}s'.format(copy_duration))
 
-        return kwargs
+        return True
 
     def backup_needed(self):
         """ Determine if backup needed or not """
         vmx_match = False
 
-        vmx_files = glob.glob(os.path.join(self.path, '*.vmx'))
+        vmx_files = self.scan.top_files(VMX_EXTENSION)
         if len(vmx_files) > 0:
-            for dir_path, dir_names, file_names in os.walk(self.settings['tape_path']):
-                for dir_name in dir_names:
-                    if self.name in dir_name:
-                        vm_path = os.path.join(dir_path, dir_name)
-                        # Compare *.vmx files (size and access date)
-                        _vmx_files = glob.glob(os.path.join(vm_path, '*.vmx'))
-
-                        for vmx_file in vmx_files:
-                            for _vmx_file in _vmx_files:
-                                # Compare files
-                                vmx_match = filecmp.cmp(_vmx_file, vmx_file, True)
-
-                                if vmx_match:
-                                    self._print("Virtual Machine '" + self.name + "' have been backed up already!")
-                                    self._print('Backup Path: ' + str(vm_path))
-                                    break
+            if self.catalog is not None:
+                # Indexed lookup, no need to scan the tapes
+                vm_path = self.catalog.find(self.name, vmx_fingerprints(self.path, vmx_files).values())
+                vmx_match = bool(vm_path is not None)
+
+                if vmx_match:
+                    self._print("Virtual Machine '" + self.name + "' have been backed up already!")
+                    self._print('Backup Path: ' + str(vm_path))
+                else:
+                    self._print("Virtual Machine '" + self.name + "' have not been backed up yet!")
+
+            else:
+                for dir_path, dir_names, file_names in os.walk(self.settings['tape_path']):
+                    # Chunk store folders do not contain any virtual machines
+                    if CHUNK_DIR_NAME in dir_names:
+                        dir_names.remove(CHUNK_DIR_NAME)
+
+                    for dir_name in dir_names:
+                        if self.name in dir_name:
+                            vm_path = os.path.join(dir_path, dir_name)
+                            if incomplete_backup(vm_path):
+                                continue
 
+                            # Compare *.vmx files (size and access date)
+                            _vmx_files = glob.glob(os.path.join(vm_path, '*.vmx'))
+
+                            for vmx_file in vmx_files:
+                                for _vmx_file in _vmx_files:
+                                    # Compare files
+                                    vmx_match = filecmp.cmp(_vmx_file, vmx_file, True)
+
+                                    if vmx_match:
+                                        self._print("Virtual Machine '" + self.name + "' have been backed up already!")
+                                        self._print('Backup Path: ' + str(vm_path))
+                                        break
+
+                                else:
+                                    continue
+                                break
                             else:
                                 continue
                             break
-                        else:
-                            continue
-                        break
+                    else:
+                        continue
+                    break
                 else:
-                    continue
-                break
-            else:
-                self._print("Virtual Machine '" + self.name + "' have not been backed up yet!")
+                    self._print("Virtual Machine '" + self.name + "' have not been backed up yet!")
 
         else:
             vmx_match = True
@@ -250,10 +488,37 @@ class VirtualMachine(object):
 
         return not vmx_match
 
-    ## VMWare Backup Method ##
-    def backup(self):
-        """ Execute backup of this virtual machine """
+    ## Planning Methods ##
+    def _memory_size(self):
+        """ Reads memory size of this virtual machine from its *.vmx file(s) """
+        memory_size = 0
+        for vmx_path in self.scan.top_files(VMX_EXTENSION):
+            with open(vmx_path, 'r') as vmx_file:
+                for vmx_line in vmx_file:
+                    vmx_key, separator, vmx_value = vmx_line.partition('=')
+                    if separator and vmx_key.strip() == VMX_MEMSIZE_KEY:
+                        vmx_value = vmx_value.strip().strip('"')
+                        if vmx_value.isdigit():
+                            memory_size = max(memory_size, int(vmx_value) * MEGA_BYTE)
+
+        return memory_size
+
+    def _scan_size(self):
+        """ Returns space machine files will take up on the tape (full backups copy virtual disks sparse) """
+        sparse = bool(self.settings['sparse_copy'] and self.settings['backup_mode'] == BACKUP_MODE_FULL)
+        return self.scan.size(allocated=sparse)
+
+    def _estimate_space(self):
+        """ Estimates space this machine will take up once suspended """
+        space_estimate = self._scan_size()
+        if self.vmware:
+            # Suspending machine dumps its memory to the disk
+            space_estimate += self._memory_size()
+
+        return space_estimate
 
+    def plan(self):
+        """ Figures out if backup is needed and how much space it will take. Does not suspend the machine """
         # Print some basic info about this Virtual Machine
         self._print('VM Name: ' + self.name)
         self._print('VM Path: ' + self.path)
@@ -262,26 +527,127 @@ class VirtualMachine(object):
         vm_state = self.state()
         self._print('VM Running: ' + str(vm_state))
 
-        if self.backup_needed():
-            # Suspend Virtual Machine (if needed)
-            self.suspend()
+        self.backup_required = self.backup_needed()
+        if self.backup_required:
+            self.space_estimate = self._estimate_space()
+            self._print('Space estimate: ' + file_system.print_memory_size(self.space_estimate))
 
-            # Figure out how much space this Virtual Machine is taking up
-            space_needed = file_system.get_size(self.path)
+        return self.backup_required
+
+    def estimate_times(self, history):
+        """ Estimates copy time and suspend window of the planned backup using throughput recorded by earlier runs.
+        Returns (None, None) if nothing has been recorded yet """
+        throughput = history.throughput(self.name)
+        if not throughput:
+            return None, None
+
+        copy_time = self.space_estimate / throughput
+        if not self.vmware:
+            return copy_time, 0.0
+
+        if self._two_phase():
+            # Suspended only to copy changes made during the pre-copy
+            suspend_window = history.mean(self.name, 'suspend_window')
+            if suspend_window is not None:
+                return copy_time, suspend_window
+
+        # Suspended for the whole copy
+        suspend_latency = history.mean(self.name, 'suspend_latency') or 0.0
+        resume_latency = history.mean(self.name, 'resume_latency') or 0.0
+        return copy_time, suspend_latency + copy_time + resume_latency
+
+    ## VMWare Backup Method ##
+    def backup(self):
+        """ Execute backup of this virtual machine. Returns None if backup is not needed """
+        backup_completed = None
+
+        if self.backup_required is None:
+            self.plan()
+        else:
+            # Planned already, but machine state might have changed since
+            self._print('VM Name: ' + self.name)
+            vm_state = self.state()
+            self._print('VM Running: ' + str(vm_state))
+
+        if self.backup_required:
+            two_phase = self._two_phase()
+
+            # Machine keeps running until its backup gets a tape slot, so space needed includes memory dumped on suspend
+            space_needed = self._estimate_space()
             self._print('Space needed: ' + file_system.print_memory_size(space_needed))
 
+            # Failed backup of this machine could be continued instead of starting over
+            if self.settings['backup_mode'] == BACKUP_MODE_FULL:
+                self.incomplete_path = find_incomplete_backup(self.settings, self.name)
+
             # Figure out what tape we will use to back up this Virtual Machine
             self.base_backup_path = self._fetch_base_path(space_needed)
+            if self.base_backup_path is None:
+                return False
+
             self.vm_backup_path = os.path.join(self.base_backup_path, self.name)
             self._print('BackUp Location: ' + str(self.vm_backup_path))
+            self._continue_backup()
 
-            # Creating backup folder
-            backup_folder_created = self._creating_backup_folder()
-
-            if backup_folder_created:
-                # Backup this Virtual Machine
-                # TODO: Add some compression options and functions
-                self._backup()
-
-            # Resume Virtual Machine (if needed)
-            self.resume()
+            tape = os.path.dirname(self.base_backup_path)
+            try:
+                # Limit number of concurrent backups written to the same tape
+                with self.ledger.slot(tape):
+                    if not two_phase:
+                        # Suspend Virtual Machine (if needed)
+                        self.suspend()
+
+                        # Files might have grown since the estimate
+                        space_extra = self._scan_size() - space_needed
+                        if space_extra > 0:
+                            self.space_reserved += space_extra
+                            self.ledger.reserve(tape, space_extra)
+
+                    self.copy_engine.stream = self.ledger.stream(tape)
+                    self.copy_engine.tape_target = bool(fetch_target_type(self.settings, tape) == TARGET_TYPE_TAPE)
+                    self.metrics['tape'] = os.path.basename(tape)
+                    self.metrics['space_free_before'] = self.ledger.space_free(tape)
+
+                    # Creating backup folder
+                    backup_folder_created = self._retry(OPERATION_CREATE_FOLDER, self._creating_backup_folder)
+
+                    backup_completed = False
+                    if backup_folder_created:
+                        if self.settings['backup_mode'] == BACKUP_MODE_FULL:
+                            # Keep track of the progress, so failed copy continues where it stopped
+                            self.copy_engine.journal = BackupJournal(self.path, self.vm_backup_path)
+
+                        if two_phase:
+                            # Copy while running, machine is suspended only to copy changes made since
+                            start_time = time.time()
+                            self.copy_engine.track_blocks = True
+                            self.pre_copied = self._pre_copy()
+                            self.metrics['pre_copy_duration'] = time.time() - start_time
+                            self.suspend()
+
+                        # Backup this Virtual Machine
+                        start_time = time.time()
+                        backup_completed = self._retry(OPERATION_BACKUP, self._backup)
+                        self.metrics['copy_duration'] = copy_duration = time.time() - start_time
+                        if backup_completed and copy_duration > 0:
+                            self.metrics['throughput'] = self.metrics['bytes_copied'] / copy_duration
+
+                    if backup_completed and self.copy_engine.journal is not None:
+                        self.copy_engine.journal.remove()
+
+                    if backup_completed and self.catalog is not None:
+                        self.catalog.record(self.name, self.vm_backup_path)
+
+                    # Resume Virtual Machine (if needed) before the next backup written to this tape gets the slot
+                    if self.async_resume:
+                        self.resume_async()
+                    else:
+                        self.resume()
+
+            finally:
+                # Backup is done, tape free space reflects actual usage now
+                self.ledger.settle(tape, self.space_reserved)
+                self.metrics['space_free_after'] = self.ledger.space_free(tape)
+                self.copy_engine.close()
+
+        return backup_completed
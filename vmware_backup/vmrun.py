@@ -0,0 +1,187 @@
+"""
+VMWare vmrun Related Classes
+Executing vmrun is slow, so state of the virtual machines is fetched once and shared by all virtual machines
+
+Every vmrun call goes through the driver. Driver limits how long a single call could take (hung vmrun does not stall
+the whole backup run), captures exit code and error output and executes calls in the background on request.
+"""
+
+
+### INCLUDES ###
+import os
+import time
+import errno
+import signal
+import threading
+import subprocess
+import collections
+
+from multiprocessing.pool import ThreadPool
+
+
+### CONSTANTS ###
+## vmrun Output ##
+VMRUN_LIST_HEADER = 'Total running VMs:'
+
+## vmrun Results ##
+VmrunResult = collections.namedtuple('VmrunResult', ('command', 'exit_code', 'output', 'error', 'duration',
+                                                     'timed_out'))
+
+
+### CLASSES ###
+class VmrunDriver(object):
+    """ vmrun Driver class. Single instance is shared by all of the virtual machines """
+    def __init__(self, settings, print_func=None):
+        self.settings = settings
+        self.timeout = float(settings['vmrun_timeout'])
+        self.workers = max(1, int(settings['backup_workers']))
+        self.print_func = print_func
+        self.lock = threading.Lock()
+        self.calls = collections.Counter()
+        self.timeouts = 0
+
+        self._pool = None
+
+    ## Internal Methods ##
+    def _print(self, message):
+        if self.print_func is not None:
+            self.print_func(message)
+
+    def _kill(self, process, timed_out):
+        """ Kills hung vmrun process """
+        timed_out.append(True)
+        try:
+            if os.name == 'posix':
+                # Note: vmrun might be a wrapper script, children holding its output open are killed as well
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+        except OSError as e:
+            # Process has just finished
+            if e.errno != errno.ESRCH:
+                raise
+
+    ## External Methods ##
+    def run(self, arguments, timeout=None):
+        """ Executes vmrun command, returns vmrun result. Process is killed if it takes longer than timeout """
+        if timeout is None:
+            timeout = self.timeout
+
+        command = arguments[0]
+        with self.lock:
+            self.calls[command] += 1
+
+        start_time = time.time()
+        try:
+            process = subprocess.Popen([self.settings['vmrun_path']] + list(arguments),
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True,
+                                       preexec_fn=os.setsid if os.name == 'posix' else None)
+        except OSError as e:
+            return VmrunResult(command, None, '', str(e), time.time() - start_time, False)
+
+        timed_out = []
+        timer = None
+        if timeout > 0:
+            timer = threading.Timer(timeout, self._kill, (process, timed_out))
+            timer.daemon = True
+            timer.start()
+
+        try:
+            output, error = process.communicate()
+        finally:
+            if timer is not None:
+                # Note: Cancelled timer is joined, so it is not left running at interpreter shutdown
+                timer.cancel()
+                timer.join()
+
+        result = VmrunResult(command, process.returncode, output, error, time.time() - start_time, bool(timed_out))
+        if result.timed_out:
+            with self.lock:
+                self.timeouts += 1
+            self._print("vmrun '" + command + "' has timed out after {0:.0f}s and has been killed!".format(timeout))
+        elif result.exit_code:
+            self._print("vmrun '" + command + "' has failed with exit code " + str(result.exit_code) + ': ' +
+                        (result.error or result.output).strip())
+
+        return result
+
+    def submit(self, func, *args):
+        """ Executes function (suspend or resume of a machine and etc.) in the background, returns async result """
+        with self.lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+
+        return self._pool.apply_async(func, args)
+
+    def close(self):
+        """ Waits for background calls to finish """
+        with self.lock:
+            pool = self._pool
+            self._pool = None
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+class VmrunState(object):
+    """ Cached snapshot of 'vmrun list' output. Single instance is shared by all of the virtual machines """
+    def __init__(self, settings, print_func=None):
+        self.settings = settings
+        self.ttl = float(settings['vmrun_cache_ttl'])
+        self.print_func = print_func
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.driver = VmrunDriver(settings, print_func)
+
+        self._running_vms = None
+        self._timestamp = 0.0
+
+    ## Internal Methods ##
+    def _print(self, message):
+        if self.print_func is not None:
+            self.print_func(message)
+
+    def _list(self):
+        """ Executes 'vmrun list', returns dictionary of running virtual machines (name to *.vmx path) """
+        self.calls += 1
+        result = self.driver.run(['list'])
+        if result.exit_code != 0:
+            return None
+
+        vm_list = result.output.strip().split('\n')
+        if VMRUN_LIST_HEADER not in vm_list[0]:
+            return None
+
+        self._print(vm_list.pop(0))
+
+        running_vms = {}
+        for vm_path in vm_list:
+            vm_name = os.path.basename(os.path.dirname(vm_path))
+            running_vms[vm_name] = vm_path
+
+        return running_vms
+
+    ## External Methods ##
+    def running_vms(self):
+        """ Returns dictionary of running virtual machines, None if vmrun could not be executed """
+        # Note: Concurrent callers wait for a single vmrun call instead of issuing their own
+        with self.lock:
+            if self._running_vms is None or time.time() - self._timestamp > self.ttl:
+                self._running_vms = self._list()
+                self._timestamp = time.time()
+
+            return self._running_vms
+
+    def invalidate(self):
+        """ Drops cached state. Has to be called whenever virtual machine is suspended or started """
+        with self.lock:
+            self._running_vms = None
+
+    def reset_counters(self):
+        """ Resets call counters, so those reflect single backup run """
+        with self.lock:
+            self.calls = 0
+            with self.driver.lock:
+                self.driver.calls.clear()
+                self.driver.timeouts = 0